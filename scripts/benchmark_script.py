@@ -0,0 +1,74 @@
+import argparse
+import time
+from copy import deepcopy
+import numpy as np
+import torch
+from src.agents.vin_agent import VINAgent
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--state_dim", type=int, default=30)
+    parser.add_argument("--hmm_rank", type=int, default=32)
+    parser.add_argument("--horizon", type=int, default=30)
+    parser.add_argument("--obs_cov", type=str, choices=["full", "diag", "tied"], default="full")
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_iters", type=int, default=20)
+    arglist = parser.parse_args()
+    return arglist
+
+def step(agent, o, u, mask, backward):
+    """ Return the time of one forward or forward + backward pass in seconds """
+    start = time.time()
+    agent.zero_grad()
+    agent.reset() # clear cached planning tensors
+    out, hidden = agent(o, u)
+    loss_u, _ = agent.act_loss(o, u, mask, hidden)
+    loss_o, _ = agent.obs_loss(o, u, mask, hidden)
+    if backward:
+        torch.mean(loss_u + loss_o).backward()
+    return time.time() - start
+
+def benchmark(agents, o, u, mask, num_iters):
+    """ Return median forward and forward + backward time in seconds of each agent. 
+    Agents are timed in alternation so that machine load affects them equally """
+    # warm up
+    for agent in agents.values():
+        for _ in range(3):
+            step(agent, o, u, mask, True)
+    
+    times = {name: {"forward": [], "forward_backward": []} for name in agents.keys()}
+    for _ in range(num_iters):
+        for backward in [False, True]:
+            key = "forward_backward" if backward else "forward"
+            for name, agent in agents.items():
+                times[name][key].append(step(agent, o, u, mask, backward))
+    return {name: {k: np.median(v) for k, v in t.items()} for name, t in times.items()}
+
+def main(arglist):
+    np.random.seed(arglist.seed)
+    torch.manual_seed(arglist.seed)
+    
+    obs_dim = 2
+    act_dim = 3
+    agent = VINAgent(
+        arglist.state_dim, act_dim, obs_dim, arglist.hmm_rank, arglist.horizon, 
+        1., 1., arglist.obs_cov
+    )
+    
+    o = torch.randn(arglist.seq_len, arglist.batch_size, obs_dim)
+    u = torch.randint(0, act_dim, size=(arglist.seq_len, arglist.batch_size, 1)).to(torch.float32)
+    mask = torch.ones(arglist.seq_len, arglist.batch_size)
+    
+    agents = {"eager": agent, "script": deepcopy(agent).script()}
+    times = benchmark(agents, o, u, mask, arglist.num_iters)
+    eager_times, script_times = times["eager"], times["script"]
+    for k in eager_times.keys():
+        print("{}: eager {:.2f}ms, script {:.2f}ms, speedup {:.2f}x".format(
+            k, eager_times[k] * 1e3, script_times[k] * 1e3, eager_times[k] / script_times[k]
+        ))
+
+if __name__ == "__main__":
+    arglist = parse_args()
+    main(arglist)
@@ -0,0 +1,90 @@
+import argparse
+import os
+import json
+import pickle
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from src.agents.vin_agent import VINAgent
+from src.agents.compaction import (
+    compute_state_occupancy, find_state_groups, compact_agent, compare_action_predictions
+)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp_path", type=str, default="../exp")
+    parser.add_argument("--exp_name", type=str, default="")
+    parser.add_argument("--data_path", type=str, default="../data/data.p")
+    parser.add_argument("--save_name", type=str, default="compact")
+    parser.add_argument("--min_occupancy", type=float, default=1e-3)
+    parser.add_argument("--merge_dist", type=float, default=0.)
+    parser.add_argument("--tol", type=float, default=0.05, help="max action probability error, default=0.05")
+    parser.add_argument("--batch_size", type=int, default=100)
+    arglist = parser.parse_args()
+    return arglist
+
+def make_loader(dataset, batch_size):
+    """ Yield padded batches of demonstration episodes """
+    for i in range(0, len(dataset), batch_size):
+        batch = dataset[i:i+batch_size]
+        obs = pad_sequence([torch.from_numpy(np.stack(d["obs"])).to(torch.float32) for d in batch])
+        act = pad_sequence([torch.from_numpy(np.stack(d["act"])).to(torch.float32).view(-1, 1) for d in batch])
+        mask = 1 - torch.all(obs == 0, dim=-1).to(torch.float32)
+        yield {"obs": obs, "act": act}, mask
+
+def main(arglist):
+    exp_path = os.path.join(arglist.exp_path, arglist.exp_name)
+
+    # load args
+    with open(os.path.join(exp_path, "args.json"), "r") as f:
+        config = json.load(f)
+
+    # load state dict
+    state_dict = torch.load(os.path.join(exp_path, "model.pt"), map_location=torch.device("cpu"))
+    state_dict = {k.replace("agent.", ""): v for (k, v) in state_dict.items() if "agent." in k and "ref" not in k}
+
+    obs_dim = 2
+    act_dim = 3
+    agent = VINAgent(
+        config["state_dim"], act_dim, obs_dim, config["hmm_rank"], config["horizon"],
+        config["alpha"], config["epsilon"], config["obs_cov"],
+        config.get("horizon_tol", 0.), config.get("log_space", False),
+        config.get("belief_topk", 0), config.get("belief_tol", 0.)
+    )
+    agent.load_state_dict(state_dict, strict=True)
+    agent.eval()
+
+    # load expert data
+    with open(arglist.data_path, "rb") as f:
+        dataset = pickle.load(f)
+    print(f"loaded {len(dataset)} episodes of demonstrations")
+
+    occupancy = compute_state_occupancy(agent, make_loader(dataset, arglist.batch_size))
+    groups = find_state_groups(agent, occupancy, arglist.min_occupancy, arglist.merge_dist)
+    compact = compact_agent(agent, groups, occupancy)
+    compact.eval()
+
+    max_err = compare_action_predictions(agent, compact, make_loader(dataset, arglist.batch_size))
+    print(f"state_dim: {agent.state_dim} -> {compact.state_dim}, max action error: {max_err:.4f}")
+    if max_err > arglist.tol:
+        print(f"max action error exceeds tol {arglist.tol}, compact agent not saved")
+        return
+
+    # save compact agent in the training output format
+    save_path = os.path.join(exp_path, arglist.save_name)
+    if not os.path.exists(save_path):
+        os.mkdir(save_path)
+
+    config.update({"state_dim": compact.state_dim, "hmm_rank": 0, "belief_topk": compact.rnn.belief_topk})
+    with open(os.path.join(save_path, "args.json"), "w") as f:
+        json.dump(config, f)
+
+    torch.save(
+        {"agent." + k: v for (k, v) in compact.state_dict().items()},
+        os.path.join(save_path, "model.pt")
+    )
+    print(f"compact agent saved to: {save_path}")
+
+if __name__ == "__main__":
+    arglist = parse_args()
+    main(arglist)
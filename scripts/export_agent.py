@@ -0,0 +1,44 @@
+import argparse
+import os
+import json
+import torch
+from src.agents.vin_agent import VINAgent
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp_path", type=str, default="../exp")
+    parser.add_argument("--exp_name", type=str, default="")
+    parser.add_argument("--filename", type=str, default="policy.npz")
+    arglist = parser.parse_args()
+    return arglist
+
+def main(arglist):
+    exp_path = os.path.join(arglist.exp_path, arglist.exp_name)
+
+    # load args
+    with open(os.path.join(exp_path, "args.json"), "r") as f:
+        config = json.load(f)
+    
+    # load state dict
+    state_dict = torch.load(os.path.join(exp_path, "model.pt"), map_location=torch.device("cpu"))
+    state_dict = {k.replace("agent.", ""): v for (k, v) in state_dict.items() if "agent." in k and "ref" not in k}
+
+    obs_dim = 2
+    act_dim = 3
+    agent = VINAgent(
+        config["state_dim"], act_dim, obs_dim, config["hmm_rank"], config["horizon"],
+        config["alpha"], config["epsilon"], config["obs_cov"], 
+        config.get("horizon_tol", 0.), config.get("log_space", False), 
+        config.get("belief_topk", 0), config.get("belief_tol", 0.)
+    )
+    agent.load_state_dict(state_dict, strict=True)
+    agent.eval()
+    
+    session = agent.inference_session()
+    save_path = os.path.join(exp_path, arglist.filename)
+    session.export(save_path)
+    print(f"exported {session} to: {save_path}")
+
+if __name__ == "__main__":
+    arglist = parse_args()
+    main(arglist)
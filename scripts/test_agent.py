@@ -12,20 +12,19 @@ def parse_args():
     parser.add_argument("--exp_path", type=str, default="../exp")
     parser.add_argument("--exp_name", type=str, default="")
     parser.add_argument("--num_eps", type=int, default=3)
+    parser.add_argument("--grid_bins", type=int, default=0, help="obs likelihood grid size, 0 for exact, default=0")
     arglist = parser.parse_args()
     return arglist
 
-def episode(env, agent, max_steps=500):
-    agent.eval()
-    agent.reset()
+def episode(env, session, max_steps=500):
+    session.reset()
 
     data = {"obs": [], "act": [], "reward": [], "next_obs": [], "done": []}
     obs = env.reset()
     
     for t in range(max_steps):
         obs_tensor = torch.from_numpy(obs).view(1, -1).to(torch.float32)
-        with torch.no_grad():
-            a = agent.choose_action(obs_tensor).numpy()[0]
+        a = session.step(obs_tensor).numpy()[0]
 
         next_obs, reward, done, into = env.step(a)
 
@@ -60,18 +59,25 @@ def main(arglist):
     act_dim = 3
     agent = VINAgent(
         config["state_dim"], act_dim, obs_dim, config["hmm_rank"], config["horizon"],
-        config["alpha"], config["epsilon"], config["obs_cov"]
+        config["alpha"], config["epsilon"], config["obs_cov"], 
+        config.get("horizon_tol", 0.), config.get("log_space", False), 
+        config.get("belief_topk", 0), config.get("belief_tol", 0.)
     )
     agent.load_state_dict(state_dict, strict=True)
+    agent.eval()
     print(agent)
-
+    
     x_bins = 20
     v_bins = 20
     env = CustomMountainCar(x_bins=x_bins, v_bins=v_bins, seed=arglist.seed)
     
+    session = agent.inference_session(env.low, env.high, arglist.grid_bins)
+    if session.obs_grid is not None:
+        print(session.obs_grid)
+    
     scores = []
     for e in range(arglist.num_eps):
-        data = episode(env, agent)
+        data = episode(env, session)
         scores.append(len(data['reward']))
         print(f"score: {scores[-1]}")
 
@@ -13,7 +13,11 @@ import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset, DataLoader
 
+from src.env.mountain_car import CustomMountainCar
 from src.agents.vin_agent import VINAgent
+from src.agents.warm_start import warm_start_agent
+from src.distributions.mixture_init import iter_obs_batches, init_obs_model
+from src.distributions.running_stats import RunningStats
 from src.algo.bc import BehaviorCloning
 
 def parse_args():
@@ -26,6 +30,13 @@ def parse_args():
     parser.add_argument("--state_dim", type=int, default=30)
     parser.add_argument("--hmm_rank", type=int, default=32)
     parser.add_argument("--horizon", type=int, default=30)
+    parser.add_argument("--horizon_tol", type=float, default=0.)
+    parser.add_argument("--log_space", type=bool_, default=False)
+    parser.add_argument("--belief_topk", type=int, default=0)
+    parser.add_argument("--belief_tol", type=float, default=0.)
+    parser.add_argument("--warm_start", type=bool_, default=False)
+    parser.add_argument("--init_obs", type=bool_, default=False, help="init obs model with k-means and em, exclusive with warm_start, default=False")
+    parser.add_argument("--em_steps", type=int, default=5)
     parser.add_argument("--alpha", type=float, default=1.)
     parser.add_argument("--epsilon", type=float, default=1.)
     parser.add_argument("--obs_cov", type=str, choices=["full", "diag", "tied"], default="full")
@@ -41,6 +52,9 @@ def parse_args():
     parser.add_argument("--epochs", type=int, default=10)
     parser.add_argument("--save", type=bool_, default=True)
     arglist = parser.parse_args()
+    if arglist.init_obs and arglist.warm_start:
+        # warm start fits the obs model to its own state clusters
+        parser.error("--init_obs and --warm_start both initialize the obs model, set only one")
     return arglist
 
 class CustomDataset(Dataset):
@@ -148,19 +162,34 @@ def main(arglist):
     print(f"train size: {len(train_loader.dataset)}, test size: {len(test_loader.dataset)}")
     
     # compute obs mean and variance
-    obs_cat = np.vstack([d["obs"] for d in dataset])
-    obs_mean = obs_cat.mean(axis=0)
-    obs_variance = obs_cat.var(axis=0)
+    obs_stats = RunningStats()
+    for d in dataset:
+        obs_stats.update(np.stack(d["obs"]))
+    obs_mean = obs_stats.mean
+    obs_variance = obs_stats.variance
     
     obs_dim = 2
     act_dim = 3
     agent = VINAgent(
         arglist.state_dim, act_dim, obs_dim, arglist.hmm_rank, arglist.horizon, 
-        arglist.alpha, arglist.epsilon, arglist.obs_cov
+        arglist.alpha, arglist.epsilon, arglist.obs_cov, arglist.horizon_tol, 
+        arglist.log_space, arglist.belief_topk, arglist.belief_tol
     )
     agent.obs_model.bn.moving_mean.data = torch.from_numpy(obs_mean).to(torch.float32)
     agent.obs_model.bn.moving_variance.data = torch.from_numpy(obs_variance).to(torch.float32)
     
+    if arglist.init_obs:
+        make_batches = lambda: iter_obs_batches([d["obs"] for d in dataset])
+        init_obs_model(agent.obs_model, make_batches, em_steps=arglist.em_steps)
+        print("initialized obs model from data")
+    
+    if arglist.warm_start:
+        env_model = CustomMountainCar(x_bins=20, v_bins=20)
+        env_model.make_initial_distribution()
+        env_model.make_transition_matrix()
+        kl = warm_start_agent(agent, env_model)
+        print(f"warm started agent from env model, transition kl: {kl:.4f}")
+    
     model = BehaviorCloning(
         agent, arglist.bptt_steps, arglist.obs_penalty, 
         arglist.lr, arglist.decay, arglist.grad_clip
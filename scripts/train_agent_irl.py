@@ -10,6 +10,9 @@ import torch
 
 from src.env.mountain_car import CustomMountainCar
 from src.agents.vin_agent import VINAgent
+from src.agents.warm_start import warm_start_agent
+from src.distributions.mixture_init import iter_obs_batches, init_obs_model
+from src.distributions.running_stats import RunningStats
 from src.algo.irl import DAC
 from src.algo.rl_utils import train
 
@@ -24,6 +27,13 @@ def parse_args():
     parser.add_argument("--state_dim", type=int, default=30)
     parser.add_argument("--hmm_rank", type=int, default=32)
     parser.add_argument("--horizon", type=int, default=30)
+    parser.add_argument("--horizon_tol", type=float, default=0.)
+    parser.add_argument("--log_space", type=bool_, default=False)
+    parser.add_argument("--belief_topk", type=int, default=0)
+    parser.add_argument("--belief_tol", type=float, default=0.)
+    parser.add_argument("--warm_start", type=bool_, default=False, help="initialize agent from env model, default=False")
+    parser.add_argument("--init_obs", type=bool_, default=False, help="init obs model with k-means and em, exclusive with warm_start, default=False")
+    parser.add_argument("--em_steps", type=int, default=5)
     parser.add_argument("--alpha", type=float, default=1.)
     parser.add_argument("--epsilon", type=float, default=1.)
     parser.add_argument("--obs_cov", type=str, choices=["full", "diag", "tied"], default="full")
@@ -37,8 +47,16 @@ def parse_args():
     parser.add_argument("--polyak", type=float, default=0.995, help="polyak averaging factor, default=0.995")
     parser.add_argument("--norm_obs", type=bool_, default=False, help="whether to normalize observations for agent and algo, default=False")
     parser.add_argument("--use_state", type=bool_, default=False, help="whether to use state in discriminator and critic, default=False")
+    parser.add_argument("--num_critics", type=int, default=2, help="number of ensemble critics, default=2")
+    parser.add_argument("--critic_reduce", type=str, choices=["min", "mean", "subset"], default="min", help="critic ensemble reduction, default=min")
     # training args
     parser.add_argument("--buffer_size", type=int, default=1e4, help="agent replay buffer size, default=1e5")
+    parser.add_argument("--buffer_path", type=str, default="none", help="replay buffer memory-mapped storage directory, reopened if it exists, default=none")
+    parser.add_argument("--demo_buffer_path", type=str, default="none", help="demonstration buffer memory-mapped storage directory, opened read only if it exists, default=none")
+    parser.add_argument("--buffer_state_dtype", type=str, choices=["float32", "float16"], default="float32", help="replay buffer state storage dtype, default=float32")
+    parser.add_argument("--priority_alpha", type=float, default=0., help="critic replay td error priority exponent, uniform sampling if 0, default=0.")
+    parser.add_argument("--priority_beta", type=float, default=0.4, help="critic replay importance weight exponent, default=0.4")
+    parser.add_argument("--prefetch", type=int, default=0, help="number of training batches sampled ahead on a background thread, priorities are up to prefetch steps stale if priority_alpha > 0, default=0")
     parser.add_argument("--d_batch_size", type=int, default=200, help="training batch size, default=200")
     parser.add_argument("--a_batch_size", type=int, default=32, help="actor critic batch size")
     parser.add_argument("--rnn_len", type=int, default=15, help="recurrent steps for training, default=15")
@@ -64,6 +82,9 @@ def parse_args():
     parser.add_argument("--verbose", type=bool_, default=True)
     parser.add_argument("--save", type=bool_, default=True)
     arglist = parser.parse_args()
+    if arglist.init_obs and arglist.warm_start:
+        # warm start fits the obs model to its own state clusters
+        parser.error("--init_obs and --warm_start both initialize the obs model, set only one")
     return arglist
 
 def plot_history(df_history, plot_keys, plot_std=True):
@@ -160,9 +181,11 @@ def main(arglist):
     print(f"loaded {len(dataset)} episodes of demonstrations")
 
     # compute observation stats
-    obs = np.vstack([d["obs"] for d in dataset])
-    obs_mean = np.mean(obs, axis=0)
-    obs_var = np.var(obs, axis=0)
+    obs_stats = RunningStats()
+    for d in dataset:
+        obs_stats.update(np.stack(d["obs"]))
+    obs_mean = obs_stats.mean
+    obs_var = obs_stats.variance
     
     env = CustomMountainCar()
     obs_dim = env.observation_space.low.shape[0]
@@ -170,7 +193,9 @@ def main(arglist):
     
     agent = VINAgent(
         arglist.state_dim, act_dim, obs_dim, arglist.hmm_rank, 
-        arglist.horizon, arglist.alpha, arglist.epsilon, obs_cov=arglist.obs_cov
+        arglist.horizon, arglist.alpha, arglist.epsilon, obs_cov=arglist.obs_cov,
+        horizon_tol=arglist.horizon_tol, log_space=arglist.log_space,
+        belief_topk=arglist.belief_topk, belief_tol=arglist.belief_tol
     )
     # init batch norm stats
     agent.obs_model.init_batch_norm(
@@ -178,6 +203,18 @@ def main(arglist):
         torch.from_numpy(obs_var).to(torch.float32).to(agent.device)
     )
     
+    if arglist.init_obs:
+        make_batches = lambda: iter_obs_batches([d["obs"] for d in dataset])
+        init_obs_model(agent.obs_model, make_batches, em_steps=arglist.em_steps)
+        print("initialized obs model from data")
+    
+    if arglist.warm_start:
+        env_model = CustomMountainCar(x_bins=20, v_bins=20)
+        env_model.make_initial_distribution()
+        env_model.make_transition_matrix()
+        kl = warm_start_agent(agent, env_model)
+        print(f"warm started agent from env model, transition kl: {kl:.4f}")
+    
     if arglist.algo == "dac":
         model = DAC(
             agent, arglist.hidden_dim, arglist.num_hidden, arglist.activation,
@@ -188,7 +225,13 @@ def main(arglist):
             lr_d=arglist.lr_d, lr_a=arglist.lr_a, lr_c=arglist.lr_c, 
             decay=arglist.decay, grad_clip=arglist.grad_clip, 
             grad_penalty=arglist.grad_penalty, grad_target=arglist.grad_target,
-            bc_penalty=arglist.bc_penalty, obs_penalty=arglist.obs_penalty
+            bc_penalty=arglist.bc_penalty, obs_penalty=arglist.obs_penalty,
+            num_critics=arglist.num_critics, critic_reduce=arglist.critic_reduce,
+            buffer_state_dtype=arglist.buffer_state_dtype,
+            buffer_path=None if arglist.buffer_path == "none" else arglist.buffer_path,
+            demo_buffer_path=None if arglist.demo_buffer_path == "none" else arglist.demo_buffer_path,
+            priority_alpha=arglist.priority_alpha, priority_beta=arglist.priority_beta,
+            prefetch=arglist.prefetch, sample_seed=arglist.seed
         )
         plot_keys = ["eps_len_avg", "d_loss_avg", "critic_loss_avg", "actor_loss_avg", "bc_loss_avg", "obs_loss_avg"]
     
@@ -213,9 +256,16 @@ def main(arglist):
         callback = SaveCallback(arglist, plot_keys, cp_history=cp_history)
     
     model.fill_real_buffer(dataset)
+    
+    # skip burn-in if the replay buffer was reopened with enough samples
+    update_after = arglist.update_after
+    if update_after > 0 and model.replay_buffer.size >= update_after:
+        update_after = 0
+        print(f"reopened replay buffer with {model.replay_buffer.size} steps, skipping burn-in")
+
     model, logger = train(
         env, model, arglist.epochs, max_steps=arglist.max_steps, 
-        steps_per_epoch=arglist.steps_per_epoch, update_after=arglist.update_after, 
+        steps_per_epoch=arglist.steps_per_epoch, update_after=update_after, 
         update_every=arglist.update_every, verbose=arglist.verbose, callback=callback
     )
     
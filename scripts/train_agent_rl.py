@@ -31,9 +31,14 @@ def parse_args():
     parser.add_argument("--beta", type=float, default=0.2, help="softmax temperature, default=0.2")
     parser.add_argument("--polyak", type=float, default=0.995, help="polyak averaging factor, default=0.995")
     parser.add_argument("--norm_obs", type=bool_, default=False, help="whether to normalize observations for agent and algo, default=False")
+    parser.add_argument("--num_critics", type=int, default=2, help="number of ensemble critics, default=2")
+    parser.add_argument("--critic_reduce", type=str, choices=["min", "mean", "subset"], default="min", help="critic ensemble reduction, default=min")
     # training args
     parser.add_argument("--batch_size", type=int, default=100, help="training batch size, default=100")
     parser.add_argument("--buffer_size", type=int, default=1e5, help="agent replay buffer size, default=1e5")
+    parser.add_argument("--priority_alpha", type=float, default=0., help="critic replay td error priority exponent, uniform sampling if 0, default=0.")
+    parser.add_argument("--priority_beta", type=float, default=0.4, help="critic replay importance weight exponent, default=0.4")
+    parser.add_argument("--prefetch", type=int, default=0, help="number of training batches sampled ahead on a background thread, priorities are up to prefetch steps stale if priority_alpha > 0, default=0")
     parser.add_argument("--a_steps", type=int, default=10, help="actor critic steps, default=50")
     parser.add_argument("--lr_a", type=float, default=0.005, help="actor learning rate, default=0.001")
     parser.add_argument("--lr_c", type=float, default=0.001, help="critic learning rate, default=0.001")
@@ -91,7 +96,10 @@ def main(arglist):
         norm_obs=arglist.norm_obs, buffer_size=arglist.buffer_size,
         batch_size=arglist.batch_size, a_steps=arglist.a_steps, 
         lr_a=arglist.lr_a, lr_c=arglist.lr_c, 
-        decay=arglist.decay, grad_clip=arglist.grad_clip
+        decay=arglist.decay, grad_clip=arglist.grad_clip,
+        num_critics=arglist.num_critics, critic_reduce=arglist.critic_reduce,
+        priority_alpha=arglist.priority_alpha, priority_beta=arglist.priority_beta,
+        prefetch=arglist.prefetch, sample_seed=arglist.seed
     )
     print(model)
 
@@ -0,0 +1,137 @@
+import torch
+from src.agents.vin_agent import VINAgent
+
+def compute_state_occupancy(agent, loader):
+    """ Compute average belief occupancy of each state over a dataset
+
+    Args:
+        agent (VINAgent): trained agent
+        loader (iterable): batches of (pad_batch, mask) where pad_batch has keys ["obs", "act"]
+
+    Returns:
+        occupancy (torch.tensor): mean state belief over valid steps. size=[state_dim]
+    """
+    occupancy = torch.zeros(agent.state_dim).to(agent.device)
+    num_steps = 0
+    with torch.no_grad():
+        for pad_batch, mask in loader:
+            o = pad_batch["obs"].to(agent.device)
+            u = pad_batch["act"].to(agent.device)
+            mask = mask.to(agent.device)
+
+            [alpha_b, _], _ = agent(o, u)
+            occupancy += torch.sum(alpha_b * mask.unsqueeze(-1), dim=[0, 1])
+            num_steps += mask.sum()
+    return occupancy / num_steps
+
+def find_state_groups(agent, occupancy, min_occupancy=1e-3, merge_dist=0.):
+    """ Group states to be kept or merged. States with occupancy and initial belief
+    below min_occupancy are dropped. Remaining states are greedily merged into the
+    most occupied state whose emission mean is within merge_dist.
+
+    Args:
+        agent (VINAgent): trained agent
+        occupancy (torch.tensor): state occupancy. size=[state_dim]
+        min_occupancy (float, optional): min occupancy or initial belief to keep a state. Default=1e-3
+        merge_dist (float, optional): max euclidean distance between emission means
+            to merge states. No merging if merge_dist=0. Default=0.
+
+    Returns:
+        groups (list): list of original state index lists. The first index of
+            each group is the most occupied state
+    """
+    with torch.no_grad():
+        b0 = agent.rnn.init_hidden()[0]
+        mu = agent.obs_model.mu[0]
+        alive = (occupancy >= min_occupancy) | (b0 >= min_occupancy)
+
+    groups = []
+    for i in torch.argsort(occupancy, descending=True).tolist():
+        if not alive[i]:
+            continue
+        for group in groups:
+            if merge_dist > 0 and torch.dist(mu[group[0]], mu[i]) <= merge_dist:
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+    return groups
+
+def compact_agent(agent, groups, occupancy):
+    """ Build a full rank agent over merged states. Member states are weighted by
+    their occupancy. Transitions into dropped states are renormalized over kept states.
+
+    Args:
+        agent (VINAgent): trained agent
+        groups (list): list of original state index lists from find_state_groups
+        occupancy (torch.tensor): state occupancy. size=[state_dim]
+
+    Returns:
+        compact (VINAgent): compacted agent with state_dim=len(groups) and rank=0
+    """
+    rnn = agent.rnn
+    compact = VINAgent(
+        len(groups), agent.act_dim, agent.obs_dim, 0, agent.horizon,
+        agent.alpha, agent.epsilon, agent.obs_model.cov, rnn.horizon_tol,
+        rnn.log_space, min(rnn.belief_topk, len(groups)), rnn.belief_tol
+    ).to(agent.device)
+
+    # group membership weights. size=[state_dim, num_groups]
+    assign = torch.zeros(agent.state_dim, len(groups)).to(agent.device)
+    for g, group in enumerate(groups):
+        assign[group, g] = 1.
+    weight = assign * (occupancy.unsqueeze(-1) + 1e-6)
+    weight = weight / weight.sum(0, keepdim=True)
+
+    with torch.no_grad():
+        transition = rnn.compute_transition()[0] # size=[act_dim, state_dim, state_dim]
+        transition = torch.einsum("ig, kij, jh -> kgh", weight, transition, assign)
+        transition = transition / transition.sum(-1, keepdim=True)
+
+        b0 = rnn.init_hidden()[0].matmul(assign)
+        c = agent.compute_target_dist()[0].matmul(assign)
+        pi0 = agent.compute_pi0()[0].matmul(weight)
+
+        compact.rnn.w.data = torch.log(transition + 1e-6).unsqueeze(0)
+        compact.rnn.b0.data = torch.log(b0 / b0.sum() + 1e-6).unsqueeze(0)
+        compact.rnn.tau.data = rnn.tau.data.clone()
+        compact.c.data = torch.log(c / c.sum() + 1e-6).unsqueeze(0)
+        compact._pi0.data = torch.log(pi0 + 1e-6).unsqueeze(0)
+
+        # emission means are averaged and covariances taken from the most occupied member
+        obs_model = agent.obs_model
+        reps = [group[0] for group in groups]
+        compact.obs_model.mu.data = torch.einsum("ig, ix -> gx", weight, obs_model.mu[0]).unsqueeze(0)
+        if obs_model.cov == "tied":
+            compact.obs_model.lv.data = obs_model.lv.data.clone()
+        else:
+            compact.obs_model.lv.data = obs_model.lv.data[:, reps].clone()
+        if obs_model.cov == "full":
+            compact.obs_model.tl.data = obs_model.tl.data[:, reps].clone()
+        if obs_model.batch_norm:
+            compact.obs_model.bn.load_state_dict(obs_model.bn.state_dict())
+    return compact
+
+def compare_action_predictions(agent, compact, loader):
+    """ Max absolute action prediction difference between two agents over valid steps
+
+    Args:
+        agent (VINAgent): original agent
+        compact (VINAgent): compacted agent
+        loader (iterable): batches of (pad_batch, mask) where pad_batch has keys ["obs", "act"]
+
+    Returns:
+        max_err (float): max absolute action probability difference
+    """
+    max_err = 0.
+    with torch.no_grad():
+        for pad_batch, mask in loader:
+            o = pad_batch["obs"].to(agent.device)
+            u = pad_batch["act"].to(agent.device)
+            mask = mask.to(agent.device)
+            
+            [_, alpha_a], _ = agent(o, u)
+            [_, alpha_a_compact], _ = compact(o, u)
+            err = torch.abs(alpha_a - alpha_a_compact).max(-1)[0] * mask
+            max_err = max(max_err, err.max().item())
+    return max_err
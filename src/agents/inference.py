@@ -0,0 +1,249 @@
+import math
+import numpy as np
+import torch
+
+from typing import Optional
+from torch import Tensor
+
+class VINInferenceSession:
+    """ Frozen single step controller for a trained VINAgent.
+
+    All parameter derived tensors (transition, observation precision factors,
+    planning horizon weights, and value) are computed once at construction.
+    The session does not track parameter updates and should be recreated
+    after the agent is trained further.
+    """
+    def __init__(self, agent, obs_low=None, obs_high=None, grid_bins=0):
+        """
+        Args:
+            agent (VINAgent): trained agent
+            obs_low (array_like, optional): observation lower bounds for the 
+                likelihood grid. size=[obs_dim]. Default=None
+            obs_high (array_like, optional): observation upper bounds for the 
+                likelihood grid. size=[obs_dim]. Default=None
+            grid_bins (int, optional): number of likelihood grid points per observation 
+                dimension. Exact likelihood is used if grid_bins=0. Default=0
+        """
+        self.state_dim = agent.state_dim
+        self.act_dim = agent.act_dim
+        self.obs_dim = agent.obs_dim
+        self.eps = agent.rnn.eps
+
+        with torch.no_grad():
+            cache = agent.compute_planning_tensors()
+            self.transition = cache["transition"][0] # size=[act_dim, state_dim, state_dim]
+            self.value = cache["value"][:, 0] # size=[num_steps, act_dim, state_dim]
+            self.tau = agent.rnn.compute_horizon_dist(len(self.value))[0] # size=[num_steps]
+
+            # first step prior under uniform action
+            self.b0 = agent.rnn.init_hidden()[0] # size=[state_dim]
+            s0 = torch.einsum("kij, i -> j", self.transition, self.b0) / self.act_dim
+            self.log_s0 = torch.log(s0 + self.eps)
+
+            # base gaussian precision factors
+            obs_model = agent.obs_model
+            mu = obs_model.mu.data[0]
+            L = obs_model.scale_tril()[0].expand(self.state_dim, -1, -1)
+            eye = torch.eye(self.obs_dim).to(L.device).expand_as(L)
+            L_inv = torch.linalg.solve_triangular(L, eye, upper=False)
+            c = -0.5 * obs_model.logdet()[0].expand(self.state_dim)
+            c = c - 0.5 * self.obs_dim * math.log(2 * math.pi)
+
+            self.mu = mu # size=[state_dim, obs_dim]
+            self.L_inv = L_inv # size=[state_dim, obs_dim, obs_dim]
+            self.log_norm = c # size=[state_dim]
+            
+            # batch norm stats. identity transform if batch norm is not used
+            self.bn_mean = torch.zeros(self.obs_dim).to(L.device)
+            self.bn_variance = torch.ones(self.obs_dim).to(L.device)
+            self.bn_gamma = torch.ones(self.obs_dim).to(L.device)
+            self.bn_beta = torch.zeros(self.obs_dim).to(L.device)
+            self.bn_epsilon = 0.
+            if obs_model.batch_norm:
+                bn = obs_model.bn
+                self.bn_mean = bn.moving_mean.data.clone()
+                self.bn_variance = bn.moving_variance.data.clone()
+                self.bn_gamma = bn.constrained_gamma
+                self.bn_beta = bn.beta.data.clone()
+                self.bn_epsilon = bn.epsilon
+
+            # fold batch norm into observation whitening:
+            # log p(o|s) = c[s] - 0.5 * ||W[s] o + w[s]||^2
+            scale = self.bn_gamma / torch.sqrt(self.bn_variance + self.bn_epsilon)
+            shift = self.bn_beta - self.bn_mean * scale
+            c = c + torch.log(scale).sum()
+
+            self.W = L_inv * scale # size=[state_dim, obs_dim, obs_dim]
+            self.w = torch.einsum("sij, sj -> si", L_inv, shift - mu) # size=[state_dim, obs_dim]
+            self.c = c # size=[state_dim]
+        
+        self.obs_grid = None
+        if grid_bins > 0:
+            self.obs_grid = ObsLikelihoodGrid(
+                self.obs_log_prob, obs_low, obs_high, grid_bins, device=self.c.device
+            )
+        self.reset()
+
+    def __repr__(self):
+        s = "{}(state_dim={}, act_dim={}, obs_dim={}, horizon={})".format(
+            self.__class__.__name__, self.state_dim, self.act_dim,
+            self.obs_dim, len(self.tau)
+        )
+        return s
+
+    def export(self, path):
+        """ Export frozen tensors to a .npz file for NumpyVINPolicy 
+        
+        Args:
+            path (str): save path
+        """
+        np.savez(
+            path,
+            transition=self.transition.cpu().numpy(),
+            value=self.value.cpu().numpy(),
+            tau=self.tau.cpu().numpy(),
+            b0=self.b0.cpu().numpy(),
+            mu=self.mu.cpu().numpy(),
+            L_inv=self.L_inv.cpu().numpy(),
+            log_norm=self.log_norm.cpu().numpy(),
+            bn_mean=self.bn_mean.cpu().numpy(),
+            bn_variance=self.bn_variance.cpu().numpy(),
+            bn_gamma=self.bn_gamma.cpu().numpy(),
+            bn_beta=self.bn_beta.cpu().numpy(),
+            bn_epsilon=np.array(self.bn_epsilon),
+            eps=np.array(self.eps),
+        )
+
+    def reset(self):
+        """ Reset belief and previous control """
+        self.b = None # size=[batch_size, state_dim]
+        self.pi = None # size=[batch_size, act_dim]
+        self.prev_ctl = None # size=[batch_size]
+
+    def obs_log_prob(self, o: Tensor) -> Tensor:
+        """ Observation log likelihood
+
+        Args:
+            o (torch.tensor): observation. size=[batch_size, obs_dim]
+
+        Returns:
+            logp_o (torch.tensor): log likelihood. size=[batch_size, state_dim]
+        """
+        m = torch.einsum("sij, nj -> nsi", self.W, o) + self.w
+        return self.c - 0.5 * m.pow(2).sum(-1)
+
+    def step(self, o: Tensor, reset_mask: Optional[Tensor]=None) -> Tensor:
+        """ Update belief and sample control for a single time step. 
+        Each batch element is tracked as an independent belief stream.
+
+        Args:
+            o (torch.tensor): observation. size=[batch_size, obs_dim]
+            reset_mask (torch.tensor, optional): binary mask of streams to restart 
+                from the initial belief before this step. size=[batch_size]. Default=None
+
+        Returns:
+            u (torch.tensor): sampled control. size=[batch_size]
+        """
+        with torch.no_grad():
+            if self.obs_grid is None:
+                logp_o = self.obs_log_prob(o)
+            else:
+                logp_o = self.obs_grid.log_prob(o)
+            if self.b is None:
+                log_s = self.log_s0
+            else:
+                s = torch.bmm(self.b.unsqueeze(-2), self.transition[self.prev_ctl]).squeeze(-2)
+                log_s = torch.log(s + self.eps)
+                if reset_mask is not None:
+                    reset_mask = reset_mask.view(-1, 1).to(torch.bool)
+                    log_s = torch.where(reset_mask, self.log_s0, log_s)
+            b = torch.softmax(log_s + logp_o, dim=-1)
+
+            q = torch.einsum("ni, hki -> nhk", b, self.value)
+            pi = torch.einsum("nhk, h -> nk", torch.softmax(q, dim=-1), self.tau)
+            u = torch.multinomial(pi, 1).squeeze(-1)
+
+        self.b, self.pi, self.prev_ctl = b, pi, u
+        return u
+
+
+class ObsLikelihoodGrid:
+    """ Precomputed observation log likelihood table over a bounded box.
+
+    Log likelihoods are evaluated once on a regular grid and looked up with 
+    multilinear interpolation. Observations outside the bounds are clamped to 
+    the boundary. The interpolation error is measured against the exact log 
+    likelihood at construction and stored in max_error and mean_error.
+    """
+    def __init__(self, log_prob_fn, low, high, num_bins, num_check=10000, seed=0, device="cpu"):
+        """
+        Args:
+            log_prob_fn (callable): exact log likelihood function mapping 
+                observations of size=[batch_size, obs_dim] to size=[batch_size, state_dim]
+            low (array_like): observation lower bounds. size=[obs_dim]
+            high (array_like): observation upper bounds. size=[obs_dim]
+            num_bins (int): number of grid points per observation dimension
+            num_check (int, optional): number of random cell centers and uniform 
+                points used to measure interpolation error. Default=10000
+            seed (int, optional): error check random seed. Default=0
+            device (str, optional): table device. Default="cpu"
+        """
+        assert num_bins >= 2
+        self.low = torch.as_tensor(np.asarray(low), dtype=torch.float32).to(device)
+        self.high = torch.as_tensor(np.asarray(high), dtype=torch.float32).to(device)
+        self.obs_dim = len(self.low)
+        self.num_bins = num_bins
+        
+        axes = [torch.linspace(l, h, num_bins).to(device) for l, h in zip(self.low.tolist(), self.high.tolist())]
+        points = torch.cartesian_prod(*axes).view(-1, self.obs_dim)
+        with torch.no_grad():
+            self.table = torch.cat([log_prob_fn(p) for p in points.split(10000)], dim=0) # size=[num_points, state_dim]
+        self.state_dim = self.table.shape[-1]
+
+        # flat index strides and cell corner offsets
+        self.strides = (num_bins ** torch.arange(self.obs_dim - 1, -1, -1)).to(device)
+        corners = torch.cartesian_prod(*[torch.arange(2)] * self.obs_dim).view(-1, self.obs_dim).to(device)
+        self.corners = corners.to(torch.bool)
+        self.offsets = corners.matmul(self.strides)
+        
+        self.max_error, self.mean_error = self.compute_error(log_prob_fn, num_check, seed)
+
+    def __repr__(self):
+        s = "{}(obs_dim={}, state_dim={}, num_bins={}, max_error={:.2e})".format(
+            self.__class__.__name__, self.obs_dim, self.state_dim, 
+            self.num_bins, self.max_error
+        )
+        return s
+
+    def log_prob(self, o: Tensor) -> Tensor:
+        """ Interpolated observation log likelihood
+
+        Args:
+            o (torch.tensor): observation. size=[batch_size, obs_dim]
+
+        Returns:
+            logp_o (torch.tensor): log likelihood. size=[batch_size, state_dim]
+        """
+        x = (o - self.low) / (self.high - self.low) * (self.num_bins - 1)
+        x = x.clip(0, self.num_bins - 1)
+        i0 = x.floor().clip(max=self.num_bins - 2)
+        f = (x - i0).unsqueeze(-2)
+        
+        idx = (i0.long().matmul(self.strides).unsqueeze(-1) + self.offsets) # size=[batch_size, 2^obs_dim]
+        w = torch.where(self.corners, f, 1 - f).prod(-1) # size=[batch_size, 2^obs_dim]
+        return torch.bmm(w.unsqueeze(-2), self.table[idx]).squeeze(-2)
+
+    def compute_error(self, log_prob_fn, num_check=10000, seed=0):
+        """ Max and mean absolute log likelihood interpolation error at random 
+        cell centers, where multilinear interpolation error peaks, and uniform points """
+        gen = torch.Generator().manual_seed(seed)
+        d = (self.high - self.low) / (self.num_bins - 1)
+        cells = torch.randint(0, self.num_bins - 1, (num_check, self.obs_dim), generator=gen)
+        centers = self.low + (cells.to(d.device) + 0.5) * d
+        uniform = torch.rand(num_check, self.obs_dim, generator=gen).to(d.device)
+        uniform = self.low + uniform * (self.high - self.low)
+        
+        o = torch.cat([centers, uniform], dim=0)
+        with torch.no_grad():
+            err = torch.abs(self.log_prob(o) - log_prob_fn(o))
+        return err.max().item(), err.mean().item()
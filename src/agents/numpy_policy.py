@@ -0,0 +1,100 @@
+import numpy as np
+
+class NumpyVINPolicy:
+    """ Dependency free VINAgent policy runtime.
+
+    Loads the frozen tensors written by VINInferenceSession.export and reproduces
+    VINAgent.choose_action with numpy only.
+    """
+    def __init__(self, path, seed=None):
+        """
+        Args:
+            path (str): path to exported .npz file
+            seed (int, optional): action sampling seed. Default=None
+        """
+        params = np.load(path)
+        self.transition = params["transition"] # size=[act_dim, state_dim, state_dim]
+        self.value = params["value"] # size=[num_steps, act_dim, state_dim]
+        self.tau = params["tau"] # size=[num_steps]
+        self.eps = float(params["eps"])
+        self.act_dim, self.state_dim = self.transition.shape[:2]
+        self.obs_dim = params["mu"].shape[-1]
+
+        # first step prior under uniform action
+        s0 = params["b0"].dot(self.transition.mean(0))
+        self.log_s0 = np.log(s0 + self.eps)
+
+        # fold batch norm into observation whitening
+        scale = params["bn_gamma"] / np.sqrt(params["bn_variance"] + params["bn_epsilon"])
+        shift = params["bn_beta"] - params["bn_mean"] * scale
+        L_inv = params["L_inv"]
+        self.W = L_inv * scale # size=[state_dim, obs_dim, obs_dim]
+        self.w = np.einsum("sij, sj -> si", L_inv, shift - params["mu"]) # size=[state_dim, obs_dim]
+        self.c = params["log_norm"] + np.log(scale).sum() # size=[state_dim]
+
+        self.rng = np.random.RandomState(seed)
+        self.reset()
+
+    def __repr__(self):
+        s = "{}(state_dim={}, act_dim={}, obs_dim={}, horizon={})".format(
+            self.__class__.__name__, self.state_dim, self.act_dim,
+            self.obs_dim, len(self.tau)
+        )
+        return s
+
+    def reset(self):
+        """ Reset belief and previous control """
+        self.b = None # size=[batch_size, state_dim]
+        self.pi = None # size=[batch_size, act_dim]
+        self.prev_ctl = None # size=[batch_size]
+
+    def obs_log_prob(self, o):
+        """ Observation log likelihood
+
+        Args:
+            o (np.array): observation. size=[batch_size, obs_dim]
+
+        Returns:
+            logp_o (np.array): log likelihood. size=[batch_size, state_dim]
+        """
+        m = np.einsum("sij, nj -> nsi", self.W, o) + self.w
+        return self.c - 0.5 * np.sum(m ** 2, axis=-1)
+
+    def step(self, o, reset_mask=None):
+        """ Update belief and sample control for a single time step
+
+        Args:
+            o (np.array): observation. size=[batch_size, obs_dim]
+            reset_mask (np.array, optional): binary mask of streams to restart
+                from the initial belief before this step. size=[batch_size]. Default=None
+
+        Returns:
+            u (np.array): sampled control. size=[batch_size]
+        """
+        o = np.atleast_2d(o)
+        logp_o = self.obs_log_prob(o)
+        if self.b is None:
+            log_s = self.log_s0 * np.ones((len(o), 1))
+        else:
+            s = np.einsum("ni, nij -> nj", self.b, self.transition[self.prev_ctl])
+            log_s = np.log(s + self.eps)
+            if reset_mask is not None:
+                reset_mask = np.asarray(reset_mask).reshape(-1, 1).astype(bool)
+                log_s = np.where(reset_mask, self.log_s0, log_s)
+        b = softmax(log_s + logp_o)
+
+        q = np.einsum("ni, hki -> nhk", b, self.value)
+        pi = np.einsum("nhk, h -> nk", softmax(q), self.tau)
+
+        cdf = np.cumsum(pi, axis=-1)
+        z = self.rng.uniform(size=(len(o), 1)) * cdf[:, -1:]
+        u = np.minimum(np.sum(cdf < z, axis=-1), self.act_dim - 1)
+
+        self.b, self.pi, self.prev_ctl = b, pi, u
+        return u
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=axis, keepdims=True)
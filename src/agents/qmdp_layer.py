@@ -3,17 +3,45 @@ import torch
 import torch.nn as nn
 import torch.jit as jit
 
-from typing import Union, Tuple
+from typing import Tuple, List, Optional
 from torch import Tensor
 
 class QMDPLayer(nn.Module):
-    def __init__(self, state_dim, act_dim, rank, horizon):
+    def __init__(
+        self, state_dim, act_dim, rank, horizon, horizon_tol=0., log_space=False, 
+        belief_topk=0, belief_tol=0.
+        ):
+        """
+        Args:
+            state_dim (int): state dimension
+            act_dim (int): action dimension
+            rank (int): transition tensor rank. full rank if rank=0
+            horizon (int): max planning horizon
+            horizon_tol (float, optional): truncate value iteration once the remaining 
+                planning horizon probability mass drops below tolerance. 
+                No truncation if horizon_tol=0. Default=0.
+            log_space (bool, optional): propagate log beliefs with logsumexp over log 
+                transitions instead of normalizing probabilities. Default=False
+            belief_topk (int, optional): approximate belief updates by propagating only 
+                the top k belief states. Dense if belief_topk=0. Default=0
+            belief_tol (float, optional): approximate belief updates by propagating only 
+                the most likely states covering 1 - belief_tol belief mass. 
+                Dense if belief_tol=0. Default=0.
+        """
         super().__init__()
         self.state_dim = state_dim
         self.act_dim = act_dim
         self.rank = rank
         self.horizon = horizon
+        self.horizon_tol = horizon_tol
+        self.log_space = log_space
+        self.belief_topk = belief_topk
+        self.belief_tol = belief_tol
+        self.sparse = belief_topk > 0 or belief_tol > 0
         self.eps = 1e-6
+        
+        # belief mass discarded by the last sparse update or forward pass
+        self.discarded_mass = torch.zeros(0)
 
         self.b0 = nn.Parameter(torch.randn(1, state_dim))
         self.tau = nn.Parameter(torch.randn(1, 1))
@@ -34,19 +62,34 @@ class QMDPLayer(nn.Module):
         nn.init.xavier_normal_(self.w, gain=1.)
     
     def __repr__(self):
-        s = "{}(state_dim={}, act_dim={}, rank={}, horizon={})".format(
-            self.__class__.__name__, self.state_dim, self.act_dim, self.rank, self.horizon
+        s = "{}(state_dim={}, act_dim={}, rank={}, horizon={}, horizon_tol={}, log_space={}".format(
+            self.__class__.__name__, self.state_dim, self.act_dim, self.rank, 
+            self.horizon, self.horizon_tol, self.log_space
         )
+        if self.sparse:
+            s += ", belief_topk={}, belief_tol={}".format(self.belief_topk, self.belief_tol)
+        s += ")"
         return s
     
-    def compute_transition(self):
-        """ Return transition matrix. size=[1, act_dim, state_dim, state_dim] """
+    def compute_transition_logits(self) -> Tensor:
+        """ Return unnormalized transition logits. size=[1, act_dim, state_dim, state_dim] """
         if self.rank != 0:
-            w = torch.einsum("nri, nrj, nrk -> nkij", self.u, self.v, self.w)
+            w = torch.einsum("nri, nrj, nrk -> nkij", [self.u, self.v, self.w])
         else:
             w = self.w
-        return torch.softmax(w, dim=-1)
+        return w
+
+    @jit.export
+    def compute_transition(self) -> Tensor:
+        """ Return transition matrix. size=[1, act_dim, state_dim, state_dim] """
+        return torch.softmax(self.compute_transition_logits(), dim=-1)
     
+    @jit.export
+    def compute_log_transition(self) -> Tensor:
+        """ Return log transition matrix. size=[1, act_dim, state_dim, state_dim] """
+        return torch.log_softmax(self.compute_transition_logits(), dim=-1)
+    
+    @jit.export
     def compute_value(self, transition: Tensor, reward: Tensor) -> Tensor:
         """ Compute expected value using value iteration
 
@@ -55,91 +98,416 @@ class QMDPLayer(nn.Module):
             reward (torch.tensor): reward matrix. size=[batch_size, act_dim, state_dim]
         
         Returns:
-            q (torch.tensor): state q value. size=[horizon, batch_size, act_dim, state_dim]
+            q (torch.tensor): state q value. size=[num_steps, batch_size, act_dim, state_dim]
         """        
-        q = [torch.empty(0)] * (self.horizon)
-        q[0] = reward
-        for t in range(self.horizon - 1):
+        num_steps = self.compute_num_steps()
+        q: List[Tensor] = [reward]
+        for t in range(num_steps - 1):
             v_next = torch.logsumexp(q[t], dim=-2, keepdim=True)
-            q[t+1] = reward + torch.einsum("nkij, nkj -> nki", transition, v_next)
+            q.append(reward + torch.einsum("nkij, nkj -> nki", [transition, v_next]))
         return torch.stack(q)
     
+    @jit.export
+    def compute_horizon_dist(self, num_steps: Optional[int]=None) -> Tensor:
+        """ Return truncated poisson planning horizon distribution
+        
+        Args:
+            num_steps (int, optional): number of leading steps to keep and renormalize. 
+                Default=None keeps all horizon steps
+        
+        Returns:
+            tau (torch.tensor): horizon distribution. size=[1, num_steps]
+        """
+        tau = torch.exp(self.tau.clip(math.log(1e-6), math.log(1e3)))
+        tau = poisson_pdf(tau, self.horizon)
+        if num_steps is not None and num_steps < self.horizon:
+            tau = tau[:, :num_steps]
+            tau = tau / tau.sum(-1, keepdim=True)
+        return tau
+    
+    @jit.export
+    def compute_log_horizon_dist(self, num_steps: Optional[int]=None) -> Tensor:
+        """ Return truncated poisson planning horizon log distribution. size=[1, num_steps] """
+        tau = torch.exp(self.tau.clip(math.log(1e-6), math.log(1e3)))
+        log_tau = poisson_log_pdf(tau, self.horizon)
+        if num_steps is not None and num_steps < self.horizon:
+            log_tau = log_tau[:, :num_steps]
+            log_tau = log_tau - torch.logsumexp(log_tau, dim=-1, keepdim=True)
+        return log_tau
+    
+    @jit.export
+    def compute_num_steps(self) -> int:
+        """ Return the number of value iteration steps needed for the poisson 
+        tail mass to drop below horizon_tol """
+        if self.horizon_tol <= 0:
+            return self.horizon
+        cdf = torch.cumsum(self.compute_horizon_dist(None).detach(), dim=-1)
+        num_steps = int(torch.sum(cdf[0] < 1 - self.horizon_tol)) + 1
+        return min(num_steps, self.horizon)
+    
+    @jit.export
     def plan(self, b: Tensor, value: Tensor) -> Tensor:
         """ Compute the belief action distribution 
         
         Args:
             b (torch.tensor): current belief. size=[batch_size, state_dim]
-            value (torch.tensor): state q value. size=[horizon, batch_size, act_dim, state_dim]
+            value (torch.tensor): state q value. size=[num_steps, batch_size, act_dim, state_dim]
 
         Returns:
             pi (torch.tensor): policy distribution. size=[batch_size, act_dim]
         """
-        tau = torch.exp(self.tau.clip(math.log(1e-6), math.log(1e3)))
-        tau = poisson_pdf(tau, self.horizon)
+        tau = self.compute_horizon_dist(value.shape[0])
         if tau.shape[0] != b.shape[-2]:
             tau = torch.repeat_interleave(tau, b.shape[-2], 0)
         
-        pi = torch.softmax(torch.einsum("...ni, h...nki -> h...nk", b, value), dim=-1)
-        pi = torch.einsum("h...nk, nh -> ...nk", pi, tau)
+        pi = torch.softmax(torch.einsum("...ni, h...nki -> h...nk", [b, value]), dim=-1)
+        pi = torch.einsum("h...nk, nh -> ...nk", [pi, tau])
         return pi
     
+    @jit.export
+    def plan_log(self, b: Tensor, value: Tensor) -> Tensor:
+        """ Compute the belief action log distribution 
+        
+        Args:
+            b (torch.tensor): current belief. size=[batch_size, state_dim]
+            value (torch.tensor): state q value. size=[num_steps, batch_size, act_dim, state_dim]
+
+        Returns:
+            log_pi (torch.tensor): policy log distribution. size=[batch_size, act_dim]
+        """
+        log_tau = self.compute_log_horizon_dist(value.shape[0])
+        if log_tau.shape[0] != b.shape[-2]:
+            log_tau = torch.repeat_interleave(log_tau, b.shape[-2], 0)
+        
+        log_pi = torch.log_softmax(
+            torch.einsum("...ni, h...nki -> h...nk", [b, value]), dim=-1
+        )
+        # align horizon weights to size=[num_steps, ..., batch_size, 1]
+        tau_shape = [log_tau.shape[1]] + [1] * (log_pi.dim() - 3) + [log_tau.shape[0], 1]
+        log_pi = torch.logsumexp(log_pi + log_tau.t().reshape(tau_shape), dim=0)
+        return log_pi
+    
+    @jit.export
     def update_belief(self, logp_o: Tensor, a: Tensor, b: Tensor, transition: Tensor) -> Tensor:
         """ Compute state posterior
         
         Args:
             logp_o (torch.tensor): log probability of current observation. size=[batch_size, state_dim]
-            a (torch.tensor): action posterior. size=[batch_size, act_dim]
+            a (torch.tensor): action posterior size=[batch_size, act_dim] 
+                or action index size=[batch_size]
             b (torch.tensor): prior belief. size=[batch_size, state_dim]
             transition (torch.tensor): transition matrix. size=[batch_size, act_dim, state_dim, state_dim]
 
         Returns:
             b_post (torch.tensor): state posterior. size=[batch_size, state_dim]
         """
-        s_next = torch.einsum("nkij, ni, nk -> nj", transition, b, a)
+        s_next = self.propagate_belief(b, a, transition)
         logp_s = torch.log(s_next + self.eps)
         b_post = torch.softmax(logp_s + logp_o, dim=-1)
         return b_post
     
+    @jit.export
+    def update_log_belief(
+        self, logp_o: Tensor, a: Tensor, log_b: Tensor, log_transition: Tensor
+        ) -> Tensor:
+        """ Compute log state posterior
+        
+        Args:
+            logp_o (torch.tensor): log probability of current observation. size=[batch_size, state_dim]
+            a (torch.tensor): action posterior size=[batch_size, act_dim] 
+                or action index size=[batch_size]
+            log_b (torch.tensor): log prior belief. size=[batch_size, state_dim]
+            log_transition (torch.tensor): log transition matrix. 
+                size=[batch_size, act_dim, state_dim, state_dim]
+
+        Returns:
+            log_b_post (torch.tensor): log state posterior. size=[batch_size, state_dim]
+        """
+        logp_s = self.propagate_log_belief(log_b, a, log_transition)
+        log_b_post = torch.log_softmax(logp_s + logp_o, dim=-1)
+        return log_b_post
+    
+    def propagate_belief(self, b: Tensor, a: Tensor, transition: Tensor) -> Tensor:
+        """ One step prediction used by belief updates. Sparse if belief_topk or belief_tol is set """
+        if not self.sparse:
+            return self.predict_one_step(b, a, transition)
+        if b.shape[0] != a.shape[0]:
+            b = b.expand(a.shape[0], -1) # shared initial belief
+        b_val, b_idx, discarded = self.sparsify_belief(b)
+        self.discarded_mass = discarded.detach()
+        return self.predict_one_step_sparse(b_val, b_idx, a, transition)
+    
+    def propagate_log_belief(self, log_b: Tensor, a: Tensor, log_transition: Tensor) -> Tensor:
+        """ Log space propagate_belief """
+        if not self.sparse:
+            return self.predict_one_step_log(log_b, a, log_transition)
+        if log_b.shape[0] != a.shape[0]:
+            log_b = log_b.expand(a.shape[0], -1) # shared initial belief
+        log_val, b_idx, discarded = self.sparsify_log_belief(log_b)
+        self.discarded_mass = discarded.detach()
+        return self.predict_one_step_sparse_log(log_val, b_idx, a, log_transition)
+    
+    @jit.export
+    def sparsify_belief(self, b: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """ Truncate belief support to the top k states or the states covering 
+        1 - belief_tol mass. Kept values are rescaled to preserve total belief mass.
+
+        Args:
+            b (torch.tensor): belief. size=[batch_size, state_dim]
+
+        Returns:
+            b_val (torch.tensor): kept belief values. size=[batch_size, k]
+            b_idx (torch.tensor): kept state indices. size=[batch_size, k]
+            discarded (torch.tensor): fraction of belief mass discarded. size=[batch_size]
+        """
+        k = self.state_dim
+        if self.belief_topk > 0:
+            k = min(self.belief_topk, self.state_dim)
+        b_val, b_idx = torch.topk(b, k, dim=-1)
+        total = b.sum(-1, keepdim=True)
+        
+        if self.belief_tol > 0:
+            # keep states whose preceding cumulative mass is below 1 - tol
+            preceding = (torch.cumsum(b_val, dim=-1) - b_val) / total
+            keep = preceding < 1 - self.belief_tol
+            k_max = int(keep.sum(-1).max())
+            b_idx = b_idx[:, :k_max]
+            b_val = b_val[:, :k_max] * keep[:, :k_max].to(b_val.dtype)
+        
+        kept = b_val.sum(-1, keepdim=True)
+        discarded = 1 - kept / total
+        b_val = b_val * total / kept
+        return b_val, b_idx, discarded.squeeze(-1)
+    
+    @jit.export
+    def sparsify_log_belief(self, log_b: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """ Log space sparsify_belief. Dropped states within the kept support 
+        have log belief -inf.
+
+        Args:
+            log_b (torch.tensor): log belief. size=[batch_size, state_dim]
+
+        Returns:
+            log_val (torch.tensor): kept log belief values. size=[batch_size, k]
+            b_idx (torch.tensor): kept state indices. size=[batch_size, k]
+            discarded (torch.tensor): fraction of belief mass discarded. size=[batch_size]
+        """
+        k = self.state_dim
+        if self.belief_topk > 0:
+            k = min(self.belief_topk, self.state_dim)
+        log_val, b_idx = torch.topk(log_b, k, dim=-1)
+        log_total = torch.logsumexp(log_b, dim=-1, keepdim=True)
+        
+        if self.belief_tol > 0:
+            # keep states whose preceding cumulative mass is below 1 - tol
+            log_cum = torch.logcumsumexp(log_val, dim=-1)
+            log_preceding = torch.cat([
+                torch.full_like(log_cum[:, :1], -math.inf), log_cum[:, :-1]
+            ], dim=-1) - log_total
+            keep = log_preceding < math.log1p(-self.belief_tol)
+            k_max = int(keep.sum(-1).max())
+            b_idx = b_idx[:, :k_max]
+            log_val = log_val[:, :k_max].masked_fill(~keep[:, :k_max], -math.inf)
+        
+        log_kept = torch.logsumexp(log_val, dim=-1, keepdim=True)
+        discarded = -torch.expm1(log_kept - log_total)
+        log_val = log_val - log_kept + log_total
+        return log_val, b_idx, discarded.squeeze(-1)
+    
+    @jit.export
+    def predict_one_step_sparse(
+        self, b_val: Tensor, b_idx: Tensor, u: Tensor, transition: Tensor
+        ) -> Tensor:
+        """ One step state prediction from a sparse belief. Only the transition 
+        rows of kept states are read.
+
+        Args:
+            b_val (torch.tensor): belief values. size=[batch_size, k]
+            b_idx (torch.tensor): belief state indices. size=[batch_size, k]
+            u (torch.tensor): action distribution size=[batch_size, act_dim]
+                or action index size=[batch_size]
+            transition (torch.tensor): transition matrix. size=[1, act_dim, state_dim, state_dim]
+
+        Returns:
+            s_next (torch.tensor): predicted state distribution. size=[batch_size, state_dim]
+        """
+        if not torch.is_floating_point(u):
+            rows = transition[0][u.unsqueeze(-1), b_idx] # size=[batch_size, k, state_dim]
+            s_next = torch.einsum("nk, nkj -> nj", [b_val, rows])
+        else:
+            rows = transition[0][:, b_idx] # size=[act_dim, batch_size, k, state_dim]
+            s_next = torch.einsum("nk, ankj, na -> nj", [b_val, rows, u])
+        return s_next
+    
+    @jit.export
+    def predict_one_step_sparse_log(
+        self, log_val: Tensor, b_idx: Tensor, u: Tensor, log_transition: Tensor
+        ) -> Tensor:
+        """ Log space predict_one_step_sparse
+
+        Args:
+            log_val (torch.tensor): log belief values. size=[batch_size, k]
+            b_idx (torch.tensor): belief state indices. size=[batch_size, k]
+            u (torch.tensor): action distribution size=[batch_size, act_dim]
+                or action index size=[batch_size]
+            log_transition (torch.tensor): log transition matrix. size=[1, act_dim, state_dim, state_dim]
+
+        Returns:
+            logp_s (torch.tensor): predicted log state distribution. size=[batch_size, state_dim]
+        """
+        if not torch.is_floating_point(u):
+            rows = log_transition[0][u.unsqueeze(-1), b_idx] # size=[batch_size, k, state_dim]
+            logp_s = torch.logsumexp(log_val.unsqueeze(-1) + rows, dim=-2)
+        else:
+            rows = log_transition[0][:, b_idx] # size=[act_dim, batch_size, k, state_dim]
+            log_u = torch.log(u).t().unsqueeze(-1).unsqueeze(-1)
+            logp_s = torch.logsumexp(log_val.unsqueeze(-1) + rows + log_u, dim=[0, 2])
+        return logp_s
+    
+    @jit.export
     def init_hidden(self) -> Tensor:
         b0 = torch.softmax(self.b0, dim=-1)
         return b0
     
-    def predict_one_step(self, b, u):
-        transition = self.compute_transition()
-        s_next = torch.einsum("...kij, ...i, ...k -> ...j", transition, b, u)
+    @jit.export
+    def init_log_hidden(self) -> Tensor:
+        log_b0 = torch.log_softmax(self.b0, dim=-1)
+        return log_b0
+    
+    def select_transition(self, transition: Tensor, u: Tensor) -> Tensor:
+        """ Gather transition matrices of hard actions 
+        
+        Args:
+            transition (torch.tensor): transition matrix. size=[1, act_dim, state_dim, state_dim]
+                or size=[batch_size, act_dim, state_dim, state_dim] if u is 1 dimensional
+            u (torch.tensor): action index. size=[..., batch_size]
+
+        Returns:
+            transition_u (torch.tensor): selected transition. size=[..., batch_size, state_dim, state_dim]
+        """
+        if transition.shape[0] == 1:
+            return transition[0][u]
+        return transition[torch.arange(u.shape[0], device=u.device), u]
+
+    @jit.export
+    def predict_one_step(self, b: Tensor, u: Tensor, transition: Optional[Tensor]=None) -> Tensor:
+        """ One step state prediction. Hard actions given as integer indices select 
+        a single transition slice instead of contracting over all actions.
+
+        Args:
+            b (torch.tensor): belief. size=[..., batch_size, state_dim]
+            u (torch.tensor): action distribution size=[..., batch_size, act_dim]
+                or action index size=[..., batch_size]
+            transition ([torch.tensor, None], optional): transition matrix. 
+                size=[1, act_dim, state_dim, state_dim]
+
+        Returns:
+            s_next (torch.tensor): predicted state distribution. size=[..., batch_size, state_dim]
+        """
+        if transition is None:
+            transition = self.compute_transition()
+        if not torch.is_floating_point(u):
+            transition_u = self.select_transition(transition, u)
+            s_next = torch.matmul(b.unsqueeze(-2), transition_u).squeeze(-2)
+        else:
+            s_next = torch.einsum("...kij, ...i, ...k -> ...j", [transition, b, u])
         return s_next
+    
+    @jit.export
+    def predict_one_step_log(
+        self, log_b: Tensor, u: Tensor, log_transition: Optional[Tensor]=None
+        ) -> Tensor:
+        """ One step log state prediction. Beliefs are contracted with the 
+        transition using max shifted logsumexp, so unlikely states do not underflow.
+
+        Args:
+            log_b (torch.tensor): log belief. size=[..., batch_size, state_dim]
+            u (torch.tensor): action distribution size=[..., batch_size, act_dim]
+                or action index size=[..., batch_size]
+            log_transition ([torch.tensor, None], optional): log transition matrix. 
+                size=[1, act_dim, state_dim, state_dim]
+
+        Returns:
+            logp_s (torch.tensor): predicted log state distribution. size=[..., batch_size, state_dim]
+        """
+        if log_transition is None:
+            log_transition = self.compute_log_transition()
+        if not torch.is_floating_point(u):
+            log_transition_u = self.select_transition(log_transition, u)
+            logp_s = torch.logsumexp(log_b.unsqueeze(-1) + log_transition_u, dim=-2)
+        else:
+            log_u = torch.log(u).unsqueeze(-1).unsqueeze(-1)
+            logp_s = torch.logsumexp(
+                log_b.unsqueeze(-2).unsqueeze(-1) + log_u + log_transition, dim=[-3, -2]
+            )
+        return logp_s
 
     def forward(
-        self, logp_o: Tensor, u: Union[Tensor, None], value: Tensor,
-        b: Union[Tensor, None]
-        ) -> Tuple[Tensor, Tensor]:
+        self, logp_o: Tensor, u: Tensor, value: Tensor,
+        b: Optional[Tensor], transition: Optional[Tensor]=None
+        ) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
         """
         Args:
             logp_o (torch.tensor): sequence of observation probabilities. size=[T, batch_size, state_dim]
-            u (torch.tensor): sequence of one-hot action vectors. size=[T, batch_size, act_dim]
+            u (torch.tensor): sequence of one-hot action vectors size=[T, batch_size, act_dim] 
+                or action indices size=[T, batch_size]
             value (torch.tensor): precomputed q value matrix. size=[batch_size, act_dim, state_dim]
-            b ([torch.tensor, None], optional): prior belief. size=[batch_size, state_dim]
+            b ([torch.tensor, None], optional): prior belief, log prior belief if log_space. 
+                size=[batch_size, state_dim]
+            transition ([torch.tensor, None], optional): precomputed transition matrix, 
+                log transition matrix if log_space. size=[1, act_dim, state_dim, state_dim]
         
         Returns:
             alpha_b (torch.tensor): sequence of posterior belief. size=[T, batch_size, state_dim]
             alpha_pi (torch.tensor): sequence of policy distribution. size=[T, batch_size, act_dim]
+            log_alpha_b (torch.tensor): sequence of log posterior belief. size=[T, batch_size, state_dim]
+            log_alpha_pi (torch.tensor): sequence of log policy distribution. size=[T, batch_size, act_dim]
         """
         batch_size = logp_o.shape[1]
-        transition = self.compute_transition()
-        T = len(logp_o)
+        if transition is None:
+            if self.log_space:
+                transition = self.compute_log_transition()
+            else:
+                transition = self.compute_transition()
+        T = logp_o.shape[0]
 
+        # without a prior belief the first step uses a uniform action prior
+        u0 = torch.ones(batch_size, self.act_dim, device=logp_o.device, dtype=logp_o.dtype) / self.act_dim
+        shift = 0
         if b is None:
-            b = self.init_hidden()
-            u = torch.cat([torch.ones(1, batch_size, self.act_dim).to(self.b0.device) / self.act_dim, u], dim=0)
+            b = self.init_log_hidden() if self.log_space else self.init_hidden()
+            shift = 1
         
-        alpha_b = [b] + [torch.empty(0)] * (T) # state posterior
-        alpha_pi = [torch.empty(0)] * (T) # policy
+        b_t = b
+        alpha_b: List[Tensor] = [] # state posterior
+        alpha_pi: List[Tensor] = [] # policy
+        log_alpha_b: List[Tensor] = [] # log state posterior
+        log_alpha_pi: List[Tensor] = [] # log policy
+        discarded: List[Tensor] = [] # sparse belief discarded mass
         for t in range(T):
-            alpha_b[t+1] = self.update_belief(
-                logp_o[t], u[t], alpha_b[t], transition
-            )
-            alpha_pi[t] = self.plan(alpha_b[t+1], value)
-        return torch.stack(alpha_b[1:]), torch.stack(alpha_pi)
+            u_t = u0 if t < shift else u[t - shift]
+            if self.log_space:
+                b_t = self.update_log_belief(logp_o[t], u_t, b_t, transition)
+                log_alpha_b.append(b_t)
+                alpha_b.append(torch.exp(b_t))
+                log_alpha_pi.append(self.plan_log(alpha_b[t], value))
+            else:
+                b_t = self.update_belief(logp_o[t], u_t, b_t, transition)
+                alpha_b.append(b_t)
+                alpha_pi.append(self.plan(b_t, value))
+            if self.sparse:
+                discarded.append(self.discarded_mass)
+        
+        if self.sparse:
+            self.discarded_mass = torch.stack(discarded)
+        
+        if self.log_space:
+            log_pi = torch.stack(log_alpha_pi)
+            return torch.stack(alpha_b), torch.exp(log_pi), torch.stack(log_alpha_b), log_pi
+        
+        pi = torch.stack(alpha_pi)
+        b_out = torch.stack(alpha_b)
+        return b_out, pi, torch.log(b_out + self.eps), torch.log(pi + self.eps)
 
 
 def poisson_pdf(rate: Tensor, K: int) -> Tensor:
@@ -151,7 +519,21 @@ def poisson_pdf(rate: Tensor, K: int) -> Tensor:
     Returns:
         pdf (torch.tensor): truncated poisson pdf [batch_size, K]
     """
-    Ks = 1 + torch.arange(K).to(rate.device)
+    Ks = 1 + torch.arange(K, dtype=rate.dtype, device=rate.device)
     poisson_logp = Ks.xlogy(rate) - rate - (Ks + 1).lgamma()
     pdf = torch.softmax(poisson_logp, dim=-1)
-    return pdf
\ No newline at end of file
+    return pdf
+
+def poisson_log_pdf(rate: Tensor, K: int) -> Tensor:
+    """ 
+    Args:
+        rate (torch.tensor): poission arrival rate [batch_size, 1]
+        K (int): number of bins
+
+    Returns:
+        log_pdf (torch.tensor): truncated poisson log pdf [batch_size, K]
+    """
+    Ks = 1 + torch.arange(K, dtype=rate.dtype, device=rate.device)
+    poisson_logp = Ks.xlogy(rate) - rate - (Ks + 1).lgamma()
+    log_pdf = torch.log_softmax(poisson_logp, dim=-1)
+    return log_pdf
\ No newline at end of file
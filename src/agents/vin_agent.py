@@ -1,9 +1,10 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+import torch.jit as jit
 import torch.distributions as torch_dist
 from src.distributions.nn_models import Model
 from src.agents.qmdp_layer import QMDPLayer
+from src.agents.inference import VINInferenceSession
 from src.distributions.mixture_models import ConditionalGaussian
 from src.distributions.utils import kl_divergence
 
@@ -17,7 +18,8 @@ class VINAgent(Model):
     """
     def __init__(
         self, state_dim, act_dim, obs_dim, rank, horizon, 
-        alpha, epsilon, obs_cov="full"
+        alpha, epsilon, obs_cov="full", horizon_tol=0., log_space=False, 
+        belief_topk=0, belief_tol=0.
         ):
         super().__init__()
         self.state_dim = state_dim
@@ -27,7 +29,10 @@ class VINAgent(Model):
         self.alpha = alpha # observation entropy weight
         self.epsilon = epsilon # prior policy weight
         
-        self.rnn = QMDPLayer(state_dim, act_dim, rank, horizon)
+        self.rnn = QMDPLayer(
+            state_dim, act_dim, rank, horizon, horizon_tol, log_space, 
+            belief_topk, belief_tol
+        )
         self.obs_model = ConditionalGaussian(
             obs_dim, state_dim, cov=obs_cov, batch_norm=True
         )
@@ -35,13 +40,37 @@ class VINAgent(Model):
         self._pi0 = nn.Parameter(torch.randn(1, act_dim, state_dim))
         nn.init.xavier_normal_(self.c, gain=1.)
         nn.init.xavier_normal_(self._pi0, gain=1.)
+
+        self._cache = None # parameter derived tensors
+    
+    def __getstate__(self):
+        # cached tensors hold autograd graphs which cannot be copied
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
     
     def reset(self):
         """ Reset internal states for online inference """
-        self._b = None # previous belief distribution
-        self._a = None # previous action distribution
-        self._prev_ctl = None # size=[1, batch_size, act_dim]
+        self._b = None # previous belief distribution, log belief if log_space
+        self._a = None # previous action distribution, log distribution if log_space
+        self._prev_ctl = None # size=[batch_size]
         self._value = None # precomputed value
+        self.clear_cache()
+    
+    def clear_cache(self):
+        """ Clear cached parameter derived tensors. Needed after parameters are 
+        modified through aliased storage, which the cache key does not track """
+        self._cache = None
+        self.obs_model._clear_cache()
+
+    def script(self):
+        """ Compile the recurrent layer and observation likelihood with TorchScript. 
+        Parameters and state dict keys are shared with the eager modules. """
+        if not isinstance(self.rnn, jit.ScriptModule):
+            self.rnn = jit.script(self.rnn)
+        self.obs_model.use_script = True
+        self._cache = None
+        return self
 
     def compute_target_dist(self):
         return torch.softmax(self.c, dim=-1)
@@ -50,17 +79,63 @@ class VINAgent(Model):
         """ Prior policy """
         return torch.softmax(self._pi0, dim=-2)
     
-    def compute_reward(self):
-        """ State action reward """
-        transition = self.rnn.compute_transition()
+    def compute_reward(self, transition=None, log_transition=None):
+        """ State action reward. Computed from log_transition without eps smoothing if given """
+        if transition is None and log_transition is not None:
+            transition = log_transition.exp()
+        elif transition is None:
+            transition = self.rnn.compute_transition()
         entropy = self.obs_model.entropy()
         
-        c = self.compute_target_dist()
-        kl = kl_divergence(transition, c.unsqueeze(-2).unsqueeze(-2))
+        if log_transition is not None:
+            log_c = torch.log_softmax(self.c, dim=-1).unsqueeze(-2).unsqueeze(-2)
+            kl = torch.sum(transition * (log_transition - log_c), dim=-1)
+            log_pi0 = torch.log_softmax(self._pi0, dim=-2)
+        else:
+            c = self.compute_target_dist()
+            kl = kl_divergence(transition, c.unsqueeze(-2).unsqueeze(-2))
+            log_pi0 = torch.log(self.compute_pi0() + 1e-6)
         eh = torch.sum(transition * entropy.unsqueeze(-2).unsqueeze(-2), dim=-1)
-        log_pi0 = torch.log(self.compute_pi0() + 1e-6)
         r = -kl - self.alpha * eh + self.epsilon * log_pi0
         return r
+    
+    def _cache_key(self):
+        """ Signature of parameter storage and in-place version counters """
+        key = [torch.is_grad_enabled()]
+        for p in self.parameters():
+            key.append((p.data_ptr(), p._version))
+        return tuple(key)
+
+    def compute_planning_tensors(self):
+        """ Compute parameter derived transition, reward, and value tensors.
+
+        Tensors are cached with their autograd graph and reused across forward 
+        passes until any parameter is modified in place (e.g. by an optimizer step) 
+        or replaced. The cache is also cleared by reset.
+
+        Returns:
+            cache (dict): dict with keys ["transition", "log_transition", "reward", "value"]. 
+                log_transition is None unless log_space
+        """
+        key = self._cache_key()
+        if self._cache is None or self._cache["key"] != key:
+            log_transition = None
+            if self.rnn.log_space:
+                log_transition = self.rnn.compute_log_transition()
+                transition = log_transition.exp()
+                reward = self.compute_reward(transition, log_transition)
+            else:
+                transition = self.rnn.compute_transition()
+                reward = self.compute_reward(transition)
+            value = self.rnn.compute_value(transition, reward)
+            self._cache = {
+                "key": key, 
+                "transition": transition, 
+                "log_transition": log_transition, 
+                "reward": reward, 
+                "value": value
+            }
+        return self._cache
 
     def forward(
         self, o: Tensor, u: Union[Tensor, None], 
@@ -71,31 +146,38 @@ class VINAgent(Model):
         Args:
             o (torch.tensor): observation sequence. size=[T, batch_size, obs_dim]
             u (torch.tensor): control sequence. size=[T, batch_size, ctl_dim]
-            hidden ([tuple[torch.tensor, torch.tensor], None], optional). initial hidden state.
+            hidden ([list, None], optional). initial hidden state. Either [b, a] or 
+                the hidden outputs of a previous forward call. Default=None
             value (tuple[torch.tensor, None], optional): precomputed value. Default=None
         
         Returns:
             alpha_b (torch.tensor): state belief distributions. size=[T, batch_size, state_dim]
             alpha_a (torch.tensor): action predictive distributions. size=[T, batch_size, act_dim]
+            hidden (list): [alpha_b, alpha_a, value, log_alpha_a, log_alpha_b]
         """
         batch_size = o.shape[1]
-        b, a = None, None
+        b = None
         if hidden is not None:
-            b, a = hidden
+            b = hidden[0]
+            if self.rnn.log_space:
+                b = hidden[4] if len(hidden) > 4 else torch.log(b)
 
         logp_o = self.obs_model.log_prob(o) 
         if u is not None:
-            u_oh = F.one_hot(u.long(), self.act_dim).squeeze(-2).to(torch.float32).to(self.device)
+            # hard action indices take the transition gather path
+            u_in = u.long().reshape(o.shape[0], batch_size).to(self.device)
         else:
-            u_oh = torch.ones(1, batch_size, self.act_dim).to(self.device) / self.act_dim
+            u_in = torch.ones(1, batch_size, self.act_dim, dtype=logp_o.dtype).to(self.device) / self.act_dim
         
+        cache = self.compute_planning_tensors()
         if value is None:
-            transition = self.rnn.compute_transition()
-            reward = self.compute_reward()
-            value = self.rnn.compute_value(transition, reward)
+            value = cache["value"]
 
-        alpha_b, alpha_a = self.rnn(logp_o, u_oh, value, b)
-        return [alpha_b, alpha_a], [alpha_b, alpha_a, value] # second tuple used in bptt
+        transition = cache["log_transition"] if self.rnn.log_space else cache["transition"]
+        alpha_b, alpha_a, log_alpha_b, log_alpha_a = self.rnn(logp_o, u_in, value, b, transition)
+        
+        # second list used in bptt
+        return [alpha_b, alpha_a], [alpha_b, alpha_a, value, log_alpha_a, log_alpha_b]
     
     def act_loss(self, o, u, mask, hidden):
         """ Compute action loss 
@@ -110,16 +192,18 @@ class VINAgent(Model):
             loss (torch.tensor): action loss. size=[batch_size]
             stats (dict): action loss stats
         """
-        _, alpha_a, _ = hidden
+        value, log_alpha_a = hidden[2], hidden[3]
         
-        logp_u = torch.gather(torch.log(alpha_a + 1e-6), -1, u.long()).squeeze(-1)
+        logp_u = torch.gather(log_alpha_a, -1, u.long()).squeeze(-1)
         loss = -torch.sum(logp_u * mask, dim=0) / (mask.sum(0) + 1e-6)
 
         # compute stats
         nan_mask = mask.clone()
         nan_mask[nan_mask == 0] = torch.nan
         logp_u_mean = -torch.nanmean((nan_mask * logp_u)).cpu().data
-        stats = {"loss_u": logp_u_mean}
+        stats = {"loss_u": logp_u_mean, "num_steps": value.shape[0]}
+        if self.rnn.sparse:
+            stats["discarded_mass"] = self.rnn.discarded_mass.mean().cpu().item()
         return loss, stats
     
     def obs_loss(self, o, u, mask, hidden):
@@ -135,12 +219,17 @@ class VINAgent(Model):
             loss (torch.tensor): observation loss. size=[batch_size]
             stats (dict): observation loss stats
         """
-        alpha_b, _, _ = hidden
+        alpha_b = hidden[0]
 
         # one step transition
-        u_oh = F.one_hot(u.long(), num_classes=self.act_dim).squeeze(-2).to(torch.float32)
-        s_next = self.rnn.predict_one_step(alpha_b, u_oh)
-        logp_o = self.obs_model.mixture_log_prob(s_next[:-1], o[1:])
+        u_in = u.long().reshape(alpha_b.shape[:-1])
+        cache = self.compute_planning_tensors()
+        if self.rnn.log_space:
+            logp_s = self.rnn.predict_one_step_log(hidden[4], u_in, cache["log_transition"])
+            logp_o = self.obs_model.mixture_log_prob(logp_s[:-1], o[1:], log_space=True)
+        else:
+            s_next = self.rnn.predict_one_step(alpha_b, u_in, cache["transition"])
+            logp_o = self.obs_model.mixture_log_prob(s_next[:-1], o[1:])
         loss = -torch.sum(logp_o * mask[1:], dim=0) / (mask[1:].sum(0) + 1e-6)
         
         # compute stats
@@ -150,31 +239,66 @@ class VINAgent(Model):
         stats = {"loss_o": logp_o_mean}
         return loss, stats
     
-    def choose_action(self, o):
-        """ Choose action online for a single time step
+    def choose_action(self, o, reset_mask=None):
+        """ Choose action online for a single time step. 
+        Each batch element is tracked as an independent belief stream.
         
         Args:
-            o (torch.tensor): observation sequence. size[batch_size, obs_dim]
-            u (torch.tensor): control sequence. size[batch_size, ctl_dim]
-            sample_method (str, optional): sampling method. 
-                choices=["bma", "ace", "ace"]. Default="ace"
-            num_samples (int, optional): number of samples to draw. Default=1
+            o (torch.tensor): observation. size[batch_size, obs_dim]
+            reset_mask (torch.tensor, optional): binary mask of streams to restart 
+                from the initial belief before this step. size=[batch_size]. Default=None
         
         Returns:
-            u_sample (torch.tensor): sampled controls. size=[num_samples, batch_size]
-            logp (torch.tensor): control log probability. size=[num_samples, batch_size]
+            u_sample (torch.tensor): sampled controls. size=[batch_size]
         """
-        _, [alpha_b, alpha_a, value] = self.forward(
-            o.unsqueeze(0), self._prev_ctl, [self._b, self._a], self._value
-        )
-        b_t, a_t = alpha_b[0], alpha_a[0]
-        u_sample = torch_dist.Categorical(a_t).sample()
+        cache = self.compute_planning_tensors()
+        if self._value is None:
+            self._value = cache["value"]
+        
+        logp_o = self.obs_model.log_prob(o)
+        
+        # restarted streams use the initial belief and a uniform action prior
+        if self.rnn.log_space:
+            b0 = self.rnn.init_log_hidden()
+            transition = cache["log_transition"]
+            update_belief = self.rnn.update_log_belief
+        else:
+            b0 = self.rnn.init_hidden()
+            transition = cache["transition"]
+            update_belief = self.rnn.update_belief
+        u0 = torch.ones(1, self.act_dim, dtype=logp_o.dtype).to(self.device) / self.act_dim
+        if self._b is None:
+            b_t = update_belief(logp_o, u0, b0, transition)
+        else:
+            b_t = update_belief(logp_o, self._prev_ctl, self._b, transition)
+            if reset_mask is not None:
+                reset_mask = reset_mask.view(-1, 1).to(torch.bool)
+                b_reset = update_belief(logp_o, u0, b0, transition)
+                b_t = torch.where(reset_mask, b_reset, b_t)
+        
+        if self.rnn.log_space:
+            a_t = self.rnn.plan_log(b_t.exp(), self._value)
+            u_sample = torch_dist.Categorical(logits=a_t).sample()
+        else:
+            a_t = self.rnn.plan(b_t, self._value)
+            u_sample = torch_dist.Categorical(a_t).sample()
         
         self._b, self._a = b_t, a_t
-        self._prev_ctl = u_sample.view(1, 1, -1)
-        self._value = value
+        self._prev_ctl = u_sample
         return u_sample
     
+    def get_belief(self):
+        """ Return the online belief distribution of the last choose_action call. 
+        size=[batch_size, state_dim] """
+        if self.rnn.log_space:
+            return self._b.exp()
+        return self._b
+    
+    def inference_session(self, obs_low=None, obs_high=None, grid_bins=0):
+        """ Create a frozen inference session for fast online control. 
+        See VINInferenceSession for the optional observation likelihood grid. """
+        return VINInferenceSession(self, obs_low, obs_high, grid_bins)
+    
     def choose_action_batch(self, o, u):
         """ Choose action offline for a batch of sequences 
         
@@ -192,21 +316,21 @@ class VINAgent(Model):
             u_sample (torch.tensor): sampled controls. size=[num_samples, T, batch_size]
             logp (torch.tensor): control log probability. size=[num_samples, T, batch_size]
         """
-        _, [alpha_b, alpha_a, _] = self.forward(o, u)
+        [alpha_b, alpha_a], _ = self.forward(o, u)
         
         u_sample = torch_dist.Categorical(alpha_a).sample()
         return u_sample
 
     def predict(self, o, u, sample_method="ace", num_samples=1):
         """ Offline prediction observations """
-        _, [alpha_b, alpha_a, value] = self.forward(o, u)
+        [alpha_b, alpha_a], _ = self.forward(o, u)
 
         if sample_method == "bma":
             o_sample = self.obs_model.bayesian_average(alpha_b)
         else:
             sample_mean = True if sample_method == "acm" else False
             o_sample = self.obs_model.ancestral_sample(
-                alpha_b, num_samples, sample_mean, tau=0.1, hard=True
+                alpha_b, num_samples, sample_mean, tau=0.1, hard=True, select=True
             )
         return o_sample
 
@@ -0,0 +1,127 @@
+import numpy as np
+import torch
+
+def cluster_env_states(env, num_clusters, num_iters=50, seed=0):
+    """ K-means cluster discretized env states by their normalized cell centers
+
+    Args:
+        env (CustomMountainCar): discretized environment
+        num_clusters (int): number of clusters
+        num_iters (int, optional): number of k-means iterations. Default=50
+        seed (int, optional): random seed. Default=0
+
+    Returns:
+        assign (np.array): cluster index of each env state. size=[env_state_dim]
+    """
+    assert num_clusters <= env.state_dim
+    x = env.state2obs(np.arange(env.state_dim))
+    x = (x - env.low) / (env.high - env.low)
+
+    rng = np.random.RandomState(seed)
+    means = x[rng.choice(len(x), num_clusters, replace=False)]
+    for _ in range(num_iters):
+        dist = np.sum((x[:, None] - means[None]) ** 2, axis=-1)
+        assign = np.argmin(dist, axis=1)
+        for k in range(num_clusters):
+            if np.any(assign == k):
+                means[k] = x[assign == k].mean(0)
+            else:
+                # restart empty cluster at the worst fitted state
+                means[k] = x[np.argmax(dist[np.arange(len(x)), assign])]
+    return assign
+
+def aggregate_env_model(env, assign, num_clusters):
+    """ Aggregate env transition, initial distribution, and observations over clusters.
+    Member states are weighted equally. Emission statistics use cell centers plus
+    the uniform within cell variance, passed through env.obs_matrix if it has been made.
+
+    Args:
+        env (CustomMountainCar): discretized environment with transition_matrix
+        assign (np.array): cluster index of each env state. size=[env_state_dim]
+        num_clusters (int): number of clusters
+
+    Returns:
+        transition (np.array): cluster transition matrix. size=[act_dim, num_clusters, num_clusters]
+        initial_dist (np.array): cluster initial distribution. size=[num_clusters]
+        obs_mean (np.array): cluster observation means. size=[num_clusters, obs_dim]
+        obs_cov (np.array): cluster observation covariances. size=[num_clusters, obs_dim, obs_dim]
+    """
+    onehot = np.eye(num_clusters)[assign] # size=[env_state_dim, num_clusters]
+    weight = onehot / (onehot.sum(0, keepdims=True) + 1e-6)
+
+    transition = np.einsum("ik, aij, jh -> akh", weight, env.transition_matrix, onehot)
+    transition /= transition.sum(-1, keepdims=True)
+
+    if hasattr(env, "initial_dist"):
+        initial_dist = env.initial_dist.dot(onehot)
+    else:
+        initial_dist = onehot.sum(0)
+    initial_dist /= initial_dist.sum()
+
+    # observed cell distribution of each cluster
+    obs_weight = weight.T
+    if hasattr(env, "obs_matrix"):
+        obs_weight = obs_weight.dot(env.obs_matrix)
+
+    d = (env.high - env.low) / np.array([env.x_bins, env.v_bins])
+    centers = env.state2obs(np.arange(env.state_dim)) + d / 2
+    obs_mean = obs_weight.dot(centers)
+    diff = centers[None] - obs_mean[:, None]
+    obs_cov = np.einsum("ki, kix, kiy -> kxy", obs_weight, diff, diff) + np.diag(d ** 2 / 12)
+    return transition, initial_dist, obs_mean, obs_cov
+
+def fit_transition_logits(rnn, transition, num_steps=1000, lr=0.05):
+    """ Fit QMDPLayer transition parameters to a target transition matrix.
+    Full rank logits are set directly, low rank factors are fit by minimizing kl divergence.
+
+    Args:
+        rnn (QMDPLayer): qmdp layer
+        transition (torch.tensor): target transition matrix. size=[act_dim, state_dim, state_dim]
+        num_steps (int, optional): number of low rank optimization steps. Default=1000
+        lr (float, optional): low rank optimization learning rate. Default=0.05
+
+    Returns:
+        kl (float): mean kl divergence between target and fitted transitions
+    """
+    log_target = torch.log(transition + 1e-6)
+    if rnn.rank == 0:
+        rnn.w.data = log_target.unsqueeze(0)
+    else:
+        optimizer = torch.optim.Adam([rnn.u, rnn.v, rnn.w], lr=lr)
+        for _ in range(num_steps):
+            log_transition = rnn.compute_log_transition()[0]
+            loss = -torch.sum(transition * log_transition, dim=-1).mean()
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+
+    with torch.no_grad():
+        log_transition = rnn.compute_log_transition()[0]
+        kl = torch.sum(transition * (log_target - log_transition), dim=-1).mean()
+    return kl.item()
+
+def warm_start_agent(agent, env, num_steps=1000, lr=0.05, seed=0):
+    """ Initialize agent initial belief, transition, and observation model from
+    a discretized environment model. Batch norm stats should be initialized beforehand.
+
+    Args:
+        agent (VINAgent): agent to initialize in place
+        env (CustomMountainCar): discretized environment with transition_matrix
+        num_steps (int, optional): number of low rank transition fitting steps. Default=1000
+        lr (float, optional): transition fitting learning rate. Default=0.05
+        seed (int, optional): clustering random seed. Default=0
+
+    Returns:
+        kl (float): mean kl divergence between aggregated and fitted transitions
+    """
+    assign = cluster_env_states(env, agent.state_dim, seed=seed)
+    transition, initial_dist, obs_mean, obs_cov = aggregate_env_model(
+        env, assign, agent.state_dim
+    )
+    to_tensor = lambda x: torch.from_numpy(x).to(torch.float32).to(agent.device)
+
+    agent.rnn.b0.data = torch.log(to_tensor(initial_dist) + 1e-6).unsqueeze(0)
+    kl = fit_transition_logits(agent.rnn, to_tensor(transition), num_steps, lr)
+    agent.obs_model.init_params(to_tensor(obs_mean), to_tensor(obs_cov))
+    agent.reset()
+    return kl
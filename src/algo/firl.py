@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 from copy import deepcopy
 import torch
@@ -10,6 +11,7 @@ from torch.autograd import grad as torch_grad
 from src.distributions.nn_models import Model, MLP
 from src.algo.rl import DoubleQNetwork
 from src.algo.replay_buffer import ReplayBuffer
+from src.algo.prefetch import BatchPrefetcher
 from src.distributions.utils import kl_divergence
 
 
@@ -18,7 +20,9 @@ class FIRL(Model):
     def __init__(
         self, agent, hidden_dim, num_hidden, activation, gamma=0.9, beta=0.2, polyak=0.995, norm_obs=False,
         buffer_size=int(1e6), d_batch_size=100, a_batch_size=32, rnn_len=50, reward_steps=500, d_steps=50, a_steps=50, 
-        lr_d=1e-3, lr_a=1e-3, lr_c=1e-3, decay=0, grad_clip=None, grad_penalty=1., bc_penalty=1., obs_penalty=1.
+        lr_d=1e-3, lr_a=1e-3, lr_c=1e-3, decay=0, grad_clip=None, grad_penalty=1., bc_penalty=1., obs_penalty=1.,
+        num_critics=2, critic_reduce="min", priority_alpha=0., priority_beta=0.4,
+        prefetch=0, sample_seed=None
         ):
         """
         Args:
@@ -41,6 +45,17 @@ class FIRL(Model):
             decay (float, optional): weight decay. Default=0
             grad_clip (float, optional): gradient clipping. Default=None
             grad_penalty (float, optional): discriminator gradient penalty. Default=1.
+            num_critics (int, optional): number of ensemble critics. Default=2
+            critic_reduce (str, optional): critic ensemble reduction. 
+                choices=["min", "mean", "subset"]. Default="min"
+            priority_alpha (float, optional): replay buffer td error priority exponent for 
+                critic sampling. Uniform sampling if priority_alpha=0. Default=0.
+            priority_beta (float, optional): replay buffer importance weight exponent. Default=0.4
+            prefetch (int, optional): number of batches sampled ahead on a background thread. 
+                Batches are sampled synchronously if prefetch=0. With priority_alpha > 0, prefetched 
+                batches are drawn from priorities up to prefetch steps old. Default=0
+            sample_seed (int, optional): replay sampling random seed. 
+                Global numpy random state is used if None. Default=None
         """
         super().__init__()
         self.gamma = gamma
@@ -61,6 +76,13 @@ class FIRL(Model):
         self.grad_penalty = grad_penalty
         self.bc_penalty = bc_penalty
         self.obs_penalty = obs_penalty
+        self.prefetch = prefetch
+        self.sample_rng = None if sample_seed is None else np.random.RandomState(sample_seed)
+        if prefetch > 0 and priority_alpha > 0:
+            warnings.warn(
+                "prefetch > 0 with priority_alpha > 0 samples from priorities up to "
+                f"{prefetch} steps stale"
+            )
 
         self.agent = agent
         self.discriminator = MLP(
@@ -80,7 +102,8 @@ class FIRL(Model):
             batch_norm=False
         )
         self.critic = DoubleQNetwork(
-            agent.obs_dim, agent.act_dim, hidden_dim, num_hidden, activation
+            agent.obs_dim, agent.act_dim, hidden_dim, num_hidden, activation,
+            num_critics=num_critics, reduce=critic_reduce
         )
         self.critic_target = deepcopy(self.critic)
 
@@ -102,7 +125,10 @@ class FIRL(Model):
         )
 
         self.real_buffer = ReplayBuffer(agent.obs_dim, agent.act_dim, agent.state_dim, int(1e6))
-        self.replay_buffer = ReplayBuffer(agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size)
+        self.replay_buffer = ReplayBuffer(
+            agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size, 
+            priority_alpha=priority_alpha, priority_beta=priority_beta
+        )
 
         self.obs_mean = nn.Parameter(torch.zeros(agent.obs_dim), requires_grad=False)
         self.obs_variance = nn.Parameter(torch.ones(agent.obs_dim), requires_grad=False)
@@ -185,9 +211,29 @@ class FIRL(Model):
         grad_pen = torch.pow(grad_norm - 1, 2).mean()
         return grad_pen
 
-    def compute_discriminator_loss(self): 
-        real_batch = self.real_buffer.sample_random(self.d_batch_size, prioritize=False)
-        fake_batch = self.replay_buffer.sample_random(self.d_batch_size, prioritize=True)
+    def sample_discriminator_batch(self, rng=None):
+        real_batch = self.real_buffer.sample_random(self.d_batch_size, prioritize=False, rng=rng)
+        fake_batch = self.replay_buffer.sample_random(self.d_batch_size, prioritize=True, rng=rng)
+        return real_batch, fake_batch
+    
+    def sample_reward_batch(self, rng=None):
+        real_batch = self.real_buffer.sample_episodes(self.a_batch_size, self.reward_steps, prioritize=False, rng=rng)
+        fake_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.reward_steps, prioritize=True, rng=rng)
+        return real_batch, fake_batch
+    
+    def sample_critic_batch(self, rng=None):
+        return self.replay_buffer.sample_random(self.d_batch_size, proportional=True, rng=rng)
+    
+    def sample_actor_batch(self, rng=None):
+        """ Sample episode batches for actor and observation losses """
+        actor_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, rng=rng)
+        obs_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, rng=rng)
+        return actor_batch, obs_batch
+
+    def compute_discriminator_loss(self, batch=None): 
+        if batch is None:
+            batch = self.sample_discriminator_batch()
+        real_batch, fake_batch = batch
         
         real_obs = real_batch["obs"].to(self.device)
         real_ctl = real_batch["ctl"].to(self.device)
@@ -216,9 +262,10 @@ class FIRL(Model):
         gp = self.gradient_penalty(real_obs_norm, fake_obs_norm)
         return d_loss, gp
     
-    def compute_reward_loss(self):
-        real_batch = self.real_buffer.sample_episodes(self.a_batch_size, self.reward_steps, prioritize=False)
-        fake_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.reward_steps, prioritize=True)
+    def compute_reward_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_reward_batch()
+        real_batch, fake_batch = batch
         real_pad_batch, real_mask = real_batch
         real_obs = real_pad_batch["obs"].to(self.device)
         fake_pad_batch, fake_mask = fake_batch
@@ -243,8 +290,9 @@ class FIRL(Model):
         r_loss = torch.mean(log_r * reward) - torch.mean(log_r) * torch.mean(reward)
         return r_loss / self.reward_steps
 
-    def compute_critic_loss(self):
-        batch = self.replay_buffer.sample_random(self.d_batch_size)
+    def compute_critic_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_critic_batch()
         obs = batch["obs"].to(self.device)
         ctl = batch["ctl"].to(self.device)
         r = batch["rwd"].to(self.device)
@@ -262,21 +310,20 @@ class FIRL(Model):
             r = self.compute_reward(obs_norm)
 
             # compute value target
-            q1_next, q2_next = self.critic_target(next_obs_norm)
-            q_next = torch.min(q1_next, q2_next)
+            q_next = self.critic_target.reduce_q(self.critic_target(next_obs_norm))
             v_next = torch.logsumexp(q_next / self.beta, dim=-1, keepdim=True) * self.beta
             q_target = r + (1 - done) * self.gamma * v_next
         
-        q1, q2 = self.critic(obs_norm)
-        q1 = torch.gather(q1, -1, ctl.long())
-        q2 = torch.gather(q2, -1, ctl.long())
-        q1_loss = torch.pow(q1 - q_target, 2).mean()
-        q2_loss = torch.pow(q2 - q_target, 2).mean()
-        q_loss = (q1_loss + q2_loss) / 2
+        q = self.critic(obs_norm)
+        weight = batch["weight"].to(self.device) if "weight" in batch else None
+        q_loss, td_error = self.critic.compute_loss(q, ctl, q_target, weight)
+        if "idx" in batch:
+            self.replay_buffer.update_priorities(batch["idx"], td_error)
         return q_loss
 
-    def compute_actor_loss(self):
-        batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False)
+    def compute_actor_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_actor_batch()[0]
         pad_batch, mask = batch
         obs = pad_batch["obs"].to(self.device)
         ctl = pad_batch["ctl"].to(self.device).to(torch.float32)
@@ -287,21 +334,21 @@ class FIRL(Model):
 
         [_, alpha_a], _ = self.agent(obs, ctl)
         
-        q1, q2 = self.critic(obs_norm)
-        q = torch.min(q1, q2)
+        q = self.critic.reduce_q(self.critic(obs_norm))
         pi_target = torch.softmax(q / self.beta, dim=-1)
         a_loss = kl_divergence(alpha_a, pi_target)
         a_loss = torch.sum(a_loss * mask) / (mask.sum() + 1e-6)
         return a_loss
     
-    def compute_obs_loss(self):
-        batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False)
+    def compute_obs_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_actor_batch()[1]
         pad_batch, mask = batch
         obs = pad_batch["obs"].to(self.device)
         ctl = pad_batch["ctl"].to(self.device)
         
-        out = self.agent(obs, ctl)
-        obs_loss, _ = self.agent.obs_loss(obs, ctl, mask, out)
+        _, hidden = self.agent(obs, ctl)
+        obs_loss, _ = self.agent.obs_loss(obs, ctl, mask, hidden)
         obs_loss = obs_loss.mean()
         return obs_loss
 
@@ -313,9 +360,12 @@ class FIRL(Model):
         self.update_normalization_stats()
         
         d_loss_epoch = []
-        for i in range(self.d_steps):
+        batches = BatchPrefetcher(
+            self.sample_discriminator_batch, self.d_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for batch in batches:
             # train discriminator
-            d_loss, gp = self.compute_discriminator_loss()
+            d_loss, gp = self.compute_discriminator_loss(batch)
             d_total_loss = d_loss + self.grad_penalty * gp
             d_total_loss.backward()
             if self.grad_clip is not None:
@@ -329,9 +379,12 @@ class FIRL(Model):
                 logger.push({"d_loss": d_loss.data.item()})
         
         r_loss_epoch = []
-        for i in range(self.d_steps):
+        batches = BatchPrefetcher(
+            self.sample_reward_batch, self.d_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for batch in batches:
             # train reward
-            r_loss = self.compute_reward_loss()
+            r_loss = self.compute_reward_loss(batch)
             r_loss.backward()
             nn.utils.clip_grad_norm_(self.reward.parameters(), self.grad_clip)
             self.r_optimizer.step()
@@ -345,9 +398,13 @@ class FIRL(Model):
         critic_loss_epoch = []
         actor_loss_epoch = []
         obs_loss_epoch = []
-        for i in range(self.a_steps):
+        batches = BatchPrefetcher(
+            lambda rng: (self.sample_critic_batch(rng), self.sample_actor_batch(rng)), 
+            self.a_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for critic_batch, (actor_batch, obs_batch) in batches:
             # train critic
-            critic_loss = self.compute_critic_loss()
+            critic_loss = self.compute_critic_loss(critic_batch)
             critic_loss.backward()
             if self.grad_clip is not None:
                 nn.utils.clip_grad_norm_(self.critic.parameters(), self.grad_clip)
@@ -358,8 +415,8 @@ class FIRL(Model):
             critic_loss_epoch.append(critic_loss.data.item())
 
             # train actor
-            actor_loss = self.compute_actor_loss()
-            obs_loss = self.compute_obs_loss()
+            actor_loss = self.compute_actor_loss(actor_batch)
+            obs_loss = self.compute_obs_loss(obs_batch)
             actor_total_loss = (
                 actor_loss + self.obs_penalty * obs_loss
             )
@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 from copy import deepcopy
 import torch
@@ -9,7 +10,8 @@ from torch.autograd import grad as torch_grad
 # model imports
 from src.distributions.nn_models import Model, MLP
 from src.algo.rl import DoubleQNetwork
-from src.algo.replay_buffer import ReplayBuffer
+from src.algo.replay_buffer import ReplayBuffer, buffer_exists, concat_padded_batches
+from src.algo.prefetch import BatchPrefetcher
 from src.distributions.utils import kl_divergence
 
 
@@ -20,7 +22,10 @@ class DAC(Model):
         gamma=0.9, beta=0.2, polyak=0.995, use_state=False, norm_obs=False,
         buffer_size=int(1e6), d_batch_size=100, a_batch_size=32, rnn_len=50, 
         d_steps=50, a_steps=50, lr_d=1e-3, lr_a=1e-3, lr_c=1e-3, decay=0, grad_clip=None, 
-        grad_penalty=1., grad_target=1., bc_penalty=1., obs_penalty=1.
+        grad_penalty=1., grad_target=1., bc_penalty=1., obs_penalty=1., 
+        num_critics=2, critic_reduce="min", buffer_state_dtype="float32", 
+        buffer_path=None, demo_buffer_path=None, priority_alpha=0., priority_beta=0.4,
+        prefetch=0, sample_seed=None
         ):
         """
         Args:
@@ -46,6 +51,23 @@ class DAC(Model):
             grad_target (float, optional): discriminator gradient norm target. Default=1.
             bc_penalty (float, optional): behavior cloning penalty. Default=1.
             obs_penalty (float, optional): observation penalty. Default=1.
+            num_critics (int, optional): number of ensemble critics. Default=2
+            critic_reduce (str, optional): critic ensemble reduction. 
+                choices=["min", "mean", "subset"]. Default="min"
+            buffer_state_dtype (str, optional): replay buffer state storage dtype. 
+                choices=["float32", "float16"]. Default="float32"
+            buffer_path (str, optional): replay buffer memory-mapped storage directory. 
+                Reopened if it exists. Stored in memory if None. Default=None
+            demo_buffer_path (str, optional): demonstration buffer memory-mapped storage 
+                directory. Opened read only if it exists. Stored in memory if None. Default=None
+            priority_alpha (float, optional): replay and demonstration buffer td error priority exponent for 
+                critic sampling. Uniform sampling if priority_alpha=0. Default=0.
+            priority_beta (float, optional): buffer importance weight exponent. Default=0.4
+            prefetch (int, optional): number of batches sampled ahead on a background thread. 
+                Batches are sampled synchronously if prefetch=0. With priority_alpha > 0, prefetched 
+                batches are drawn from priorities up to prefetch steps old. Default=0
+            sample_seed (int, optional): buffer sampling random seed. 
+                Global numpy random state is used if None. Default=None
         """
         super().__init__()
         self.gamma = gamma
@@ -69,6 +91,13 @@ class DAC(Model):
         self.grad_target = grad_target
         self.bc_penalty = bc_penalty
         self.obs_penalty = obs_penalty
+        self.prefetch = prefetch
+        self.sample_rng = None if sample_seed is None else np.random.RandomState(sample_seed)
+        if prefetch > 0 and priority_alpha > 0:
+            warnings.warn(
+                "prefetch > 0 with priority_alpha > 0 samples from priorities up to "
+                f"{prefetch} steps stale"
+            )
         
         self.agent = agent
         self.ref_agent = deepcopy(agent) # rollout agent
@@ -90,7 +119,8 @@ class DAC(Model):
             batch_norm=False
         )
         self.critic = DoubleQNetwork(
-            critic_input_dim, agent.act_dim, hidden_dim, num_hidden, activation
+            critic_input_dim, agent.act_dim, hidden_dim, num_hidden, activation,
+            num_critics=num_critics, reduce=critic_reduce
         )
         self.critic_target = deepcopy(self.critic)
 
@@ -108,8 +138,17 @@ class DAC(Model):
             self.agent.parameters(), lr=lr_a, weight_decay=decay
         )
 
-        self.real_buffer = ReplayBuffer(agent.obs_dim, agent.act_dim, agent.state_dim, int(1e6))
-        self.replay_buffer = ReplayBuffer(agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size)
+        demo_read_only = demo_buffer_path is not None and buffer_exists(demo_buffer_path)
+        assert not (use_state and demo_read_only), "cannot update states of a read only demonstration buffer"
+        self.real_buffer = ReplayBuffer(
+            agent.obs_dim, agent.act_dim, agent.state_dim, int(1e6), state_dtype=buffer_state_dtype, 
+            path=demo_buffer_path, read_only=demo_read_only,
+            priority_alpha=priority_alpha, priority_beta=priority_beta
+        )
+        self.replay_buffer = ReplayBuffer(
+            agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size, state_dtype=buffer_state_dtype,
+            path=buffer_path, priority_alpha=priority_alpha, priority_beta=priority_beta
+        )
 
         self.obs_mean = nn.Parameter(torch.zeros(agent.obs_dim), requires_grad=False)
         self.obs_variance = nn.Parameter(torch.ones(agent.obs_dim), requires_grad=False)
@@ -135,6 +174,10 @@ class DAC(Model):
         return s
 
     def fill_real_buffer(self, dataset):
+        # shared demonstrations are already stored
+        if self.real_buffer.read_only:
+            return
+
         for i in range(len(dataset)):
             batch = dataset[i]
             obs = np.array(batch["obs"])
@@ -153,6 +196,7 @@ class DAC(Model):
                 state = np.zeros((len(obs), self.agent.state_dim))
             
             self.real_buffer.push(obs, ctl, state, rwd, done)
+        self.real_buffer.flush()
 
     def update_normalization_stats(self):
         if self.norm_obs:
@@ -205,9 +249,29 @@ class DAC(Model):
         grad_pen = torch.pow(grad_norm - self.grad_target, 2).mean()
         return grad_pen
 
-    def compute_discriminator_loss(self): 
-        real_batch = self.real_buffer.sample_random(self.d_batch_size, prioritize=False)
-        fake_batch = self.replay_buffer.sample_random(self.d_batch_size, prioritize=True)
+    def sample_discriminator_batch(self, rng=None):
+        real_batch = self.real_buffer.sample_random(self.d_batch_size, prioritize=False, rng=rng)
+        fake_batch = self.replay_buffer.sample_random(self.d_batch_size, prioritize=True, rng=rng)
+        return real_batch, fake_batch
+    
+    def sample_critic_batch(self, rng=None):
+        real_batch = self.real_buffer.sample_random(self.d_batch_size, proportional=True, rng=rng)
+        fake_batch = self.replay_buffer.sample_random(self.d_batch_size, proportional=True, rng=rng)
+        return real_batch, fake_batch
+    
+    def sample_actor_batch(self, rng=None):
+        real_batch = self.real_buffer.sample_episodes(
+            self.a_batch_size, self.rnn_len, prioritize=False, sample_terminal=False, rng=rng
+        )
+        fake_batch = self.replay_buffer.sample_episodes(
+            self.a_batch_size, self.rnn_len, prioritize=False, sample_terminal=False, rng=rng
+        )
+        return real_batch, fake_batch
+
+    def compute_discriminator_loss(self, batch=None): 
+        if batch is None:
+            batch = self.sample_discriminator_batch()
+        real_batch, fake_batch = batch
         
         real_state = real_batch["state"].to(self.device)
         real_obs = real_batch["obs"].to(self.device)
@@ -266,9 +330,10 @@ class DAC(Model):
         #     r += self.beta * log_pi
         return r
 
-    def compute_critic_loss(self):
-        real_batch = self.real_buffer.sample_random(self.d_batch_size)
-        fake_batch = self.replay_buffer.sample_random(self.d_batch_size)
+    def compute_critic_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_critic_batch()
+        real_batch, fake_batch = batch
         
         real_state = real_batch["state"].to(self.device)
         real_obs = real_batch["obs"].to(self.device)
@@ -323,80 +388,68 @@ class DAC(Model):
             r_a = -self.discriminator(inputs_a)
 
             # compute value target
-            q1_next, q2_next = self.critic_target(critic_next_inputs)
-            q_next = torch.min(q1_next, q2_next)
+            q_next = self.critic_target.reduce_q(self.critic_target(critic_next_inputs))
             v_next = torch.logsumexp(q_next / self.beta, dim=-1, keepdim=True) * self.beta
             v_absorb = self.gamma / (1 - self.gamma) * r_a
             q_target = r + (1 - next_absorb) * self.gamma * v_next + next_absorb * v_absorb
         
-        q1, q2 = self.critic(critic_inputs)
-        q1 = torch.gather(q1, -1, ctl.long())
-        q2 = torch.gather(q2, -1, ctl.long())
-        q1_loss = torch.pow(q1 - q_target, 2).mean()
-        q2_loss = torch.pow(q2 - q_target, 2).mean()
-        q_loss = (q1_loss + q2_loss) / 2
+        # importance weights of prioritized buffer samples, ones for uniform samples
+        weight = None
+        if "weight" in real_batch or "weight" in fake_batch:
+            weight = torch.cat([
+                b["weight"].to(self.device) if "weight" in b else torch.ones(len(b["obs"]), 1).to(self.device)
+                for b in [real_batch, fake_batch]
+            ], dim=-2)
+
+        q = self.critic(critic_inputs)
+        q_loss, td_error = self.critic.compute_loss(q, ctl, q_target, weight)
+        real_size = len(real_obs)
+        if "idx" in real_batch:
+            self.real_buffer.update_priorities(real_batch["idx"], td_error[:real_size])
+        if "idx" in fake_batch:
+            self.replay_buffer.update_priorities(fake_batch["idx"], td_error[real_size:])
         return q_loss
 
-    def compute_actor_loss(self):
-        real_batch = self.real_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, sample_terminal=False)
-        fake_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, sample_terminal=False)
-        real_pad_batch, real_mask = real_batch
-        fake_pad_batch, fake_mask = fake_batch
+    def compute_actor_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_actor_batch()
+        real_batch, fake_batch = batch
         
-        real_obs = real_pad_batch["obs"].to(self.device)
-        real_ctl = real_pad_batch["ctl"].to(self.device).to(torch.float32)
-        real_absorb = real_pad_batch["absorb"].to(self.device)
-        real_mask = real_mask.to(self.device)
-
-        fake_obs = fake_pad_batch["obs"].to(self.device)
-        fake_ctl = fake_pad_batch["ctl"].to(self.device).to(torch.float32)
-        fake_absorb = fake_pad_batch["absorb"].to(self.device)
-        fake_mask = fake_mask.to(self.device)
-        
-        # normalize observation
-        real_obs_norm = self.normalize_obs(real_obs)
-        fake_obs_norm = self.normalize_obs(fake_obs)
+        # stack real and fake sequences to share a single agent and critic pass
+        real_size = real_batch[1].shape[1]
+        pad_batch, mask = concat_padded_batches([real_batch, fake_batch])
         
-        _, real_hidden = self.agent(real_obs, real_ctl)
-        _, fake_hidden = self.agent(fake_obs, fake_ctl)
+        obs = pad_batch["obs"].to(self.device)
+        ctl = pad_batch["ctl"].to(self.device).to(torch.float32)
+        absorb = pad_batch["absorb"].to(self.device)
+        mask = mask.to(self.device)
+        real_mask, fake_mask = mask[:, :real_size], mask[:, real_size:]
         
-        [real_state, real_alpha_a, _] = real_hidden
-        [fake_state, fake_alpha_a, _] = fake_hidden
+        # normalize observation
+        obs_norm = self.normalize_obs(obs)
         
-        # compute fake actor loss
-        fake_critic_inputs = self.concat_inputs(fake_state, fake_obs_norm, fake_absorb)
-        fake_q1, fake_q2 = self.critic(fake_critic_inputs)
-        fake_q = torch.min(fake_q1, fake_q2)
-        # fake_pi_target = torch.softmax(fake_q / self.beta, dim=-1)
-        # fake_a_loss = kl_divergence(fake_alpha_a, fake_pi_target)
-        # fake_a_loss = torch.sum(fake_a_loss * fake_mask) / (fake_mask.sum() + 1e-6)
-        fake_a_loss = torch.sum(
-            fake_alpha_a * (self.beta * torch.log(fake_alpha_a + 1e-6) - fake_q)
-        , dim=-1)
-        fake_a_loss = torch.sum(fake_a_loss * fake_mask) / (fake_mask.sum() + 1e-6)
+        _, hidden = self.agent(obs, ctl)
+        state, alpha_a, log_alpha_a = hidden[0], hidden[1], hidden[3]
         
-        # compute real actor loss
-        real_critic_inputs = self.concat_inputs(real_state, real_obs_norm, real_absorb)
-        real_q1, real_q2 = self.critic(real_critic_inputs)
-        real_q = torch.min(real_q1, real_q2)
-        # real_pi_target = torch.softmax(real_q / self.beta, dim=-1)
-        # real_a_loss = kl_divergence(real_alpha_a, real_pi_target)
-        # real_a_loss = torch.sum(real_a_loss * real_mask) / (real_mask.sum() + 1e-6)
-        real_a_loss = torch.sum(
-            real_alpha_a * (self.beta * torch.log(real_alpha_a + 1e-6) - real_q)
+        # compute actor loss
+        critic_inputs = self.concat_inputs(state, obs_norm, absorb)
+        q = self.critic.reduce_q(self.critic(critic_inputs))
+        # pi_target = torch.softmax(q / self.beta, dim=-1)
+        # a_loss = kl_divergence(alpha_a, pi_target)
+        a_loss = torch.sum(
+            alpha_a * (self.beta * log_alpha_a - q)
         , dim=-1)
-        real_a_loss = torch.sum(real_a_loss * real_mask) / (real_mask.sum() + 1e-6)
-        
+        real_a_loss = torch.sum(a_loss[:, :real_size] * real_mask) / (real_mask.sum() + 1e-6)
+        fake_a_loss = torch.sum(a_loss[:, real_size:] * fake_mask) / (fake_mask.sum() + 1e-6)
         a_loss = (real_a_loss + fake_a_loss) / 2
 
         # compute bc loss
-        bc_loss, _ = self.agent.act_loss(real_obs, real_ctl, real_mask, real_hidden)
-        bc_loss = bc_loss.mean()
+        bc_loss, _ = self.agent.act_loss(obs, ctl, mask, hidden)
+        bc_loss = bc_loss[:real_size].mean()
 
         # compute obs loss
-        real_obs_loss, _ = self.agent.obs_loss(real_obs, real_ctl, real_mask, real_hidden)
-        fake_obs_loss, _ = self.agent.obs_loss(fake_obs, fake_ctl, fake_mask, fake_hidden)
-        obs_loss = (real_obs_loss.mean() + fake_obs_loss.mean()) / 2
+        obs_loss, _ = self.agent.obs_loss(obs, ctl, mask, hidden)
+        obs_loss = (obs_loss[:real_size].mean() + obs_loss[real_size:].mean()) / 2
         return a_loss, bc_loss, obs_loss
 
     def take_gradient_step(self, logger=None):
@@ -406,9 +459,12 @@ class DAC(Model):
         self.update_normalization_stats()
         
         d_loss_epoch = []
-        for i in range(self.d_steps):
+        batches = BatchPrefetcher(
+            self.sample_discriminator_batch, self.d_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for batch in batches:
             # train discriminator
-            d_loss, gp = self.compute_discriminator_loss()
+            d_loss, gp = self.compute_discriminator_loss(batch)
             d_total_loss = d_loss + self.grad_penalty * gp
             d_total_loss.backward()
             if self.grad_clip is not None:
@@ -425,9 +481,13 @@ class DAC(Model):
         actor_loss_epoch = []
         bc_loss_epoch = []
         obs_loss_epoch = []
-        for i in range(self.a_steps):
+        batches = BatchPrefetcher(
+            lambda rng: (self.sample_critic_batch(rng), self.sample_actor_batch(rng)), 
+            self.a_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for critic_batch, actor_batch in batches:
             # train critic
-            critic_loss = self.compute_critic_loss()
+            critic_loss = self.compute_critic_loss(critic_batch)
             critic_loss.backward()
             if self.grad_clip is not None:
                 nn.utils.clip_grad_norm_(self.critic.parameters(), self.grad_clip)
@@ -438,7 +498,7 @@ class DAC(Model):
             critic_loss_epoch.append(critic_loss.data.item())
 
             # train actor
-            actor_loss, bc_loss, obs_loss = self.compute_actor_loss()
+            actor_loss, bc_loss, obs_loss = self.compute_actor_loss(actor_batch)
             actor_total_loss = (
                 actor_loss + self.bc_penalty * bc_loss + self.obs_penalty * obs_loss
             )
@@ -475,11 +535,13 @@ class DAC(Model):
             "actor_loss": np.mean(actor_loss_epoch),
             "bc_loss": np.mean(bc_loss_epoch),
             "obs_loss": np.mean(obs_loss_epoch),
+            "num_steps": self.agent.rnn.compute_num_steps(),
         }
         
         self.discriminator.eval()
         self.critic.eval()
         self.agent.eval()
+        self.ref_agent.clear_cache()
         return stats
 
     def on_epoch_end(self):
@@ -490,6 +552,9 @@ class DAC(Model):
             ):
                 p_target.data = p.data
         
+        # ref agent parameters alias agent storage without sharing version counters
+        self.ref_agent.clear_cache()
+        
         # Update real buffer hidden states on epoch end
         if self.use_state:
             num_samples = min(self.a_batch_size, self.real_buffer.num_eps)
@@ -499,13 +564,14 @@ class DAC(Model):
                 if (i + 1) >= self.real_buffer.num_eps:
                     break
                 
-                obs = self.real_buffer.episodes[i]["obs"]
-                ctl = self.real_buffer.episodes[i]["ctl"]
-                next_obs = self.real_buffer.episodes[i]["next_obs"]
-                next_ctl = self.real_buffer.episodes[i]["next_ctl"]
-                done = self.real_buffer.episodes[i]["done"]
-                rwd = self.real_buffer.episodes[i]["rwd"]
-                absorb = self.real_buffer.episodes[i]["absorb"]
+                episode = self.real_buffer.get_episode(i)
+                obs = episode["obs"]
+                ctl = episode["ctl"]
+                next_obs = episode["next_obs"]
+                next_ctl = episode["next_ctl"]
+                done = episode["done"]
+                rwd = episode["rwd"]
+                absorb = episode["absorb"]
                 
                 # remove absorbing states
                 obs = obs[absorb.flatten() == 0]
@@ -526,4 +592,7 @@ class DAC(Model):
                     [state, _], _ = self.ref_agent(obs_torch.unsqueeze(1), ctl_torch.unsqueeze(1))
                     state = state.squeeze(1).cpu().numpy()
 
-                self.real_buffer.push(obs, ctl, state, rwd, done)
\ No newline at end of file
+                self.real_buffer.push(obs, ctl, state, rwd, done)
+        
+        self.real_buffer.flush()
+        self.replay_buffer.flush()
\ No newline at end of file
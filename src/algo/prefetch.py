@@ -0,0 +1,84 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+def to_device(batch, device):
+    """ Move tensors in nested dicts, tuples, and lists to device """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device)
+    elif isinstance(batch, dict):
+        return {k: to_device(v, device) for k, v in batch.items()}
+    elif isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(v, device) for v in batch)
+    return batch
+
+
+class BatchPrefetcher:
+    """ Iterable over a fixed number of batches sampled ahead on a worker thread.
+
+    The worker calls sample_fn(rng), moves the returned tensors to device, and
+    keeps up to prefetch ready batches in a bounded queue while the consumer
+    computes on the current batch. Batches are sampled synchronously on
+    iteration if prefetch=0. Sampling only draws from rng, so the batch stream
+    is reproducible from its seed regardless of thread timing. State updated by
+    the consumer between steps, such as replay priorities, is read up to
+    prefetch steps late.
+    """
+    def __init__(self, sample_fn, num_batches, prefetch=2, rng=None, device="cpu"):
+        """
+        Args:
+            sample_fn (callable): function mapping a numpy RandomState or the
+                np.random module to a batch of tensors
+            num_batches (int): number of batches to sample
+            prefetch (int, optional): max number of batches sampled ahead. Default=2
+            rng (np.random.RandomState, optional): sampling random state.
+                Global numpy random state if None. Default=None
+            device (str, optional): batch device. Default="cpu"
+        """
+        self.sample_fn = sample_fn
+        self.num_batches = num_batches
+        self.prefetch = prefetch
+        self.rng = np.random if rng is None else rng
+        self.device = device
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        if self.prefetch == 0:
+            for _ in range(self.num_batches):
+                yield to_device(self.sample_fn(self.rng), self.device)
+            return
+
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for _ in range(self.num_batches):
+                    if not put(to_device(self.sample_fn(self.rng), self.device)):
+                        return
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            for _ in range(self.num_batches):
+                batch = batch_queue.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -1,6 +1,12 @@
+import os
+import json
+import threading
+from collections import deque
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
+from src.distributions.mixture_init import iter_obs_batches
+from src.distributions.running_stats import RunningStats
 
 def collate_fn(batch):
     """ Collate batch of dict to have the same sequence length """
@@ -10,6 +16,24 @@ def collate_fn(batch):
     mask = pad_sequence([torch.ones(len(b[keys[0]])) for b in batch])
     return pad_batch, mask
 
+def concat_padded_batches(batches):
+    """ Concatenate padded sequence batches along the batch dimension
+    
+    Args:
+        batches (list): list of (pad_batch, mask) tuples returned by collate_fn
+    
+    Returns:
+        pad_batch (dict): concatenated batch padded to the longest sequence. size=[T, batch_size, dim]
+        mask (torch.tensor): concatenated binary mask. size=[T, batch_size]
+    """
+    max_len = max([mask.shape[0] for _, mask in batches])
+    pad = lambda x: torch.cat([x, x.new_zeros((max_len - len(x),) + x.shape[1:])], dim=0)
+    
+    keys = list(batches[0][0].keys())
+    pad_batch = {k: torch.cat([pad(b[k]) for b, _ in batches], dim=1) for k in keys}
+    mask = torch.cat([pad(m) for _, m in batches], dim=1)
+    return pad_batch, mask
+
 def sample_sequence(seq_len, max_seq_len, gamma=0.):
     """ Sample a segment of the sequence
 
@@ -34,26 +58,162 @@ def sample_sequence(seq_len, max_seq_len, gamma=0.):
     return sample_id
 
 
+class SumTree:
+    """ Binary sum tree over a fixed number of nonnegative leaves. Supports 
+    O(log N) batched leaf updates and proportional sampling by prefix sum search.
+    """
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): number of leaves
+        """
+        self.capacity = capacity
+        self.num_leaves = 1 << int(np.ceil(np.log2(max(capacity, 2))))
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+    
+    def grow(self, capacity):
+        """ Increase the number of leaves keeping leaf values """
+        num_leaves = 1 << int(np.ceil(np.log2(max(capacity, 2))))
+        if num_leaves > self.num_leaves:
+            leaves = self.tree[self.num_leaves:]
+            self.tree = np.zeros(2 * num_leaves)
+            self.tree[num_leaves:num_leaves + len(leaves)] = leaves
+            self.num_leaves = num_leaves
+            
+            # rebuild ancestor sums level by level
+            lo = num_leaves // 2
+            while lo >= 1:
+                self.tree[lo:2 * lo] = self.tree[2 * lo:4 * lo:2] + self.tree[2 * lo + 1:4 * lo:2]
+                lo //= 2
+        self.capacity = max(self.capacity, capacity)
+
+    def get(self, idx):
+        """ Leaf values. size=[batch_size] """
+        return self.tree[np.asarray(idx) + self.num_leaves]
+
+    def update(self, idx, value):
+        """ Set leaf values and update ancestor sums. The last value is kept for duplicate indices
+        
+        Args:
+            idx (np.array): leaf indices. size=[batch_size]
+            value (np.array): leaf values. size=[batch_size]
+        """
+        idx = np.asarray(idx).flatten()
+        value = np.broadcast_to(value, idx.shape)
+        if len(idx) == 0:
+            return
+        _, last = np.unique(idx[::-1], return_index=True)
+        node = idx[::-1][last] + self.num_leaves
+        self.tree[node] = value[::-1][last]
+        while node[0] > 1:
+            node = np.unique(node // 2)
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+    
+    def add(self, idx, delta):
+        """ Add to leaf values accumulating duplicate indices. Results are clipped at zero """
+        idx = np.asarray(idx).flatten()
+        node, inverse = np.unique(idx, return_inverse=True)
+        total_delta = np.zeros(len(node))
+        np.add.at(total_delta, inverse, np.broadcast_to(delta, idx.shape))
+        self.update(node, np.maximum(self.get(node) + total_delta, 0))
+
+    def find(self, value):
+        """ Leaf indices whose prefix sum interval contains value. Zero leaves are never returned
+        
+        Args:
+            value (np.array): prefix sums in [0, total). size=[batch_size]
+
+        Returns:
+            idx (np.array): leaf indices. size=[batch_size]
+        """
+        value = np.asarray(value, dtype=np.float64).copy()
+        node = np.ones(len(value), dtype=np.int64)
+        while node[0] < self.num_leaves:
+            left = 2 * node
+            go_right = (value >= self.tree[left]) & (self.tree[left + 1] > 0)
+            value = np.where(go_right, value - self.tree[left], value)
+            node = np.where(go_right, left + 1, left)
+        return node - self.num_leaves
+
+
 class ReplayBuffer:
-    def __init__(self, obs_dim, ctl_dim, state_dim, max_size, momentum=0.1):
+    """ Episodic replay buffer with compact contiguous storage.
+
+    Each step is stored once per field. Next step fields are gathered by index 
+    offset within the episode, and terminated episodes end with a single 
+    absorbing state row which transitions to itself. Controls are stored as small 
+    integers, done and absorbing flags as bools, and states optionally as float16. 
+    Sampled batches are converted to float32.
+
+    If path is given, fields are stored in memory-mapped .npy files preallocated 
+    to max_size rows. The episode index is written to index.json by flush after 
+    the fields are flushed, so episodes pushed after the last flush are not 
+    visible when reopening. An existing buffer at path is reopened and must 
+    match the dimensions, max_size, and state_dtype of the constructor. Read only 
+    buffers can be shared between processes and cannot be pushed to.
+
+    If priority_alpha > 0, transitions are indexed in a sum tree by storage row 
+    and can be sampled proportional to priority with importance weights. 
+    Episodes are indexed by their first row with priority equal to the mean 
+    transition priority. New transitions get the max priority seen so far. 
+    Priorities are kept in memory and reset to uniform when reopening from path.
+    """
+    def __init__(
+        self, obs_dim, ctl_dim, state_dim, max_size, momentum=0., state_dtype="float32", 
+        path=None, read_only=False, priority_alpha=0., priority_beta=0.4
+        ):
         """
         Args:
             obs_dim (int): observation dimension
             ctl_dim (int): action dimension
             state_dim (int): hidden state dimension
-            max_size (int): maximum buffer size
-            momentum (float): moving stats momentum
+            max_size (int): maximum number of stored steps
+            momentum (float, optional): observation stats decay rate per pushed episode. 
+                Cumulative stats over all pushed episodes if momentum=0. Default=0.
+            state_dtype (str, optional): state storage dtype. choices=["float32", "float16"]. 
+                Default="float32"
+            path (str, optional): storage directory for memory-mapped fields. 
+                Stored in memory if None. Default=None
+            read_only (bool, optional): whether to open an existing buffer at path 
+                read only. Default=False
+            priority_alpha (float, optional): td error priority exponent. 
+                No prioritized sampling if priority_alpha=0. Default=0.
+            priority_beta (float, optional): importance weight exponent. Default=0.4
         """
+        assert state_dtype in ["float32", "float16"]
         self.obs_dim = obs_dim
         self.ctl_dim = ctl_dim
         self.state_dim = state_dim
-
-        self.episodes = []
-        self.eps_len = []
+        self.state_dtype = state_dtype
+        self.dtypes = {
+            "obs": np.float32,
+            "state": np.dtype(state_dtype),
+            "absorb": np.bool_,
+            "ctl": np.uint8 if ctl_dim <= 256 else np.int32,
+            "rwd": np.float32,
+            "done": np.bool_
+        }
+        
+        # contiguous step storage allocated on first push and grown up to max_size
+        self.data = {}
+        self.capacity = 0
+        self.ptr = 0 # circular write pointer
+        
+        # episode offset index in insertion order
+        self.eps_start = deque() # first row
+        self.eps_rows = deque() # number of stored rows
+        self.eps_len = deque() # number of transitions
+        self.eps_len_nt = deque() # number of non terminal transitions
 
         self.num_eps = 0
-        self.size = 0
-        self.max_size = max_size
+        self.size = 0 # number of transitions
+        self.num_rows = 0 # number of stored rows
+        self.max_size = int(max_size)
+        self._index = None # cached episode index arrays
         
         self.obs_eps = [] # store a single episode
         self.ctl_eps = [] # store a single episode
@@ -62,10 +222,35 @@ class ReplayBuffer:
         self.done_eps = [] # store a single episode
         
         self.momentum = momentum
-        self.moving_mean = np.zeros((obs_dim,))
-        self.moving_mean_square = np.zeros((obs_dim,))
-        self.moving_variance = np.ones((obs_dim, ))
-
+        self.obs_stats = RunningStats(momentum)
+        
+        self.priority_alpha = priority_alpha
+        self.priority_beta = priority_beta
+        self.prioritized = priority_alpha > 0
+        self.max_priority = 1.
+        self.priority_lock = threading.Lock()
+        if self.prioritized:
+            self.reset_priorities()
+        
+        self.path = path
+        self.read_only = read_only
+        if path is not None and buffer_exists(path):
+            self.load()
+        elif read_only:
+            raise FileNotFoundError("no replay buffer index found at {}".format(path))
+    
+    @property
+    def moving_mean(self):
+        if self.obs_stats.count == 0:
+            return np.zeros((self.obs_dim,))
+        return self.obs_stats.mean
+    
+    @property
+    def moving_variance(self):
+        if self.obs_stats.count == 0:
+            return np.ones((self.obs_dim,))
+        return self.obs_stats.variance
+    
     def __call__(self, obs, ctl, state, rwd, done=False):
         """ Append episode history """ 
         self.obs_eps.append(obs)
@@ -75,13 +260,23 @@ class ReplayBuffer:
         self.done_eps.append(np.array([int(done)]).reshape(1, 1))
     
     def clear(self):
-        self.episodes = []
-        self.eps_len = []
+        self.check_writable()
+        self.eps_start = deque()
+        self.eps_rows = deque()
+        self.eps_len = deque()
+        self.eps_len_nt = deque()
+        self.ptr = 0
         self.num_eps = 0
         self.size = 0
+        self.num_rows = 0
+        self._index = None
+        if self.prioritized:
+            self.reset_priorities()
+        self.flush()
         
     def push(self, obs=None, ctl=None, state=None, rwd=None, done=None):
         """ Store episode """
+        self.check_writable()
         if obs is None and ctl is None:
             obs = np.vstack(self.obs_eps)
             ctl = np.vstack(self.ctl_eps)
@@ -89,156 +284,420 @@ class ReplayBuffer:
             rwd = np.vstack(self.rwd_eps)
             done = np.vstack(self.done_eps)
         
-        # add absorbing state flag based on done
+        # add a self transitioning absorbing state based on done
+        absorb = np.zeros((len(obs), 1))
         if done[-1] == 1:
-            obs_a = np.zeros((1, obs.shape[1]))
-            ctl_a = np.zeros((1, ctl.shape[1]))
-            state_a = np.zeros((1, state.shape[1]))
-            rwd_a = rwd[-1:]
-            done_a = np.ones((1, 1))
-
-            obs = np.vstack([obs, obs_a, obs_a])
-            ctl = np.vstack([ctl, ctl_a, ctl_a])
-            state = np.vstack([state, state_a, state_a])
-            rwd = np.vstack([rwd, rwd_a, rwd_a])
-            done = np.vstack([done, done_a, done_a])
-
-            absorb = np.zeros((len(obs), 1))
-            absorb[-2:] = 1
+            obs = np.vstack([obs, np.zeros((1, obs.shape[1]))])
+            ctl = np.vstack([ctl, np.zeros((1, ctl.shape[1]))])
+            state = np.vstack([state, np.zeros((1, state.shape[1]))])
+            rwd = np.vstack([rwd, rwd[-1:]])
+            done = np.vstack([done, np.ones((1, 1))])
+            absorb = np.vstack([absorb, np.ones((1, 1))])
+            eps_len = len(obs)
         else:
-            absorb = np.zeros((len(obs), 1))
-        
-        self.episodes.append({ 
-            "obs": obs[:-1],
-            "state": state[:-1],
-            "absorb": absorb[:-1],
-            "ctl": ctl[:-1],
-            "rwd": rwd[:-1],
-            "next_obs": obs[1:],
-            "next_state": state[1:],
-            "next_absorb": absorb[1:],
-            "next_ctl": ctl[1:],
-            "done": done[1:]
-        })
-        self.update_obs_stats(obs)
-        
-        self.eps_len.append(len(self.episodes[-1]["obs"]))
+            eps_len = len(obs) - 1
         
-        self.num_eps += 1
-        self.size += len(self.episodes[-1]["obs"])
-        
-        if self.size > self.max_size:
-            while self.size > self.max_size:
-                self.size -= len(self.episodes[0]["obs"])
-                self.episodes = self.episodes[1:]
-                self.eps_len = self.eps_len[1:]
-                self.num_eps = len(self.eps_len)
+        episode = {
+            "obs": obs,
+            "state": state,
+            "absorb": absorb,
+            "ctl": ctl,
+            "rwd": rwd,
+            "done": done
+        }
+        self.update_obs_stats(obs, 1 - absorb.flatten())
+        self.store_episode(episode, eps_len)
         self.obs_eps = []
         self.ctl_eps = [] 
         self.state_eps = []
         self.rwd_eps = []
         self.done_eps = []
 
-    def sample_random(self, batch_size, prioritize=False):
-        """ sample random steps """ 
-        obs = np.vstack([e["obs"] for e in self.episodes])
-        state = np.vstack([e["state"] for e in self.episodes])
-        absorb = np.vstack([e["absorb"] for e in self.episodes])
-        ctl = np.vstack([e["ctl"] for e in self.episodes])
-        rwd = np.vstack([e["rwd"] for e in self.episodes])
-        next_obs = np.vstack([e["next_obs"] for e in self.episodes])
-        next_state = np.vstack([e["next_state"] for e in self.episodes])
-        next_absorb = np.vstack([e["next_absorb"] for e in self.episodes])
-        next_ctl = np.vstack([e["next_ctl"] for e in self.episodes])
-        done = np.vstack([e["done"] for e in self.episodes])
+    def store_episode(self, episode, eps_len):
+        """ Write episode rows contiguously at the write pointer and evict 
+        the oldest episodes it overwrites or that exceed max_size 
+        
+        Args:
+            episode (dict): per step fields. size=[num_rows, dim]
+            eps_len (int): number of transitions
+        """
+        num_rows = len(episode["obs"])
+        assert num_rows <= self.max_size, "episode longer than buffer size"
+        if self.capacity == 0 and self.path is not None:
+            self.allocate({k: v.shape[1] for k, v in episode.items()})
+        elif self.capacity == 0:
+            self.data = {
+                k: np.zeros((min(self.max_size, 2 * num_rows), v.shape[1]), dtype=self.dtypes[k]) 
+                for k, v in episode.items()
+            }
+            self.capacity = len(self.data["obs"])
+        if self.prioritized:
+            self.grow_priorities(self.capacity)
+        
+        if self.ptr + num_rows > self.capacity:
+            if self.capacity < self.max_size:
+                self.grow(min(self.max_size, max(2 * self.capacity, self.ptr + num_rows)))
+        
+        if self.ptr + num_rows > self.capacity:
+            # drop episodes in the unused tail and wrap around
+            while self.num_eps > 0 and self.eps_start[0] >= self.ptr:
+                self.evict()
+            self.ptr = 0
+        
+        while self.num_eps > 0 and (
+            self.num_rows + num_rows > self.max_size or 
+            (self.eps_start[0] < self.ptr + num_rows and self.eps_start[0] >= self.ptr)
+        ):
+            self.evict()
+
+        for k, v in episode.items():
+            self.data[k][self.ptr:self.ptr+num_rows] = v
+        self.eps_start.append(self.ptr)
+        self.eps_rows.append(num_rows)
+        self.eps_len.append(eps_len)
+        self.eps_len_nt.append(min(eps_len, int(np.sum(episode["done"][1:] == 0))))
+        if self.prioritized:
+            self.index_priorities(self.ptr, num_rows, eps_len, self.max_priority)
+        self.ptr += num_rows
+        self.num_eps += 1
+        self.size += eps_len
+        self.num_rows += num_rows
+        self._index = None
+    
+    def grow(self, capacity):
+        """ Reallocate field storage with a larger capacity """
+        for k, v in self.data.items():
+            new_v = np.zeros((capacity,) + v.shape[1:], dtype=v.dtype)
+            new_v[:self.capacity] = v
+            self.data[k] = new_v
+        self.capacity = capacity
+        if self.prioritized:
+            self.grow_priorities(capacity)
+
+    def allocate(self, dims):
+        """ Create memory-mapped field files with max_size rows """
+        os.makedirs(self.path, exist_ok=True)
+        self.data = {
+            k: np.lib.format.open_memmap(
+                os.path.join(self.path, k + ".npy"), mode="w+", 
+                dtype=self.dtypes[k], shape=(self.max_size, dim)
+            ) for k, dim in dims.items()
+        }
+        self.capacity = self.max_size
+
+    def evict(self):
+        """ Remove the oldest episode """
+        if self.prioritized:
+            self.index_priorities(self.eps_start[0], self.eps_rows[0], 0, 0.)
+        self.eps_start.popleft()
+        self.num_rows -= self.eps_rows.popleft()
+        self.size -= self.eps_len.popleft()
+        self.eps_len_nt.popleft()
+        self.num_eps -= 1
+        self._index = None
+    
+    def gather(self, row, next_row):
+        """ Gather transition fields from step and next step storage indices """
+        batch = {k: v[row] for k, v in self.data.items()}
+        for k in ["obs", "state", "absorb", "ctl"]:
+            batch["next_" + k] = self.data[k][next_row]
+        batch["done"] = self.data["done"][next_row]
+        return batch
+    
+    def episode_index(self):
+        """ Episode offset arrays in insertion order. Cached until the next push or eviction
+
+        Returns:
+            index (dict): arrays with keys ["start", "rows", "len", "len_nt", "end"], 
+                where end is the cumulative number of transitions. size=[num_eps]
+        """
+        if self._index is None:
+            eps_len = np.array(self.eps_len, dtype=np.int64)
+            self._index = {
+                "start": np.array(self.eps_start, dtype=np.int64),
+                "rows": np.array(self.eps_rows, dtype=np.int64),
+                "len": eps_len,
+                "len_nt": np.array(self.eps_len_nt, dtype=np.int64),
+                "end": np.cumsum(eps_len),
+            }
+        return self._index
+
+    def get_episode(self, i):
+        """ Return all transition fields of the i-th stored episode in insertion order """
+        start, num_rows = self.eps_start[i], self.eps_rows[i]
+        t = np.arange(self.eps_len[i])
+        return self.gather(start + t, start + np.minimum(t + 1, num_rows - 1))
+    
+    def sample_step_ids(self, batch_size, prioritize=False, rng=None):
+        """ Sample storage indices of transitions uniformly over stored transitions
+        
+        Returns:
+            row (np.array): step storage indices. size=[batch_size]
+            next_row (np.array): next step storage indices. size=[batch_size]
+        """
+        rng = np.random if rng is None else rng
         
         # prioritize new data for sampling
         if prioritize:
-            idx = np.random.randint(max(0, self.size - batch_size * 100), self.size, size=batch_size)
+            ids = rng.randint(max(0, self.size - batch_size * 100), self.size, size=batch_size)
         else:
-            idx = np.random.randint(0, self.size, size=batch_size)
-        batch = dict(
-            obs=obs[idx], 
-            state=state[idx],
-            absorb=absorb[idx],
-            ctl=ctl[idx], 
-            rwd=rwd[idx], 
-            next_obs=next_obs[idx],
-            next_state=next_state[idx],
-            next_absorb=next_absorb[idx], 
-            next_ctl=next_ctl[idx],
-            done=done[idx]
-        )
+            ids = rng.randint(0, self.size, size=batch_size)
+        
+        # map step ids in insertion order to storage indices
+        index = self.episode_index()
+        eps_len, eps_end = index["len"], index["end"]
+        eps_ids = np.searchsorted(eps_end, ids, side="right")
+        t = ids - (eps_end[eps_ids] - eps_len[eps_ids])
+        start = index["start"][eps_ids]
+        num_rows = index["rows"][eps_ids]
+        return start + t, start + np.minimum(t + 1, num_rows - 1)
+
+    def sample_random(self, batch_size, prioritize=False, proportional=False, rng=None):
+        """ Sample random steps. If proportional and the buffer is prioritized, 
+        steps are sampled proportional to priority and the batch has additional 
+        keys "weight" for importance weights of size=[batch_size, 1] and "idx" 
+        for storage indices passed to update_priorities of size=[batch_size].
+        Samples from rng if given, otherwise from the global numpy random state
+        """ 
+        if proportional and self.prioritized and not prioritize:
+            row, weight = self.sample_proportional(self.step_tree, batch_size, self.size, rng)
+            batch = self.gather(row, self.row_next[row])
+            batch = {k: torch.from_numpy(v).to(torch.float32) for k, v in batch.items()}
+            batch["weight"] = torch.from_numpy(weight).to(torch.float32).view(-1, 1)
+            batch["idx"] = torch.from_numpy(row)
+            return batch
+
+        row, next_row = self.sample_step_ids(batch_size, prioritize, rng)
+        batch = self.gather(row, next_row)
         return {k: torch.from_numpy(v).to(torch.float32) for k, v in batch.items()}
     
-    def sample_episodes(self, batch_size, max_len=200, prioritize=False, sample_terminal=True):
-        """ sample random episodes """
-        if prioritize:
-            idx = np.random.randint(max(0, self.num_eps - batch_size * 5), self.num_eps, size=batch_size)
+    def sample_proportional(self, tree, batch_size, num_items, rng=None):
+        """ Sample leaves proportional to value with stratified prefix sums 
+        
+        Returns:
+            idx (np.array): leaf indices. size=[batch_size]
+            weight (np.array): importance weights normalized by the batch max. size=[batch_size]
+        """
+        rng = np.random if rng is None else rng
+        u = rng.uniform(size=batch_size)
+        with self.priority_lock:
+            total = tree.total
+            value = (np.arange(batch_size) + u) * total / batch_size
+            idx = tree.find(np.minimum(value, total * (1 - 1e-12)))
+            weight = (num_items * tree.get(idx) / total) ** -self.priority_beta
+        return idx, weight / weight.max()
+
+    def update_priorities(self, idx, td_error):
+        """ Set transition priorities from absolute td errors 
+        
+        Args:
+            idx (torch.tensor): storage indices from sample_random. size=[batch_size]
+            td_error (torch.tensor): td errors. size=[batch_size, 1]
+        """
+        idx = torch.as_tensor(idx).cpu().numpy().flatten()
+        td_error = torch.as_tensor(td_error).cpu().numpy().astype(np.float64).flatten()
+        priority = (np.abs(td_error) + 1e-6) ** self.priority_alpha
+        
+        with self.priority_lock:
+            # skip transitions evicted since sampling
+            keep = self.step_tree.get(idx) > 0
+            idx, priority = idx[keep], priority[keep]
+            _, last = np.unique(idx[::-1], return_index=True)
+            idx, priority = idx[::-1][last], priority[::-1][last]
+            if len(idx) == 0:
+                return
+            
+            start = self.row_start[idx]
+            delta = (priority - self.step_tree.get(idx)) / self.start_len[start]
+            self.step_tree.update(idx, priority)
+            self.eps_tree.add(start, delta)
+            self.max_priority = max(self.max_priority, priority.max())
+    
+    def reset_priorities(self):
+        """ Allocate priority indices over the storage capacity and set all stored 
+        transitions to the max priority """
+        self.step_tree = SumTree(self.capacity)
+        self.eps_tree = SumTree(self.capacity)
+        self.row_start = np.zeros(self.capacity, dtype=np.int32) # first row of the episode of each row
+        self.row_next = np.zeros(self.capacity, dtype=np.int32) # next step row of each row
+        self.start_len = np.ones(self.capacity, dtype=np.int32) # number of transitions by first row
+        for start, num_rows, eps_len in zip(self.eps_start, self.eps_rows, self.eps_len):
+            self.index_priorities(start, num_rows, eps_len, self.max_priority)
+    
+    def grow_priorities(self, capacity):
+        """ Grow priority indices with the storage capacity keeping existing priorities """
+        if capacity <= len(self.row_start):
+            return
+        with self.priority_lock:
+            self.step_tree.grow(capacity)
+            self.eps_tree.grow(capacity)
+            pad = capacity - len(self.row_start)
+            self.row_start = np.concatenate([self.row_start, np.zeros(pad, dtype=np.int32)])
+            self.row_next = np.concatenate([self.row_next, np.zeros(pad, dtype=np.int32)])
+            self.start_len = np.concatenate([self.start_len, np.ones(pad, dtype=np.int32)])
+
+    def index_priorities(self, start, num_rows, eps_len, priority):
+        """ Set the priority of all transitions of an episode and its row index """
+        rows = np.arange(start, start + num_rows)
+        t = rows - start
+        self.row_start[rows] = start
+        self.row_next[rows] = start + np.minimum(t + 1, num_rows - 1)
+        self.start_len[start] = max(eps_len, 1)
+        self.step_tree.update(rows, np.where(t < eps_len, priority, 0.))
+        self.eps_tree.update([start], priority if eps_len > 0 else 0.)
+
+    def sample_episodes(
+        self, batch_size, max_len=200, prioritize=False, sample_terminal=True, proportional=False, 
+        rng=None
+        ):
+        """ Sample random episode windows. Window starts are sampled uniformly and all 
+        fields are gathered into padded tensors with a single index per field
+
+        Args:
+            batch_size (int): number of episodes
+            max_len (int, optional): max window length. Default=200
+            prioritize (bool, optional): whether to sample from the newest episodes. Default=False
+            sample_terminal (bool, optional): whether to include transitions into done states. 
+                Done transitions are assumed to be at the end of episodes. Default=True
+            proportional (bool, optional): whether to sample episodes proportional to their 
+                mean transition priority if the buffer is prioritized. Importance weights are 
+                returned in pad_batch["weight"]. Default=False
+            rng (np.random.RandomState, optional): random state. Global numpy random 
+                state if None. Default=None
+
+        Returns:
+            pad_batch (dict): padded transition fields. size=[T, batch_size, dim]
+            mask (torch.tensor): binary mask. size=[T, batch_size]
+        """
+        rng = np.random if rng is None else rng
+        index = self.episode_index()
+        weight = None
+        if proportional and self.prioritized and not prioritize:
+            start, weight = self.sample_proportional(self.eps_tree, batch_size, self.num_eps, rng)
+            eps_start = index["start"]
+            order = np.argsort(eps_start)
+            idx = order[np.searchsorted(eps_start[order], start)]
+        elif prioritize:
+            idx = rng.randint(max(0, self.num_eps - batch_size * 5), self.num_eps, size=batch_size)
         else:
-            idx = np.random.randint(0, self.num_eps, size=batch_size)
-        
-        batch = []
-        for i in idx:
-            obs = torch.from_numpy(self.episodes[i]["obs"]).to(torch.float32)
-            state = torch.from_numpy(self.episodes[i]["state"]).to(torch.float32)
-            absorb = torch.from_numpy(self.episodes[i]["absorb"]).to(torch.float32)
-            ctl = torch.from_numpy(self.episodes[i]["ctl"]).to(torch.float32)
-            rwd = torch.from_numpy(self.episodes[i]["rwd"]).to(torch.float32)
-            next_obs = torch.from_numpy(self.episodes[i]["next_obs"]).to(torch.float32)
-            next_state = torch.from_numpy(self.episodes[i]["next_state"]).to(torch.float32)
-            next_absorb = torch.from_numpy(self.episodes[i]["next_absorb"]).to(torch.float32)
-            next_ctl = torch.from_numpy(self.episodes[i]["next_ctl"]).to(torch.float32)
-            done = torch.from_numpy(self.episodes[i]["done"]).to(torch.float32)
-
-            if not sample_terminal:
-                obs = obs[done.flatten() == 0]
-                state = state[done.flatten() == 0]
-                absorb = absorb[done.flatten() == 0]
-                ctl = ctl[done.flatten() == 0]
-                rwd = rwd[done.flatten() == 0]
-                next_obs = next_obs[done.flatten() == 0]
-                next_state = next_state[done.flatten() == 0]
-                next_absorb = next_absorb[done.flatten() == 0]
-                next_ctl = next_ctl[done.flatten() == 0]
-                done = done[done.flatten() == 0]
-
-            # truncate sequence
-            sample_ids = sample_sequence(len(obs), max_len, gamma=0.)
-            obs = obs[sample_ids]
-            state = state[sample_ids]
-            absorb = absorb[sample_ids]
-            ctl = ctl[sample_ids]
-            rwd = rwd[sample_ids]
-            next_obs = next_obs[sample_ids]
-            next_state = next_state[sample_ids]
-            next_absorb = next_absorb[sample_ids]
-            next_ctl = next_ctl[sample_ids]
-            done = done[sample_ids]
-
-            batch.append({
-                "obs": obs, 
-                "state": state,
-                "absorb": absorb,
-                "ctl": ctl, 
-                "rwd": rwd, 
-                "next_obs": next_obs,
-                "next_state": next_state,
-                "next_absorb": next_absorb, 
-                "next_ctl": next_ctl,
-                "done": done
-            })
-        
-        out = collate_fn(batch)
-        return out
-        
-    def update_obs_stats(self, obs):
-        batch_size = len(obs)
-        
-        moving_mean = (self.moving_mean * self.size + np.sum(obs, axis=0)) / (self.size + batch_size)
-        moving_mean_square = (self.moving_mean_square * self.size + np.sum(obs**2, axis=0)) / (self.size + batch_size)
-        moving_variance = moving_mean_square - moving_mean**2
-
-        self.moving_mean = self.moving_mean * (1 - self.momentum) + moving_mean * self.momentum
-        self.moving_mean_square = self.moving_mean_square * (1 - self.momentum) + moving_mean_square * self.momentum
-        self.moving_variance = self.moving_variance * (1 - self.momentum) + moving_variance * self.momentum 
+            idx = rng.randint(0, self.num_eps, size=batch_size)
+        
+        eps_len = index["len" if sample_terminal else "len_nt"][idx]
+        eps_start = index["start"][idx]
+        eps_rows = index["rows"][idx]
+        
+        # truncate sequence
+        win_start = rng.randint(0, np.maximum(eps_len - max_len, 1))
+        win_len = np.minimum(eps_len, max_len)
+        
+        t = np.arange(win_len.max()).reshape(-1, 1)
+        mask = t < win_len
+        step = np.where(mask, win_start + t, 0)
+        row = eps_start + step
+        next_row = eps_start + np.minimum(step + 1, eps_rows - 1)
+        
+        batch = self.gather(row, next_row)
+        mask = torch.from_numpy(mask).to(torch.float32)
+        pad_batch = {
+            k: torch.from_numpy(v).to(torch.float32) * mask.unsqueeze(-1) for k, v in batch.items()
+        }
+        if weight is not None:
+            weight = torch.from_numpy(weight).to(torch.float32).view(1, -1, 1)
+            pad_batch["weight"] = weight * mask.unsqueeze(-1)
+        return pad_batch, mask
+        
+    def iter_obs(self, batch_size=1000):
+        """ Stream stored non-absorbing observations in fixed size batches. 
+        Episode rows are sliced from storage lazily as batches are consumed """
+        def iter_episodes():
+            for start, eps_len in zip(list(self.eps_start), list(self.eps_len)):
+                obs = self.data["obs"][start:start+eps_len]
+                absorb = self.data["absorb"][start:start+eps_len]
+                yield obs[absorb.flatten() == 0]
+        return iter_obs_batches(iter_episodes(), batch_size)
+
+    def update_obs_stats(self, obs, mask=None):
+        """ Update moving observation stats with an optional binary mask over steps """
+        self.obs_stats.update(obs, mask)
+    
+    def check_writable(self):
+        if self.read_only:
+            raise RuntimeError("cannot modify read only replay buffer at {}".format(self.path))
+
+    def flush(self):
+        """ Flush memory-mapped fields and write the episode index """
+        if self.path is None or self.read_only:
+            return
+        for v in self.data.values():
+            v.flush()
+        self.save_index()
+
+    def save_index(self):
+        """ Atomically write the episode index and moving stats to index.json """
+        to_list = lambda x: np.asarray(x, dtype=np.float64).tolist()
+        index = {
+            "obs_dim": self.obs_dim,
+            "ctl_dim": self.ctl_dim,
+            "state_dim": self.state_dim,
+            "state_dtype": self.state_dtype,
+            "max_size": self.max_size,
+            "fields": list(self.data.keys()),
+            "ptr": self.ptr,
+            "num_eps": self.num_eps,
+            "size": self.size,
+            "eps_start": list(self.eps_start),
+            "eps_rows": list(self.eps_rows),
+            "eps_len": list(self.eps_len),
+            "eps_len_nt": list(self.eps_len_nt),
+            "obs_stats": {
+                "count": float(self.obs_stats.count),
+                "mean": to_list(self.obs_stats.mean),
+                "m2": to_list(self.obs_stats.m2),
+            }
+        }
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, "index.json"))
+
+    def load(self):
+        """ Reopen memory-mapped fields and the episode index from path """
+        with open(os.path.join(self.path, "index.json"), "r") as f:
+            index = json.load(f)
+        
+        for key in ["obs_dim", "ctl_dim", "state_dim", "max_size", "state_dtype"]:
+            if index[key] != getattr(self, key):
+                raise ValueError("replay buffer at {} has {}={}, expected {}".format(
+                    self.path, key, index[key], getattr(self, key)
+                ))
+        
+        mode = "r" if self.read_only else "r+"
+        self.data = {
+            k: np.load(os.path.join(self.path, k + ".npy"), mmap_mode=mode) 
+            for k in index["fields"]
+        }
+        self.capacity = self.max_size if len(self.data) > 0 else 0
+        
+        self.ptr = index["ptr"]
+        self.num_eps = index["num_eps"]
+        self.size = index["size"]
+        self.eps_start = deque(index["eps_start"])
+        self.eps_rows = deque(index["eps_rows"])
+        self.eps_len = deque(index["eps_len"])
+        self.eps_len_nt = deque(index["eps_len_nt"])
+        self.num_rows = sum(self.eps_rows)
+        self._index = None
+        
+        obs_stats = index["obs_stats"]
+        self.obs_stats.count = obs_stats["count"]
+        self.obs_stats.mean = np.array(obs_stats["mean"])
+        self.obs_stats.m2 = np.array(obs_stats["m2"])
+        
+        if self.prioritized:
+            self.reset_priorities()
+
+
+def buffer_exists(path):
+    """ Whether a memory-mapped replay buffer index exists at path """
+    return os.path.exists(os.path.join(path, "index.json"))
@@ -1,56 +1,117 @@
+import warnings
 from copy import deepcopy
 import numpy as np
 import torch
 import torch.nn as nn
 from src.distributions.nn_models import Model
-from src.distributions.nn_models import MLP
+from src.distributions.nn_models import EnsembleMLP
 from src.algo.replay_buffer import ReplayBuffer
+from src.algo.prefetch import BatchPrefetcher
 from src.distributions.utils import kl_divergence
 
 class DoubleQNetwork(Model):
-    """ Double Q network for discrete actions and fully observable use """
-    def __init__(self, obs_dim, act_dim, hidden_dim, num_hidden, activation="silu"):
+    """ Ensemble Q network for discrete actions and fully observable use. 
+    All critics are evaluated in a single batched pass """
+    def __init__(
+        self, obs_dim, act_dim, hidden_dim, num_hidden, activation="silu", 
+        num_critics=2, reduce="min", subset_size=2
+        ):
+        """
+        Args:
+            obs_dim (int): input dimension
+            act_dim (int): action dimension
+            hidden_dim (int): hidden dimension
+            num_hidden (int): number of hidden layers
+            activation (str, optional): activation. Default="silu"
+            num_critics (int, optional): number of critics. Default=2
+            reduce (str, optional): critic reduction method. choices=["min", "mean", "subset"].
+                subset takes the min over a random subset of critics. Default="min"
+            subset_size (int, optional): subset size for subset reduction. Default=2
+        """
         super().__init__()
+        assert reduce in ["min", "mean", "subset"]
         self.obs_dim = obs_dim
         self.act_dim = act_dim
+        self.num_critics = num_critics
+        self.reduce = reduce
+        self.subset_size = min(subset_size, num_critics)
 
-        self.q1 = MLP(
-            input_dim=obs_dim,
-            output_dim=act_dim,
-            hidden_dim=hidden_dim,
-            num_hidden=num_hidden,
-            activation=activation,
-            batch_norm=False
-        )
-        self.q2 = MLP(
+        self.q = EnsembleMLP(
+            num_members=num_critics,
             input_dim=obs_dim,
             output_dim=act_dim,
             hidden_dim=hidden_dim,
             num_hidden=num_hidden,
-            activation=activation,
-            batch_norm=False
+            activation=activation
         )
     
     def __repr__(self):
-        s = "{}(input_dim={}, hidden_dim={}, num_hidden={}, activation={})".format(
-            self.__class__.__name__, self.obs_dim, self.q1.hidden_dim, 
-            self.q1.num_hidden, self.q1.activation
+        s = "{}(input_dim={}, hidden_dim={}, num_hidden={}, activation={}, num_critics={}, reduce={})".format(
+            self.__class__.__name__, self.obs_dim, self.q.hidden_dim, 
+            self.q.num_hidden, self.q.activation, self.num_critics, self.reduce
         )
         return s
+    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # stack separate q1 and q2 mlp weights from older checkpoints
+        keys = [k for k in list(state_dict.keys()) if k.startswith(prefix + "q1.")]
+        for k in keys:
+            name = k[len(prefix + "q1."):]
+            w1 = state_dict.pop(k)
+            w2 = state_dict.pop(prefix + "q2." + name)
+            if name.endswith("weight"):
+                state_dict[prefix + "q." + name] = torch.stack([w1.T, w2.T])
+            else:
+                state_dict[prefix + "q." + name] = torch.stack([w1, w2]).unsqueeze(-2)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, o):
-        """ Compute q1 and q2 values
+        """ Compute q values of all critics
         
         Args:
-            o (torch.tensor): observation. size=[batch_size, obs_dim]
+            o (torch.tensor): observation. size=[..., obs_dim]
 
         Returns:
-            q1 (torch.tensor): q1 value. size=[batch_size, 1]
-            q2 (torch.tensor): q2 value. size=[batch_size, 1]
+            q (torch.tensor): q values. size=[num_critics, ..., act_dim]
         """
-        q1 = self.q1(o)
-        q2 = self.q2(o)
-        return q1, q2
+        return self.q(o)
+    
+    def reduce_q(self, q):
+        """ Reduce q values over critics 
+        
+        Args:
+            q (torch.tensor): q values. size=[num_critics, ..., act_dim]
+
+        Returns:
+            q (torch.tensor): reduced q values. size=[..., act_dim]
+        """
+        if self.reduce == "mean":
+            return q.mean(0)
+        elif self.reduce == "subset":
+            idx = torch.randperm(self.num_critics)[:self.subset_size].to(q.device)
+            q = q[idx]
+        return q.min(0)[0]
+    
+    def compute_loss(self, q, ctl, q_target, weight=None):
+        """ Mean squared td error averaged over critics
+        
+        Args:
+            q (torch.tensor): q values. size=[num_critics, batch_size, act_dim]
+            ctl (torch.tensor): controls. size=[batch_size, 1]
+            q_target (torch.tensor): q target. size=[batch_size, 1]
+            weight (torch.tensor, optional): importance weights. size=[batch_size, 1]. Default=None
+
+        Returns:
+            q_loss (torch.tensor): loss
+            td_error (torch.tensor): detached td error averaged over critics. size=[batch_size, 1]
+        """
+        q = torch.gather(q, -1, ctl.long().expand(self.num_critics, -1, -1))
+        td_error = q - q_target
+        if weight is None:
+            q_loss = torch.pow(td_error, 2).mean()
+        else:
+            q_loss = (weight * torch.pow(td_error, 2)).mean()
+        return q_loss, td_error.mean(0).detach()
 
 
 class SAC(Model):
@@ -60,7 +121,9 @@ class SAC(Model):
         gamma=0.9, beta=0.2, polyak=0.995, norm_obs=False,
         buffer_size=int(1e6), batch_size=100, a_batch_size=32, 
         rnn_len=10, a_steps=50, 
-        lr_a=1e-3, lr_c=1e-3, decay=0, grad_clip=None, obs_penalty=1.
+        lr_a=1e-3, lr_c=1e-3, decay=0, grad_clip=None, obs_penalty=1.,
+        num_critics=2, critic_reduce="min", priority_alpha=0., priority_beta=0.4,
+        prefetch=0, sample_seed=None
         ):
         """
         Args:
@@ -78,6 +141,17 @@ class SAC(Model):
             lr_c (float, optional): critic learning rate. Default=1e-3
             decay (float, optional): weight decay. Default=0
             grad_clip (float, optional): gradient clipping. Default=None
+            num_critics (int, optional): number of ensemble critics. Default=2
+            critic_reduce (str, optional): critic ensemble reduction. 
+                choices=["min", "mean", "subset"]. Default="min"
+            priority_alpha (float, optional): replay buffer td error priority exponent for 
+                critic sampling. Uniform sampling if priority_alpha=0. Default=0.
+            priority_beta (float, optional): replay buffer importance weight exponent. Default=0.4
+            prefetch (int, optional): number of batches sampled ahead on a background thread. 
+                Batches are sampled synchronously if prefetch=0. With priority_alpha > 0, prefetched 
+                batches are drawn from priorities up to prefetch steps old. Default=0
+            sample_seed (int, optional): replay sampling random seed. 
+                Global numpy random state is used if None. Default=None
         """
         super().__init__()
         self.gamma = gamma
@@ -93,11 +167,19 @@ class SAC(Model):
         self.decay = decay
         self.grad_clip = grad_clip
         self.obs_penalty = obs_penalty
+        self.prefetch = prefetch
+        self.sample_rng = None if sample_seed is None else np.random.RandomState(sample_seed)
+        if prefetch > 0 and priority_alpha > 0:
+            warnings.warn(
+                "prefetch > 0 with priority_alpha > 0 samples from priorities up to "
+                f"{prefetch} steps stale"
+            )
 
         self.agent = agent
 
         self.critic = DoubleQNetwork(
-            agent.state_dim + agent.obs_dim, agent.act_dim, hidden_dim, num_hidden, activation
+            agent.state_dim + agent.obs_dim, agent.act_dim, hidden_dim, num_hidden, activation,
+            num_critics=num_critics, reduce=critic_reduce
         )
         self.critic_target = deepcopy(self.critic)
 
@@ -111,7 +193,10 @@ class SAC(Model):
         self.actor_optimizer = torch.optim.Adam(
             self.agent.parameters(), lr=lr_a, weight_decay=decay
         )
-        self.replay_buffer = ReplayBuffer(agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size)
+        self.replay_buffer = ReplayBuffer(
+            agent.obs_dim, agent.act_dim, agent.state_dim, buffer_size, 
+            priority_alpha=priority_alpha, priority_beta=priority_beta
+        )
         
         self.obs_mean = nn.Parameter(torch.zeros(agent.obs_dim), requires_grad=False)
         self.obs_variance = nn.Parameter(torch.ones(agent.obs_dim), requires_grad=False)
@@ -155,8 +240,18 @@ class SAC(Model):
             ctl = self.agent.choose_action(obs)
         return ctl.squeeze(0).numpy()
 
-    def compute_critic_loss(self):
-        batch = self.replay_buffer.sample_random(self.batch_size)
+    def sample_critic_batch(self, rng=None):
+        return self.replay_buffer.sample_random(self.batch_size, proportional=True, rng=rng)
+    
+    def sample_actor_batch(self, rng=None):
+        """ Sample episode batches for actor and observation losses """
+        actor_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, rng=rng)
+        obs_batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False, rng=rng)
+        return actor_batch, obs_batch
+
+    def compute_critic_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_critic_batch()
         state = batch["state"]
         obs = batch["obs"]
         ctl = batch["ctl"]
@@ -171,21 +266,20 @@ class SAC(Model):
         
         with torch.no_grad():    
             # compute value target
-            q1_next, q2_next = self.critic_target(torch.cat([next_state, next_obs_norm], dim=-1))
-            q_next = torch.min(q1_next, q2_next)
+            q_next = self.critic_target.reduce_q(self.critic_target(torch.cat([next_state, next_obs_norm], dim=-1)))
             v_next = torch.logsumexp(q_next / self.beta, dim=-1, keepdim=True) * self.beta
             q_target = r + (1 - done) * self.gamma * v_next
         
-        q1, q2 = self.critic(torch.cat([state, obs_norm], dim=-1))
-        q1 = torch.gather(q1, -1, ctl.long())
-        q2 = torch.gather(q2, -1, ctl.long())
-        q1_loss = torch.pow(q1 - q_target, 2).mean()
-        q2_loss = torch.pow(q2 - q_target, 2).mean()
-        q_loss = (q1_loss + q2_loss) / 2
+        q = self.critic(torch.cat([state, obs_norm], dim=-1))
+        weight = batch["weight"].to(self.device) if "weight" in batch else None
+        q_loss, td_error = self.critic.compute_loss(q, ctl, q_target, weight)
+        if "idx" in batch:
+            self.replay_buffer.update_priorities(batch["idx"], td_error)
         return q_loss
 
-    def compute_actor_loss(self):
-        batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False)
+    def compute_actor_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_actor_batch()[0]
         pad_batch, mask = batch
         state = pad_batch["state"].to(self.device)
         obs = pad_batch["obs"].to(self.device)
@@ -197,21 +291,21 @@ class SAC(Model):
 
         [_, alpha_a], _ = self.agent(obs, ctl)
         
-        q1, q2 = self.critic(torch.cat([state, obs_norm], dim=-1))
-        q = torch.min(q1, q2)
+        q = self.critic.reduce_q(self.critic(torch.cat([state, obs_norm], dim=-1)))
         a_target = torch.softmax(q / self.beta, dim=-1)
         a_loss = kl_divergence(alpha_a, a_target)#.mean()
         a_loss = torch.sum(a_loss * mask) / (mask.sum() + 1e-6)
         return a_loss
     
-    def compute_obs_loss(self):
-        batch = self.replay_buffer.sample_episodes(self.a_batch_size, self.rnn_len, prioritize=False)
+    def compute_obs_loss(self, batch=None):
+        if batch is None:
+            batch = self.sample_actor_batch()[1]
         pad_batch, mask = batch
         obs = pad_batch["obs"].to(self.device)
         ctl = pad_batch["ctl"].to(self.device)
         
-        out = self.agent(obs, ctl)
-        obs_loss, _ = self.agent.obs_loss(obs, ctl, mask, out)
+        _, hidden = self.agent(obs, ctl)
+        obs_loss, _ = self.agent.obs_loss(obs, ctl, mask, hidden)
         obs_loss = obs_loss.mean()
         return obs_loss
 
@@ -223,9 +317,13 @@ class SAC(Model):
         critic_loss_epoch = []
         actor_loss_epoch = []
         obs_loss_epoch = []
-        for i in range(self.a_steps):
+        batches = BatchPrefetcher(
+            lambda rng: (self.sample_critic_batch(rng), self.sample_actor_batch(rng)), 
+            self.a_steps, self.prefetch, self.sample_rng, self.device
+        )
+        for critic_batch, (actor_batch, obs_batch) in batches:
             # train critic
-            critic_loss = self.compute_critic_loss()
+            critic_loss = self.compute_critic_loss(critic_batch)
             critic_loss.backward()
             if self.grad_clip is not None:
                 nn.utils.clip_grad_norm_(self.critic.parameters(), self.grad_clip)
@@ -236,8 +334,8 @@ class SAC(Model):
             critic_loss_epoch.append(critic_loss.data.item())
 
             # train actor
-            actor_loss = self.compute_actor_loss()
-            obs_loss = self.compute_obs_loss()
+            actor_loss = self.compute_actor_loss(actor_batch)
+            obs_loss = self.compute_obs_loss(obs_batch)
             actor_total_loss = actor_loss + self.obs_penalty * obs_loss
             actor_total_loss.backward()
             if self.grad_clip is not None:
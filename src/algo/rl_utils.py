@@ -70,7 +70,7 @@ def train(
         eps_return += reward
         eps_len += 1
         
-        state = model.ref_agent._b.cpu().data.numpy()
+        state = model.ref_agent.get_belief().cpu().data.numpy()
         model.replay_buffer(obs, ctl, state, reward, done)
         obs = next_obs
         done = next_done
@@ -79,7 +79,7 @@ def train(
         if done or (eps_len + 1) >= max_steps:
             # collect terminal step
             ctl = model.choose_action(obs)
-            state = model.ref_agent._b.cpu().data.numpy()
+            state = model.ref_agent.get_belief().cpu().data.numpy()
             model.replay_buffer(obs, ctl, state, reward, done)
 
             model.replay_buffer.push()
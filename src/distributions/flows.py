@@ -3,6 +3,7 @@ import torch.nn as nn
 from torch.distributions import constraints
 from torch.distributions.transformed_distribution import TransformedDistribution
 from pyro.distributions.torch_transform import TransformModule
+from src.distributions.running_stats import RunningStats
 
 class SimpleTransformedModule(TransformedDistribution):
     """ Subclass of torch TransformedDistribution with mean, variance, entropy 
@@ -25,7 +26,7 @@ class SimpleTransformedModule(TransformedDistribution):
         variance = self.base_dist.variance
         for transform in self.transforms:
             if transform.__class__.__name__ == "BatchNormTransform":
-                variance *= transform.moving_variance / transform.constrained_gamma**2
+                variance = variance * transform.moving_variance / transform.constrained_gamma**2
             else:
                 raise NotImplementedError
         return variance
@@ -35,7 +36,7 @@ class SimpleTransformedModule(TransformedDistribution):
         for transform in self.transforms:
             if transform.__class__.__name__ == "BatchNormTransform":
                 scale = torch.sqrt(transform.moving_variance) / transform.constrained_gamma
-                entropy += torch.log(scale).sum()
+                entropy = entropy + torch.log(scale).sum()
             else:
                 raise NotImplementedError
         return entropy
@@ -74,12 +75,10 @@ class BatchNormTransform(TransformModule):
         ) + self.moving_mean
             
     def _inverse(self, y):
-        op_dims = [i for i in range(len(y.shape) - 1)]
-        
         if self.training and self.update_stats:
-            mask = 1. - 1. * torch.all(y == 0, dim=-1, keepdim=True)
-            mean = torch.sum(mask * y, dim=op_dims) / (mask.sum(op_dims) + 1e-6)
-            var = torch.sum(mask * (y - mean)**2, dim=op_dims) / (mask.sum(op_dims) + 1e-6)
+            mask = 1. - 1. * torch.all(y == 0, dim=-1)
+            stats = RunningStats().update(y, mask)
+            mean, var = stats.mean, stats.variance
             with torch.no_grad():
                 self.moving_mean.mul_(1 - self.momentum).add_(mean * self.momentum)
                 self.moving_variance.mul_(1 - self.momentum).add_(var * self.momentum)
@@ -90,11 +89,9 @@ class BatchNormTransform(TransformModule):
         ) + self.beta
     
     def log_abs_det_jacobian(self, x, y):
-        op_dims = [i for i in range(len(y.shape) - 1)]
         if self.training and self.update_stats:
-            mask = 1. - 1. * torch.all(y == 0, dim=-1, keepdim=True)
-            mean = torch.sum(mask * y, dim=op_dims, keepdim=True) / (mask.sum(op_dims) + 1e-6)
-            var = torch.sum(mask * (y - mean)**2, dim=op_dims, keepdim=True) / (mask.sum(op_dims) + 1e-6)
+            mask = 1. - 1. * torch.all(y == 0, dim=-1)
+            var = RunningStats().update(y, mask).variance
         else:
             var = self.moving_variance
         return -self.constrained_gamma.log() + 0.5 * torch.log(var + self.epsilon)
\ No newline at end of file
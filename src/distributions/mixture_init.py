@@ -0,0 +1,187 @@
+import numpy as np
+import torch
+import torch.distributions as torch_dist
+
+def iter_obs_batches(obs_list, batch_size=1000):
+    """ Stream observations from a list of sequences in fixed size batches
+
+    Args:
+        obs_list (list): list of observation sequences. size=[seq_len, obs_dim]
+        batch_size (int, optional): number of observations per batch. Default=1000
+
+    Yields:
+        obs (torch.tensor): observation batch. size=[batch_size, obs_dim]
+    """
+    chunks, size = [], 0
+    for obs in obs_list:
+        chunks.append(torch.as_tensor(np.asarray(obs), dtype=torch.float32))
+        size += len(chunks[-1])
+        while size >= batch_size:
+            obs_cat = torch.cat(chunks, dim=0)
+            yield obs_cat[:batch_size]
+            chunks, size = [obs_cat[batch_size:]], size - batch_size
+    if size > 0:
+        yield torch.cat(chunks, dim=0)
+
+def restrict_covariance(cov, cov_type, reg=1e-3):
+    """ Restrict full covariances to the covariance type and add diagonal regularization
+
+    Args:
+        cov (torch.tensor): full covariances. size=[z_dim, x_dim, x_dim]
+        cov_type (str): covariance type ["diag", "full", "tied"]
+        reg (float, optional): diagonal regularization. Default=1e-3
+
+    Returns:
+        cov (torch.tensor): restricted covariances. size=[z_dim, x_dim, x_dim]
+    """
+    if cov_type != "full":
+        var = torch.diagonal(cov, dim1=-2, dim2=-1)
+        if cov_type == "tied":
+            var = var.mean(0, keepdim=True).expand_as(var)
+        cov = torch.diag_embed(var)
+    return cov + reg * torch.eye(cov.shape[-1]).to(cov.device)
+
+def minibatch_kmeans(make_batches, num_clusters, num_epochs=1, seed=0):
+    """ Mini-batch k-means with per cluster learning rates
+
+    Args:
+        make_batches (callable): function returning a new iterator over data batches.
+            size=[batch_size, x_dim]
+        num_clusters (int): number of clusters
+        num_epochs (int, optional): number of passes over the data. Default=1
+        seed (int, optional): random seed for choosing initial centers. Default=0
+
+    Returns:
+        centers (torch.tensor): cluster centers. size=[num_clusters, x_dim]
+    """
+    # choose initial centers from the first batches
+    rng = np.random.RandomState(seed)
+    chunks, size = [], 0
+    for x in make_batches():
+        chunks.append(x)
+        size += len(x)
+        if size >= num_clusters:
+            break
+    x = torch.cat(chunks, dim=0)
+    assert len(x) >= num_clusters, "fewer observations than clusters"
+    centers = x[rng.choice(len(x), num_clusters, replace=False)].clone()
+
+    counts = torch.zeros(num_clusters).to(x.device)
+    for _ in range(num_epochs):
+        for x in make_batches():
+            assign = torch.cdist(x, centers).argmin(-1)
+            onehot = torch.nn.functional.one_hot(assign, num_clusters).to(x.dtype)
+            n = onehot.sum(0)
+            counts += n
+
+            # move centers towards the running mean of assigned points
+            lr = (n / counts.clip(min=1)).unsqueeze(-1)
+            batch_mean = onehot.T.matmul(x) / n.clip(min=1).unsqueeze(-1)
+            centers = centers + lr * (batch_mean - centers)
+    return centers
+
+def accumulate_stats(make_batches, log_prob_fn):
+    """ Accumulate soft assignment sufficient statistics over a data stream
+
+    Args:
+        make_batches (callable): function returning a new iterator over data batches.
+            size=[batch_size, x_dim]
+        log_prob_fn (callable): function mapping a data batch to unnormalized
+            component log probabilities. size=[batch_size, z_dim]
+
+    Returns:
+        n (torch.tensor): component weights. size=[z_dim]
+        s (torch.tensor): weighted sums. size=[z_dim, x_dim]
+        ss (torch.tensor): weighted outer product sums. size=[z_dim, x_dim, x_dim]
+        log_likelihood (float): average data log likelihood
+    """
+    n, s, ss, log_likelihood, num_obs = 0, 0, 0, 0, 0
+    for x in make_batches():
+        logp = log_prob_fn(x)
+        r = torch.softmax(logp, dim=-1)
+        n = n + r.sum(0)
+        s = s + r.T.matmul(x)
+        ss = ss + torch.einsum("nk, ni, nj -> kij", r, x, x)
+        log_likelihood += torch.logsumexp(logp, dim=-1).sum().item()
+        num_obs += len(x)
+    return n, s, ss, log_likelihood / num_obs
+
+def fit_mixture(
+    make_batches, num_components, cov_type="full",
+    kmeans_epochs=1, em_steps=5, reg=1e-3, seed=0
+    ):
+    """ Fit gaussian mixture parameters with mini-batch k-means followed by
+    full pass EM steps over a data stream
+
+    Args:
+        make_batches (callable): function returning a new iterator over data batches.
+            size=[batch_size, x_dim]
+        num_components (int): number of mixture components
+        cov_type (str, optional): covariance type ["diag", "full", "tied"]. Default="full"
+        kmeans_epochs (int, optional): number of k-means passes. Default=1
+        em_steps (int, optional): number of em steps. Default=5
+        reg (float, optional): covariance diagonal regularization. Default=1e-3
+        seed (int, optional): random seed. Default=0
+
+    Returns:
+        mu (torch.tensor): component means. size=[num_components, x_dim]
+        cov (torch.tensor): component covariances. size=[num_components, x_dim, x_dim]
+        log_likelihood (float): average data log likelihood before the last em step.
+            None if em_steps=0
+    """
+    centers = minibatch_kmeans(make_batches, num_components, kmeans_epochs, seed)
+
+    # hard assignment statistics
+    hard_log_prob = lambda x: -1e6 * torch.cdist(x, centers)
+    n, s, ss, _ = accumulate_stats(make_batches, hard_log_prob)
+    log_likelihood = None
+    for i in range(em_steps + 1):
+        # m step. empty components keep their means and unit covariance
+        empty = (n < 1e-6).view(-1, 1, 1)
+        n_ = n.clip(min=1e-6).unsqueeze(-1)
+        mu = torch.where(empty[..., 0], centers, s / n_)
+        cov = ss / n_.unsqueeze(-1) - mu.unsqueeze(-1) * mu.unsqueeze(-2)
+        cov = torch.where(empty, torch.eye(mu.shape[-1]).to(mu.device), cov)
+        cov = restrict_covariance(cov, cov_type, reg)
+        log_pi = torch.log(n / n.sum() + 1e-6)
+        centers = mu
+        if i == em_steps:
+            break
+
+        # e step
+        distribution = torch_dist.MultivariateNormal(mu, cov)
+        log_prob = lambda x: log_pi + distribution.log_prob(x.unsqueeze(-2))
+        n, s, ss, log_likelihood = accumulate_stats(make_batches, log_prob)
+    return mu, cov, log_likelihood
+
+def init_obs_model(obs_model, make_batches, kmeans_epochs=1, em_steps=5, reg=1e-3, seed=0):
+    """ Initialize ConditionalGaussian means and covariances from data. The mixture
+    is fit in the batch normalized space. Batch norm stats should be initialized beforehand.
+
+    Args:
+        obs_model (ConditionalGaussian): observation model to initialize in place
+        make_batches (callable): function returning a new iterator over
+            observation batches. size=[batch_size, x_dim]
+        kmeans_epochs (int, optional): number of k-means passes. Default=1
+        em_steps (int, optional): number of em steps. Default=5
+        reg (float, optional): covariance diagonal regularization in the
+            batch normalized space. Default=1e-3
+        seed (int, optional): random seed. Default=0
+
+    Returns:
+        log_likelihood (float): average log likelihood of the normalized data.
+            None if em_steps=0
+    """
+    with torch.no_grad():
+        scale, shift = obs_model.batch_norm_affine()
+        device = scale.device
+        normalize = lambda: (x.to(device) * scale + shift for x in make_batches())
+        mu, cov, log_likelihood = fit_mixture(
+            normalize, obs_model.z_dim, obs_model.cov, kmeans_epochs, em_steps, reg, seed
+        )
+
+        # map back to observation space
+        mu = (mu - shift) / scale
+        cov = cov / scale.unsqueeze(-1) / scale.unsqueeze(-2)
+    obs_model.init_params(mu, cov)
+    return log_likelihood
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,6 +6,8 @@ import torch.distributions as torch_dist
 from src.distributions.flows import SimpleTransformedModule, BatchNormTransform
 from src.distributions.utils import make_covariance_matrix
 
+from torch import Tensor
+
 class ConditionalGaussian(nn.Module):
     """ Conditional gaussian distribution used to create mixture distributions """
     def __init__(self, x_dim, z_dim, cov="full", batch_norm=True):
@@ -12,7 +15,8 @@ class ConditionalGaussian(nn.Module):
         Args:
             x_dim (int): observed output dimension
             z_dim (int): latent conditonal dimension
-            cov (str): covariance type ["diag", "full", "tied]
+            cov (str): covariance type ["diag", "full", "tied]. 
+                tied uses a diagonal covariance shared by all components
             batch_norm (bool, optional): whether to use input batch normalization. default=True
         """
         super().__init__()
@@ -31,14 +35,29 @@ class ConditionalGaussian(nn.Module):
             self.tl = nn.Parameter(torch.zeros(1, z_dim, x_dim, x_dim), requires_grad=True)
         elif cov == "diag":
             self.lv = nn.Parameter(torch.zeros(1, z_dim, x_dim), requires_grad=True)
-            self.tl = nn.Parameter(torch.zeros(1, z_dim, x_dim, x_dim), requires_grad=False)
+            self.register_parameter("tl", None)
         elif cov == "tied":
             self.lv = nn.Parameter(torch.zeros(1, 1, x_dim), requires_grad=True)
-            self.tl = nn.Parameter(torch.zeros(1, z_dim, x_dim, x_dim), requires_grad=False)
+            self.register_parameter("tl", None)
         
         if batch_norm:
             self.bn = BatchNormTransform(x_dim, momentum=0.1, affine=False, update_stats=False)
         
+        self.use_script = False # whether to use scripted log likelihood
+        self._cache = None # parameter derived factors
+        
+    def __getstate__(self):
+        # cached tensors hold autograd graphs which cannot be copied
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store an unused zero tl for diag and tied covariance
+        if self.tl is None:
+            state_dict.pop(prefix + "tl", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
     def __repr__(self):
         s = "{}(x_dim={}, z_dim={}, cov={}, batch_norm={})".format(
             self.__class__.__name__, self.x_dim, self.z_dim, self.cov, 
@@ -49,14 +68,88 @@ class ConditionalGaussian(nn.Module):
     def init_batch_norm(self, mean, variance):
         self.bn.moving_mean.data = mean
         self.bn.moving_variance.data = variance
+    
+    def init_params(self, mu, cov):
+        """ Initialize component means and covariances from observation space statistics. 
+        Statistics are mapped to the batch normalized space if batch norm is used.
+        Only the diagonal is used for diag covariance, averaged over components if tied.
 
-    def get_distribution_class(self, requires_grad=True):
-        [mu, lv, tl] = self.mu, self.lv, self.tl
-        L = make_covariance_matrix(lv, tl, cholesky=True, lv_rectify="exp")
+        Args:
+            mu (torch.tensor): component means. size=[z_dim, x_dim]
+            cov (torch.tensor): component covariances. size=[z_dim, x_dim, x_dim]
+        """
+        with torch.no_grad():
+            scale, shift = self.batch_norm_affine()
+            mu = mu * scale + shift
+            cov = cov * scale.unsqueeze(-1) * scale.unsqueeze(-2)
+            
+            self.mu.data = mu.unsqueeze(0)
+            if self.cov == "full":
+                L = torch.linalg.cholesky(cov)
+                self.lv.data = torch.log(torch.diagonal(L, dim1=-2, dim2=-1)).unsqueeze(0)
+                self.tl.data = torch.tril(L, diagonal=-1).unsqueeze(0)
+            elif self.cov == "diag":
+                self.lv.data = 0.5 * torch.log(torch.diagonal(cov, dim1=-2, dim2=-1)).unsqueeze(0)
+            elif self.cov == "tied":
+                var = torch.diagonal(cov, dim1=-2, dim2=-1).mean(0)
+                self.lv.data = 0.5 * torch.log(var).view(1, 1, -1)
+
+    def batch_norm_affine(self):
+        """ Return batch norm inverse transform as elementwise scale and shift 
+        using moving stats. Identity if batch norm is not used. size=[x_dim] """
+        if not self.batch_norm:
+            return torch.ones_like(self.mu[0, 0]), torch.zeros_like(self.mu[0, 0])
+        bn = self.bn
+        scale = bn.constrained_gamma / torch.sqrt(bn.moving_variance + bn.epsilon)
+        shift = bn.beta - bn.moving_mean * scale
+        return scale, shift
+
+    def _cache_key(self):
+        """ Signature of parameter storage and in-place version counters """
+        key = [torch.is_grad_enabled()]
+        for p in self.parameters():
+            key.append((p.data_ptr(), p._version))
+        return tuple(key)
+    
+    def _clear_cache(self, grad=None):
+        self._cache = None
         
-        if requires_grad is False:
-            mu, L = mu.data, L.data
+    def compute_factors(self):
+        """ Compute cholesky factors, log determinants, and distribution.
+        
+        Factors are cached and reused until any parameter is modified in place 
+        or replaced. The cache is also cleared once a backward pass reaches the 
+        cached factors since their autograd graph is freed.
+
+        Returns:
+            cache (dict): dict with keys ["scale_tril", "logdet", "distribution"]
+        """
+        key = self._cache_key()
+        if self._cache is None or self._cache["key"] != key:
+            L = make_covariance_matrix(self.lv, self.tl, cholesky=True, lv_rectify="exp")
+            logdet = 2 * torch.log(torch.diagonal(L, dim1=-2, dim2=-1)).sum(-1)
+            distribution = self.make_distribution(self.mu, L)
+            if L.requires_grad:
+                L.register_hook(self._clear_cache)
+            self._cache = {
+                "key": key,
+                "scale_tril": L,
+                "logdet": logdet,
+                "distribution": distribution
+            }
+        return self._cache
+
+    def scale_tril(self):
+        """ Return component cholesky factors. size=[1, z_dim, x_dim, x_dim] 
+        or size=[1, 1, x_dim, x_dim] if tied """
+        return self.compute_factors()["scale_tril"]
+    
+    def logdet(self):
+        """ Return component covariance log determinants in the normalized space. 
+        size=[1, z_dim] or size=[1, 1] if tied """
+        return self.compute_factors()["logdet"]
 
+    def make_distribution(self, mu, L):
         distribution = torch_dist.MultivariateNormal(mu, scale_tril=L)
         
         transforms = []
@@ -64,6 +157,11 @@ class ConditionalGaussian(nn.Module):
             transforms.append(self.bn)
         distribution = SimpleTransformedModule(distribution, transforms)
         return distribution
+
+    def get_distribution_class(self, requires_grad=True):
+        if requires_grad is False:
+            return self.make_distribution(self.mu.data, self.scale_tril().data)
+        return self.compute_factors()["distribution"]
     
     def mean(self, params=None):
         distribution = self.get_distribution_class(params)
@@ -83,17 +181,27 @@ class ConditionalGaussian(nn.Module):
         Args:
             x (torch.tensor): size=[batch_size, x_dim]
         """
+        if self.cov != "full":
+            # elementwise standardization without cholesky factors
+            scale, shift = self.batch_norm_affine()
+            log_std = self.lv.clip(math.log(1e-6), math.log(1e6))
+            log_prob_fn = script_function(diag_gaussian_log_prob) if self.use_script else diag_gaussian_log_prob
+            return log_prob_fn(x, self.mu, log_std, scale, shift)
+        if self.use_script:
+            scale, shift = self.batch_norm_affine()
+            return script_function(affine_gaussian_log_prob)(x, self.mu, self.scale_tril(), scale, shift)
         distribution = self.get_distribution_class()
         return distribution.log_prob(x.unsqueeze(-2))
     
-    def mixture_log_prob(self, pi, x):
+    def mixture_log_prob(self, pi, x, log_space=False):
         """ Compute mixture log probabilities 
         
         Args:
             pi (torch.tensor): mixing weights. size=[..., z_dim]
             x (torch.tensor): observervations. size[..., x_dim]
+            log_space (bool, optional): whether pi is given as log mixing weights. Default=False
         """
-        logp_pi = torch.log(pi + self.eps)
+        logp_pi = pi if log_space else torch.log(pi + self.eps)
         logp_x = self.log_prob(x)
         logp = torch.logsumexp(logp_pi + logp_x, dim=-1)
         return logp
@@ -130,7 +238,9 @@ class ConditionalGaussian(nn.Module):
         x = torch.sum(pi.unsqueeze(-1) * mu.unsqueeze(0), dim=-2)
         return x
     
-    def ancestral_sample(self, pi, num_samples=1, sample_mean=False, tau=0.1, hard=True):
+    def ancestral_sample(
+        self, pi, num_samples=1, sample_mean=False, tau=0.1, hard=True, select=False
+        ):
         """ Ancestral sampling
         
         Args:
@@ -139,6 +249,9 @@ class ConditionalGaussian(nn.Module):
             sample_mean (bool, optional): whether to sample component mean. Default=False
             tau (float, optional): gumbel softmax temperature. Default=0.1
             hard (float, optional): if hard use straight-through gradient. Default=True
+            select (bool, optional): whether to sample component indices first and 
+                only draw from the selected components. Samples are always hard and 
+                mixing weight gradients are straight-through over component means. Default=False
 
         Returns:
             x (torch.tensor): sampled observations. size[num_samples, T, batch_size, x_dim]
@@ -147,6 +260,8 @@ class ConditionalGaussian(nn.Module):
         z_ = F.gumbel_softmax(log_pi_, tau=tau, hard=hard).unsqueeze(-1)
         # z_ = torch_dist.RelaxedOneHotCategorical(1, pi).rsample((num_samples,))
         # z_ = straight_through_sample(z_, dim=-1).unsqueeze(-1)
+        if select:
+            return self.select_sample(z_.squeeze(-1), sample_mean)
         
         # sample component
         if sample_mean:
@@ -155,3 +270,94 @@ class ConditionalGaussian(nn.Module):
             x_ = self.sample((num_samples, pi.shape[0])).squeeze(1)
         x = torch.sum(z_ * x_, dim=-2)
         return x
+    
+    def select_sample(self, z, sample_mean=False):
+        """ Sample from the argmax components of relaxed one hot vectors by 
+        gathering their means and cholesky factors
+
+        Args:
+            z (torch.tensor): relaxed one hot component vectors. size=[..., z_dim]
+            sample_mean (bool, optional): whether to sample component mean. Default=False
+
+        Returns:
+            x (torch.tensor): sampled observations. size=[..., x_dim]
+        """
+        idx = z.argmax(-1)
+        mean = self.mean()[0] # size=[z_dim, x_dim]
+        if sample_mean:
+            x = mean[idx]
+        else:
+            mu = self.mu[0][idx]
+            eps = torch.randn_like(mu)
+            if self.cov == "full":
+                L = self.scale_tril()[0][idx]
+                x = mu + torch.matmul(L, eps.unsqueeze(-1)).squeeze(-1)
+            else:
+                std = torch.exp(self.lv[0]).expand(self.z_dim, -1)
+                x = mu + std[idx] * eps
+            
+            # map from batch normalized space to observation space
+            scale, shift = self.batch_norm_affine()
+            x = (x - shift) / scale
+        
+        # straight-through gradient for mixing weights
+        x = x + torch.matmul(z - z.detach(), mean)
+        return x
+
+_scripted_functions = {}
+
+def script_function(fn):
+    """ Compile a function with TorchScript on first use. Compilation is deferred 
+    so that importing this module does not invoke the TorchScript compiler """
+    if fn not in _scripted_functions:
+        _scripted_functions[fn] = torch.jit.script(fn)
+    return _scripted_functions[fn]
+
+def affine_gaussian_log_prob(
+    x: Tensor, mu: Tensor, scale_tril: Tensor, scale: Tensor, shift: Tensor
+    ) -> Tensor:
+    """ Component log probabilities of observations under an elementwise affine 
+    transform z = x * scale + shift followed by gaussian components on z
+
+    Args:
+        x (torch.tensor): observations. size=[..., x_dim]
+        mu (torch.tensor): component means. size=[1, z_dim, x_dim]
+        scale_tril (torch.tensor): component cholesky factors. size=[1, z_dim, x_dim, x_dim]
+        scale (torch.tensor): transform scale. size=[x_dim]
+        shift (torch.tensor): transform shift. size=[x_dim]
+    
+    Returns:
+        logp (torch.tensor): component log probabilities. size=[..., z_dim]
+    """
+    x_dim = x.shape[-1]
+    eye = torch.eye(x_dim, dtype=x.dtype, device=x.device).expand_as(scale_tril)
+    L_inv = torch.linalg.solve_triangular(scale_tril, eye, upper=False)[0]
+    diff = (x * scale + shift).unsqueeze(-2) - mu[0]
+    m = torch.einsum("zij, ...zj -> ...zi", [L_inv, diff])
+    log_det = torch.log(torch.diagonal(scale_tril[0], dim1=-2, dim2=-1)).sum(-1)
+    logp = -0.5 * m.pow(2).sum(-1) - log_det - 0.5 * x_dim * math.log(2 * math.pi)
+    return logp + torch.log(scale).sum()
+
+def diag_gaussian_log_prob(
+    x: Tensor, mu: Tensor, log_std: Tensor, scale: Tensor, shift: Tensor
+    ) -> Tensor:
+    """ Component log probabilities of observations under an elementwise affine 
+    transform z = x * scale + shift followed by diagonal gaussian components on z
+
+    Args:
+        x (torch.tensor): observations. size=[..., x_dim]
+        mu (torch.tensor): component means. size=[1, z_dim, x_dim]
+        log_std (torch.tensor): component log standard deviations. 
+            size=[1, z_dim, x_dim] or size=[1, 1, x_dim] if tied
+        scale (torch.tensor): transform scale. size=[x_dim]
+        shift (torch.tensor): transform shift. size=[x_dim]
+    
+    Returns:
+        logp (torch.tensor): component log probabilities. size=[..., z_dim]
+    """
+    x_dim = x.shape[-1]
+    diff = (x * scale + shift).unsqueeze(-2) - mu[0]
+    m = diff * torch.exp(-log_std[0])
+    log_det = log_std[0].sum(-1)
+    logp = -0.5 * m.pow(2).sum(-1) - log_det - 0.5 * x_dim * math.log(2 * math.pi)
+    return logp + torch.log(scale).sum()
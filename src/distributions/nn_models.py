@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 from src.distributions.flows import BatchNormTransform
@@ -53,4 +54,84 @@ class MLP(Model):
             
         for layer in self.layers:
             x = layer(x)
-        return x
\ No newline at end of file
+        return x
+
+class EnsembleLinear(nn.Module):
+    """ Stacked linear layers evaluated with a single batched matmul """
+    def __init__(self, num_members, input_dim, output_dim):
+        super().__init__()
+        self.num_members = num_members
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        
+        # use nn.Linear default initialization for each member
+        bound = 1 / math.sqrt(input_dim)
+        self.weight = nn.Parameter(torch.empty(num_members, input_dim, output_dim))
+        self.bias = nn.Parameter(torch.empty(num_members, 1, output_dim))
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+    
+    def __repr__(self):
+        s = "{}(num_members={}, input_dim={}, output_dim={})".format(
+            self.__class__.__name__, self.num_members, self.input_dim, self.output_dim
+        )
+        return s
+
+    def forward(self, x):
+        """
+        Args:
+            x (torch.tensor): member inputs. size=[num_members, batch_size, input_dim]
+
+        Returns:
+            out (torch.tensor): member outputs. size=[num_members, batch_size, output_dim]
+        """
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleMLP(Model):
+    """ Ensemble of MLPs with stacked weights. Layer indices match MLP """
+    def __init__(self, num_members, input_dim, output_dim, hidden_dim, num_hidden, activation):
+        super().__init__()
+        self.num_members = num_members
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.hidden_dim = hidden_dim
+        self.num_hidden = num_hidden
+        self.activation = activation
+        
+        if activation == "relu":
+            act = nn.ReLU()
+        elif activation == "silu":
+            act = nn.SiLU()
+        else:
+            raise NotImplementedError
+
+        layers = [EnsembleLinear(num_members, input_dim, hidden_dim)]
+        for _ in range(num_hidden):
+            layers.append(act)
+            layers.append(EnsembleLinear(num_members, hidden_dim, hidden_dim))
+        layers.append(act)
+        layers.append(EnsembleLinear(num_members, hidden_dim, output_dim))
+        self.layers = nn.ModuleList(layers)
+
+    def __repr__(self):
+        s = "{}(num_members={}, input_dim={}, output_dim={}, hidden_dim={}, num_hidden={}, activation={})".format(
+            self.__class__.__name__, self.num_members, self.input_dim, self.output_dim, 
+            self.hidden_dim, self.num_hidden, self.activation
+        )
+        return s
+
+    def forward(self, x):
+        """ Evaluate all members on a shared input
+
+        Args:
+            x (torch.tensor): input. size=[..., input_dim]
+
+        Returns:
+            out (torch.tensor): member outputs. size=[num_members, ..., output_dim]
+        """
+        batch_shape = x.shape[:-1]
+        x = x.reshape(1, -1, self.input_dim).expand(self.num_members, -1, -1)
+        for layer in self.layers:
+            x = layer(x)
+        return x.view(self.num_members, *batch_shape, self.output_dim)
@@ -0,0 +1,93 @@
+class RunningStats:
+    """ Streaming mean and variance using Welford/Chan style moment merging.
+
+    Works with numpy arrays and torch tensors as long as all updates use the
+    same backend. Statistics are taken over all but the last dimension.
+    With momentum > 0, the accumulated count and moments are decayed by
+    (1 - momentum) before each update, giving exponentially weighted stats.
+    """
+    def __init__(self, momentum=0.):
+        """
+        Args:
+            momentum (float, optional): exponential decay rate applied before
+                each update. No decay if momentum=0. Default=0.
+        """
+        self.momentum = momentum
+        self.count = 0.
+        self.mean = 0.
+        self.m2 = 0.
+
+    def __repr__(self):
+        s = "{}(momentum={}, count={})".format(
+            self.__class__.__name__, self.momentum, float(self.count)
+        )
+        return s
+
+    @property
+    def variance(self):
+        """ Population variance. Zero if no data has been added """
+        return self.m2 / (self.count + (self.count == 0))
+
+    def update(self, x, mask=None):
+        """ Add a batch of data
+
+        Args:
+            x (np.array or torch.tensor): data. size=[..., dim]
+            mask (np.array or torch.tensor, optional): binary or weight mask over
+                the leading dimensions of x. size=[...]. Default=None
+
+        Returns:
+            self (RunningStats)
+        """
+        count, mean, m2 = batch_moments(x, mask)
+        if self.momentum > 0:
+            self.count = self.count * (1 - self.momentum)
+            self.m2 = self.m2 * (1 - self.momentum)
+        self._combine(count, mean, m2)
+        return self
+
+    def merge(self, other):
+        """ Merge partial results computed on another stream. Decay is not applied
+
+        Args:
+            other (RunningStats): stats to merge
+
+        Returns:
+            self (RunningStats)
+        """
+        self._combine(other.count, other.mean, other.m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        ratio = count / (total + (total == 0))
+        delta = mean - self.mean
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * ratio
+        self.count = total
+
+
+def batch_moments(x, mask=None):
+    """ Count, mean, and sum of squared deviations of a batch
+
+    Args:
+        x (np.array or torch.tensor): data. size=[..., dim]
+        mask (np.array or torch.tensor, optional): binary or weight mask over
+            the leading dimensions of x. size=[...]. Default=None
+
+    Returns:
+        count (float or array): total weight
+        mean (np.array or torch.tensor): weighted mean. size=[dim]
+        m2 (np.array or torch.tensor): weighted sum of squared deviations. size=[dim]
+    """
+    x = x.reshape(-1, x.shape[-1])
+    if mask is None:
+        count = float(x.shape[0])
+        mean = x.sum(0) / max(count, 1.)
+        m2 = ((x - mean) ** 2).sum(0)
+    else:
+        w = mask.reshape(-1, 1)
+        count = w.sum()
+        mean = (w * x).sum(0) / (count + (count == 0))
+        m2 = (w * (x - mean) ** 2).sum(0)
+    return count, mean, m2